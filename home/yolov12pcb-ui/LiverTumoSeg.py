@@ -1,5 +1,6 @@
 import streamlit as st
 from st_pages import Page, Section, show_pages, add_page_title, hide_pages
+from assets import show_image
 
 add_page_title()
 
@@ -25,7 +26,7 @@ hide_pages(["Thank you"])
 
 st.markdown("### 👨‍🔧 感谢[DataTalksClub](https://datatalks.club/)")
 
-st.image("https://pbs.twimg.com/media/FmmYA2YWYAApPRB.png")
+show_image("https://pbs.twimg.com/media/FmmYA2YWYAApPRB.png")
 
 # st.info("Original Course Repository on [Github](https://github.com/DataTalksClub/data-engineering-zoomcamp)")
 
@@ -63,7 +64,7 @@ st.markdown("""
 
 ### 🔎 Overview""", unsafe_allow_html=True)
 
-st.image(
+show_image(
     "https://raw.githubusercontent.com/DataTalksClub/data-engineering-zoomcamp/main/images/architecture/photo1700757552.jpeg")
 
 st.markdown("""
@@ -0,0 +1,262 @@
+import os
+import io
+import re
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+
+import requests
+import streamlit as st
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 静态资源层：远程图片按内容寻址缓存到本地，本地图片只解码一次并预先缩放压缩，
+# 通过 Streamlit 静态文件服务（server.enableStaticServing）提供，文件名即内容哈希，
+# URL 带 ?v= 时 tornado 返回长期缓存头；离线或未开启静态服务时回退为页面内嵌。
+# 开启静态服务: streamlit run Hello.py --server.enableStaticServing true
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, "static", "assets")
+STATIC_URL = "app/static/assets"
+MANIFEST_NAME = "manifest.json"
+
+# 页面展示的最大宽度，更大的图片预先缩小
+MAX_WIDTH = 1400
+# 设置 PCB_OFFLINE=1 时不访问外网，只使用本地缓存
+OFFLINE = os.environ.get("PCB_OFFLINE") == "1"
+# 远程下载失败后，在这段时间内不再重试（秒），避免离线主机上反复发起下载
+RETRY_AFTER = 300
+
+# 页面用到的远程图片，vendor 命令会预先下载
+REMOTE_IMAGES = [
+    "https://pbs.twimg.com/media/FmmYA2YWYAApPRB.png",
+    "https://raw.githubusercontent.com/DataTalksClub/data-engineering-zoomcamp/main/images/architecture/photo1700757552.jpeg",
+]
+
+YOUTUBE_ID = re.compile(r"(?:v=|youtu\.be/)([\w-]{11})")
+
+
+def _optimize(data, max_width):
+    """缩放到展示宽度并压缩为 WebP，返回 (字节, 宽, 高)"""
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "P") else "RGB")
+    if image.width > max_width:
+        image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=85, method=4)
+    return buffer.getvalue(), image.width, image.height
+
+
+class AssetCache:
+    """
+    内容寻址的静态资源缓存
+
+    manifest.json 记录来源（URL 或本地路径+修改时间）到缓存文件的映射，
+    同一来源在进程内只下载/解码一次，跨进程和重启通过清单复用。
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, max_width=MAX_WIDTH, offline=OFFLINE, timeout=3):
+        """
+        Args:
+            static_dir (str): 缓存目录（需位于静态文件服务目录 static/ 下）
+            max_width (int): 最大宽度
+            offline (bool): 离线模式，不尝试下载
+            timeout (float): 下载超时（秒）
+        """
+        self.static_dir = static_dir
+        self.max_width = max_width
+        self.offline = offline
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._failed = {}
+        self._fetching = set()
+        self._data = {}
+        os.makedirs(static_dir, exist_ok=True)
+        self._manifest_path = os.path.join(static_dir, MANIFEST_NAME)
+        self.manifest = {"remote": {}, "local": {}}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                self.manifest.update(json.load(f))
+
+    def _save_manifest(self):
+        with open(self._manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(self._manifest_path + ".tmp", self._manifest_path)
+
+    def _store(self, data):
+        """优化后按内容哈希落盘，返回清单条目"""
+        optimized, width, height = _optimize(data, self.max_width)
+        digest = hashlib.sha256(optimized).hexdigest()[:16]
+        name = f"{digest}.webp"
+        path = os.path.join(self.static_dir, name)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(optimized)
+            os.replace(path + ".tmp", path)
+        return {"file": name, "hash": digest, "width": width, "height": height, "bytes": len(optimized)}
+
+    def _valid(self, entry):
+        return entry is not None and os.path.exists(os.path.join(self.static_dir, entry["file"]))
+
+    def remote(self, url, background=True):
+        """
+        远程图片的本地缓存条目；未缓存时发起一次下载
+
+        页面渲染中默认在后台线程下载，立即返回，下载完成后的下一次渲染即可显示；
+        离线主机上不会让页面等待下载超时。
+
+        Args:
+            url (str): 图片 URL
+            background (bool): 是否在后台下载，False 时等待下载完成（vendor 命令）
+
+        Returns:
+            dict: 缓存条目，未缓存（下载中、离线或下载失败）时为 None
+        """
+        entry = self.manifest["remote"].get(url)
+        if self._valid(entry):
+            return entry
+        if self.offline or time.time() - self._failed.get(url, 0) < RETRY_AFTER:
+            return None
+        if not background:
+            return self._fetch(url)
+        with self._lock:
+            if url in self._fetching:
+                return None
+            self._fetching.add(url)
+        threading.Thread(target=self._fetch, args=(url,), name="asset-fetch", daemon=True).start()
+        return None
+
+    def _fetch(self, url):
+        """下载并缓存远程图片，失败时记录时间，RETRY_AFTER 内不再重试"""
+        try:
+            response = requests.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            entry = dict(self._store(response.content), fetched=time.time())
+        except Exception as e:
+            self._failed[url] = time.time()
+            logger.warning(f"远程图片不可用: {url}: {str(e)}")
+            entry = None
+        with self._lock:
+            self._fetching.discard(url)
+            if entry is not None:
+                self.manifest["remote"][url] = entry
+                self._save_manifest()
+        return entry
+
+    def local(self, path):
+        """本地图片的缓存条目，文件变化后重新生成"""
+        abs_path = os.path.join(APP_DIR, path) if not os.path.isabs(path) else path
+        if not os.path.exists(abs_path):
+            return None
+        key = os.path.relpath(abs_path, APP_DIR)
+        stat = os.stat(abs_path)
+        entry = self.manifest["local"].get(key)
+        if self._valid(entry) and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry
+        with open(abs_path, "rb") as f:
+            entry = dict(self._store(f.read()), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        with self._lock:
+            self.manifest["local"][key] = entry
+            self._save_manifest()
+        return entry
+
+    def url(self, entry):
+        """静态文件 URL，带版本参数以获得长期缓存头"""
+        return f"{STATIC_URL}/{entry['file']}?v={entry['hash']}"
+
+    def data(self, entry):
+        """缓存文件内容（未开启静态服务时内嵌到页面），进程内只读一次"""
+        data = self._data.get(entry["file"])
+        if data is None:
+            with open(os.path.join(self.static_dir, entry["file"]), "rb") as f:
+                data = f.read()
+            self._data[entry["file"]] = data
+        return data
+
+    def vendor(self, urls=REMOTE_IMAGES, local_dirs=("page1/image",)):
+        """预先缓存远程图片和本地图片（联网环境下执行一次，随部署分发 static/assets）"""
+        result = {"cached": [], "failed": []}
+        for url in urls:
+            self._failed.pop(url, None)
+            (result["cached"] if self.remote(url, background=False) else result["failed"]).append(url)
+        for directory in local_dirs:
+            for name in sorted(os.listdir(os.path.join(APP_DIR, directory))):
+                if name.lower().endswith((".png", ".jpg", ".jpeg")):
+                    self.local(os.path.join(directory, name))
+                    result["cached"].append(os.path.join(directory, name))
+        return result
+
+
+@st.cache_resource
+def get_asset_cache():
+    return AssetCache()
+
+
+def show_image(source, caption=None, use_column_width=False):
+    """
+    显示图片：远程 URL 或本地路径都从本地缓存提供，不可用（包括后台下载中）时显示占位说明
+
+    Args:
+        source (str): 图片 URL 或相对应用目录的路径
+        caption (str): 图片说明
+        use_column_width (bool): 宽度撑满列
+    """
+    cache = get_asset_cache()
+    entry = cache.remote(source) if source.startswith(("http://", "https://")) else cache.local(source)
+    if entry is None:
+        st.caption(f"🖼️ 图片暂不可用{'：' + caption if caption else ''}")
+        return
+    if not st.get_option("server.enableStaticServing"):
+        st.image(cache.data(entry), caption=caption, use_column_width=use_column_width)
+        return
+    style = "width:100%" if use_column_width else f"max-width:min(100%, {entry['width']}px)"
+    html = (f'<img src="{cache.url(entry)}" width="{entry["width"]}" height="{entry["height"]}" '
+            f'style="{style};height:auto" loading="lazy" alt="{caption or ""}">')
+    if caption:
+        html = (f'<div style="text-align:center">{html}'
+                f'<p style="color:rgba(49,51,63,0.6);font-size:14px">{caption}</p></div>')
+    st.markdown(html, unsafe_allow_html=True)
+
+
+def show_video(url):
+    """
+    显示视频：static/assets/videos 下有同 ID 的本地文件时使用本地文件，
+    离线时只显示链接，避免嵌入无法访问的外部播放器
+    """
+    match = YOUTUBE_ID.search(url)
+    if match:
+        local_name = f"{match.group(1)}.mp4"
+        if os.path.exists(os.path.join(STATIC_DIR, "videos", local_name)):
+            if st.get_option("server.enableStaticServing"):
+                st.markdown(f'<video src="{STATIC_URL}/videos/{local_name}" controls preload="metadata" '
+                            f'style="width:100%"></video>', unsafe_allow_html=True)
+            else:
+                st.video(os.path.join(STATIC_DIR, "videos", local_name))
+            return
+    if OFFLINE:
+        st.info(f"🎬 当前为离线模式，视频地址: {url}")
+        return
+    st.video(url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="静态资源预缓存")
+    parser.add_argument("--static-dir", default=STATIC_DIR)
+    parser.add_argument("--max-width", type=int, default=MAX_WIDTH)
+    args = parser.parse_args()
+    result = AssetCache(args.static_dir, args.max_width, offline=False, timeout=30).vendor()
+    print(f"已缓存 {len(result['cached'])} 个资源, 失败 {len(result['failed'])} 个")
+    for url in result["failed"]:
+        print(f"  失败: {url}")
+
+
+if __name__ == "__main__":
+    main()
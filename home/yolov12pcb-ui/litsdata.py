@@ -0,0 +1,403 @@
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import argparse
+import concurrent.futures
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 索引格式版本，切片参数或布局变化时递增
+STORE_VERSION = 1
+INDEX_NAME = "index.json"
+
+# 默认腹部窗（HU），肝脏与肿瘤的对比度集中在这个区间
+DEFAULT_WINDOW = (-200, 250)
+DEFAULT_SIZE = 512
+DEFAULT_CHUNK = 32
+# 构建时默认最多的进程数：每个进程载入整个体数据（LiTS 单个体数据解码后可达 1GB）
+MAX_BUILD_WORKERS = 4
+
+VOLUME_PATTERN = re.compile(r"volume-(\d+)\.nii(\.gz)?$")
+
+
+def find_lits_pairs(source_dir):
+    """
+    查找 LiTS 的 volume-N.nii / segmentation-N.nii 配对（支持分批子目录和 .nii.gz）
+
+    Returns:
+        dict: {"volume-N": (体数据路径, 标注路径)}，按编号排序
+    """
+    volumes, segmentations = {}, {}
+    for root, _, files in os.walk(source_dir):
+        for name in files:
+            match = VOLUME_PATTERN.match(name)
+            if match:
+                volumes[int(match.group(1))] = os.path.join(root, name)
+            elif name.startswith("segmentation-"):
+                match = re.match(r"segmentation-(\d+)\.nii(\.gz)?$", name)
+                if match:
+                    segmentations[int(match.group(1))] = os.path.join(root, name)
+    pairs = OrderedDict()
+    for number in sorted(volumes):
+        if number not in segmentations:
+            logger.warning(f"volume-{number} 没有对应的标注，已跳过")
+            continue
+        pairs[f"volume-{number}"] = (volumes[number], segmentations[number])
+    return pairs
+
+
+def load_nifti(path):
+    """
+    读取 NIfTI 体数据
+
+    Returns:
+        tuple: (数组 (Z, H, W), 体素间距 (z, y, x) mm)
+    """
+    try:
+        import nibabel as nib
+    except ImportError:
+        raise ImportError("读取 .nii 需要安装 nibabel: pip install nibabel")
+    image = nib.load(path)
+    # nibabel 轴序为 (X, Y, Z)，转为按层排列的 (Z, Y, X)
+    data = np.transpose(np.asanyarray(image.dataobj), (2, 1, 0))
+    zooms = image.header.get_zooms()[:3]
+    return data, (float(zooms[2]), float(zooms[1]), float(zooms[0]))
+
+
+def window_slices(volume, window=DEFAULT_WINDOW):
+    """按 HU 窗截断并线性映射到 uint8"""
+    low, high = window
+    scaled = (np.clip(volume.astype(np.float32), low, high) - low) * (255.0 / (high - low))
+    return np.round(scaled).astype(np.uint8)
+
+
+def _source_stamp(paths):
+    return [{"path": os.path.abspath(p), "size": os.path.getsize(p), "mtime_ns": os.stat(p).st_mtime_ns}
+            for p in paths]
+
+
+def _config(window, size, chunk, compress, margin):
+    return {"version": STORE_VERSION, "window": list(window), "size": size, "chunk": chunk,
+            "compress": compress, "margin": margin}
+
+
+def _build_volume(name, volume_path, seg_path, out_dir, config):
+    """
+    在工作进程中处理一个体数据：加窗、缩放、按块写盘
+
+    先写到临时目录再整体替换，中断的构建不会留下半个体数据。
+    """
+    start = time.time()
+    volume, spacing = load_nifti(volume_path)
+    labels, _ = load_nifti(seg_path)
+    if volume.shape != labels.shape:
+        raise ValueError(f"{name}: 体数据 {volume.shape} 与标注 {labels.shape} 尺寸不一致")
+    labels = labels.astype(np.uint8)
+
+    # 只保留肝脏附近的层（margin 为肝脏上下额外保留的层数）
+    liver_slices = np.flatnonzero(labels.reshape(len(labels), -1).max(axis=1) > 0)
+    if config["margin"] is not None and liver_slices.size:
+        lo = max(0, int(liver_slices[0]) - config["margin"])
+        hi = min(len(labels), int(liver_slices[-1]) + config["margin"] + 1)
+        volume, labels = volume[lo:hi], labels[lo:hi]
+        first_slice = lo
+    else:
+        first_slice = 0
+
+    # 按块加窗、缩放并写盘：加窗需要 float32 中间结果，逐块处理使峰值内存与块大小相关，而不是整个体数据
+    size = config["size"]
+    tmp_dir = os.path.join(out_dir, f".{name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    chunk = config["chunk"]
+    chunks, liver, tumor = [], [], []
+    for n, begin in enumerate(range(0, len(volume), chunk)):
+        images = window_slices(volume[begin:begin + chunk], config["window"])
+        masks = labels[begin:begin + chunk]
+        if images.shape[1:] != (size, size):
+            images = np.stack([cv2.resize(s, (size, size), interpolation=cv2.INTER_AREA) for s in images])
+            masks = np.stack([cv2.resize(s, (size, size), interpolation=cv2.INTER_NEAREST) for s in masks])
+        images = np.ascontiguousarray(images)
+        masks = np.ascontiguousarray(masks)
+        stem = f"chunk_{n:04d}"
+        if config["compress"]:
+            np.savez_compressed(os.path.join(tmp_dir, stem + ".npz"), images=images, masks=masks)
+            chunks.append({"file": stem + ".npz", "slices": len(images)})
+        else:
+            np.save(os.path.join(tmp_dir, stem + "_images.npy"), images)
+            np.save(os.path.join(tmp_dir, stem + "_masks.npy"), masks)
+            chunks.append({"file": stem, "slices": len(images)})
+        per_slice = masks.reshape(len(masks), -1).max(axis=1)
+        liver.extend((per_slice >= 1).astype(int).tolist())
+        tumor.extend((per_slice >= 2).astype(int).tolist())
+
+    final_dir = os.path.join(out_dir, name)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+    return {
+        "source": _source_stamp([volume_path, seg_path]),
+        "slices": int(len(labels)),
+        "first_slice": first_slice,
+        "spacing": spacing,
+        "chunks": chunks,
+        # 每层是否含肝脏 / 肿瘤，便于按前景比例采样
+        "liver": liver,
+        "tumor": tumor,
+        "build_time": time.time() - start,
+    }
+
+
+def _load_index(out_dir):
+    path = os.path.join(out_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_index(out_dir, index):
+    path = os.path.join(out_dir, INDEX_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def build_store(source_dir, out_dir, window=DEFAULT_WINDOW, size=DEFAULT_SIZE, chunk=DEFAULT_CHUNK,
+                compress=False, margin=None, workers=None, force=False):
+    """
+    并行把 LiTS 体数据转换为分块切片库；增量构建，只处理新增或变化的体数据
+
+    Args:
+        source_dir (str): LiTS 数据目录
+        out_dir (str): 切片库目录
+        window (tuple): HU 窗 (下限, 上限)
+        size (int): 切片边长
+        chunk (int): 每块层数
+        compress (bool): 压缩存储（.npz，读取时需解压，不能零拷贝映射）
+        margin (int): 只保留肝脏上下 margin 层以内的切片，None 表示保留全部
+        workers (int): 进程数，默认 CPU 核数与 MAX_BUILD_WORKERS 中较小者（每个进程都要载入整个体数据）
+        force (bool): 忽略已有结果全部重建
+
+    Returns:
+        dict: built、skipped、removed、failed 及耗时
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    config = _config(window, size, chunk, compress, margin)
+    index = _load_index(out_dir)
+    if force or index is None or index.get("config") != config:
+        if index is not None:
+            logger.info("切片参数变化，全部重建")
+        index = {"config": config, "volumes": {}}
+
+    pairs = find_lits_pairs(source_dir)
+    todo = [name for name, paths in pairs.items()
+            if index["volumes"].get(name, {}).get("source") != _source_stamp(paths)]
+    removed = [name for name in index["volumes"] if name not in pairs]
+    for name in removed:
+        shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+        del index["volumes"][name]
+
+    start = time.time()
+    failed = {}
+    logger.info(f"共 {len(pairs)} 个体数据, 需要处理 {len(todo)} 个, 移除 {len(removed)} 个")
+    workers = workers or min(os.cpu_count() or 1, MAX_BUILD_WORKERS)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_build_volume, name, *pairs[name], out_dir, config): name for name in todo}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                index["volumes"][name] = future.result()
+                # 每完成一个就落盘索引，中断后可以从这里继续
+                _save_index(out_dir, index)
+                logger.info(f"{name}: {index['volumes'][name]['slices']} 层, "
+                            f"耗时 {index['volumes'][name]['build_time']:.1f}s")
+            except Exception as e:
+                failed[name] = str(e)
+                logger.error(f"{name} 处理失败: {str(e)}")
+
+    index["volumes"] = OrderedDict(sorted(index["volumes"].items(), key=lambda kv: int(kv[0].split("-")[1])))
+    _save_index(out_dir, index)
+    return {"built": len(todo) - len(failed), "skipped": len(pairs) - len(todo), "removed": len(removed),
+            "failed": failed, "time": time.time() - start}
+
+
+class SliceStore:
+    """
+    切片库读取器
+
+    未压缩的库以 mmap 打开每个块，__getitem__ 返回映射上的只读视图，不发生拷贝；
+    压缩库按块解压并保留最近使用的 cache_chunks 个块。
+    可直接作为 paddle.io.Dataset 使用（多进程 DataLoader 中每个进程各自映射）。
+    """
+
+    def __init__(self, store_dir, volumes=None, cache_chunks=16, max_mapped=256):
+        """
+        Args:
+            store_dir (str): 切片库目录
+            volumes (list): 只使用这些体数据（如按体数据划分训练/验证集），None 表示全部
+            cache_chunks (int): 压缩库解压块缓存数
+            max_mapped (int): 未压缩库同时映射的块数（每块两个文件，各占一个文件描述符）
+        """
+        index = _load_index(store_dir)
+        if index is None:
+            raise FileNotFoundError(f"切片库索引不存在: {os.path.join(store_dir, INDEX_NAME)}")
+        self.store_dir = store_dir
+        self.config = index["config"]
+        self.volumes = [name for name in index["volumes"] if volumes is None or name in volumes]
+        self.cache_chunks = cache_chunks if self.config["compress"] else max_mapped
+        self._chunks = OrderedDict()
+
+        chunk_ids, offsets, volume_ids, liver, tumor = [], [], [], [], []
+        self._chunk_files = []
+        for v, name in enumerate(self.volumes):
+            entry = index["volumes"][name]
+            for chunk in entry["chunks"]:
+                chunk_ids.extend([len(self._chunk_files)] * chunk["slices"])
+                offsets.extend(range(chunk["slices"]))
+                self._chunk_files.append(os.path.join(store_dir, name, chunk["file"]))
+            volume_ids.extend([v] * entry["slices"])
+            liver.extend(entry["liver"])
+            tumor.extend(entry["tumor"])
+        self.chunk_ids = np.asarray(chunk_ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.volume_ids = np.asarray(volume_ids, dtype=np.int32)
+        self.has_liver = np.asarray(liver, dtype=bool)
+        self.has_tumor = np.asarray(tumor, dtype=bool)
+        self.spacing = {name: tuple(index["volumes"][name]["spacing"]) for name in self.volumes}
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def _chunk(self, chunk_id):
+        arrays = self._chunks.get(chunk_id)
+        if arrays is not None:
+            self._chunks.move_to_end(chunk_id)
+            return arrays
+        path = self._chunk_files[chunk_id]
+        if self.config["compress"]:
+            with np.load(path) as data:
+                arrays = (data["images"], data["masks"])
+        else:
+            # 映射只占地址空间，物理内存由页缓存管理；但每个映射持有一个文件描述符，按 LRU 关闭
+            arrays = (np.load(path + "_images.npy", mmap_mode="r"), np.load(path + "_masks.npy", mmap_mode="r"))
+        while len(self._chunks) >= self.cache_chunks:
+            self._chunks.popitem(last=False)
+        self._chunks[chunk_id] = arrays
+        return arrays
+
+    def __getitem__(self, i):
+        """
+        Returns:
+            tuple: (uint8 加窗切片 (H, W), uint8 标注 (H, W))
+        """
+        images, masks = self._chunk(int(self.chunk_ids[i]))
+        offset = int(self.offsets[i])
+        return images[offset], masks[offset]
+
+    def indices(self, shuffle=True, seed=None, tumor_ratio=None):
+        """
+        生成一个 epoch 的切片顺序
+
+        Args:
+            shuffle (bool): 打乱顺序；按块打乱后在块内打乱，相邻读取落在同一块上，页缓存命中率高
+            seed (int): 随机种子
+            tumor_ratio (float): 含肿瘤切片的目标比例（对含肿瘤切片重复采样），None 表示不调整
+        """
+        order = np.arange(len(self))
+        if tumor_ratio is not None and self.has_tumor.any():
+            rng = np.random.default_rng(seed)
+            tumor = np.flatnonzero(self.has_tumor)
+            other = len(order) - len(tumor)
+            extra = int(tumor_ratio * other / max(1e-6, 1 - tumor_ratio)) - len(tumor)
+            if extra > 0:
+                order = np.concatenate([order, rng.choice(tumor, extra)])
+        if not shuffle:
+            return order
+        rng = np.random.default_rng(seed)
+        chunk_of = self.chunk_ids[order]
+        chunk_rank = rng.permutation(len(self._chunk_files))
+        return order[np.lexsort((rng.random(len(order)), chunk_rank[chunk_of]))]
+
+    def batch(self, indices, out=None):
+        """
+        读取一批切片并转为 UNet 输入：3 通道 float32 (N, 3, H, W)，按 paddleseg Normalize 归一化到 [-1, 1]
+
+        Args:
+            indices: 切片编号
+            out (tuple): 预分配的 (图像, 标注) 缓冲区，重复使用可避免每批分配
+
+        Returns:
+            tuple: (图像 float32 (N, 3, H, W), 标注 int64 (N, H, W))
+        """
+        size = self.config["size"]
+        if out is None:
+            out = (np.empty((len(indices), 3, size, size), dtype=np.float32),
+                   np.empty((len(indices), size, size), dtype=np.int64))
+        images, masks = out
+        for n, i in enumerate(indices):
+            image, mask = self[i]
+            np.multiply(image, 2.0 / 255.0, out=images[n, 0], casting="unsafe")
+            images[n, 0] -= 1.0
+            images[n, 1] = images[n, 0]
+            images[n, 2] = images[n, 0]
+            masks[n] = mask
+        return images[:len(indices)], masks[:len(indices)]
+
+
+def benchmark_store(store_dir, samples=2000, batch_size=16, seed=0):
+    """随机读取吞吐（切片/秒），用于确认数据加载不再是训练瓶颈"""
+    store = SliceStore(store_dir)
+    order = store.indices(shuffle=True, seed=seed)[:samples]
+    size = store.config["size"]
+    buffers = (np.empty((batch_size, 3, size, size), dtype=np.float32),
+               np.empty((batch_size, size, size), dtype=np.int64))
+    start = time.time()
+    for begin in range(0, len(order), batch_size):
+        store.batch(order[begin:begin + batch_size], buffers)
+    elapsed = time.time() - start
+    return {"slices": len(order), "time": elapsed, "slices_per_sec": len(order) / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiTS 切片库构建与读取测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="构建或增量更新切片库")
+    build_parser.add_argument("--source", required=True, help="LiTS 数据目录")
+    build_parser.add_argument("--out", default="data/lits_slices")
+    build_parser.add_argument("--window", type=float, nargs=2, default=DEFAULT_WINDOW, metavar=("LOW", "HIGH"))
+    build_parser.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    build_parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK)
+    build_parser.add_argument("--compress", action="store_true", help="压缩存储（读取时解压，不能零拷贝）")
+    build_parser.add_argument("--margin", type=int, default=None, help="只保留肝脏上下若干层")
+    build_parser.add_argument("--workers", type=int, default=None)
+    build_parser.add_argument("--force", action="store_true")
+    bench_parser = subparsers.add_parser("bench", help="随机读取吞吐测试")
+    bench_parser.add_argument("--out", default="data/lits_slices")
+    bench_parser.add_argument("--samples", type=int, default=2000)
+    bench_parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        result = build_store(args.source, args.out, tuple(args.window), args.size, args.chunk, args.compress,
+                             args.margin, args.workers, args.force)
+        print(f"构建完成: 新建 {result['built']}, 未变化 {result['skipped']}, 移除 {result['removed']}, "
+              f"失败 {len(result['failed'])}, 耗时 {result['time']:.1f}s")
+        if result["failed"]:
+            raise SystemExit(1)
+    else:
+        result = benchmark_store(args.out, args.samples, args.batch_size)
+        print(f"随机读取 {result['slices']} 层, 耗时 {result['time']:.2f}s, {result['slices_per_sec']:.0f} 层/秒")
+
+
+if __name__ == "__main__":
+    main()
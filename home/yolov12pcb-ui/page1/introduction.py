@@ -1,6 +1,6 @@
 import streamlit as st
 from st_pages import add_page_title, hide_pages
-from PIL import Image
+from assets import show_video
 add_page_title(layout="wide")
 
 hide_pages(["Thank you"])
@@ -25,7 +25,7 @@ st.markdown("肝（liver），人体脏器名，五脏之一。是脊椎动物
 
 st.markdown("---")
 st.markdown("## 2️⃣肝脏的功能🎥")
-st.video("https://www.youtube.com/watch?v=T3YTWpKskRY")
+show_video("https://www.youtube.com/watch?v=T3YTWpKskRY")
 
 st.markdown("""
   * 代谢方面：维生素、激素、抗利尿激素
@@ -42,11 +42,11 @@ st.success("""
 * 所以，肝脏如此重要，我们应该如何在平时生活中保护它呢？
 """)
 st.markdown("####  自检🤏")
-st.video("https://www.youtube.com/watch?v=xZ-oMOXXbQw")
+show_video("https://www.youtube.com/watch?v=xZ-oMOXXbQw")
 st.markdown("####  饮食🍝")
-st.video("https://www.youtube.com/watch?v=X9KXX5lI2CU")
+show_video("https://www.youtube.com/watch?v=X9KXX5lI2CU")
 st.markdown("#### 运动🏃‍♂️")
-st.video("https://www.youtube.com/watch?v=Zj5DQ-t1Ago")
+show_video("https://www.youtube.com/watch?v=Zj5DQ-t1Ago")
 st.markdown("""
 ---
 
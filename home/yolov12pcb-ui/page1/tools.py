@@ -1,6 +1,6 @@
 import streamlit as st
 from st_pages import add_page_title, hide_pages
-from PIL import Image
+from assets import show_image
 add_page_title(layout="wide")
 
 hide_pages(["Thank you"])
@@ -26,8 +26,7 @@ st.markdown("## 1️⃣视觉任务👁️")
 st.markdown("计算机视觉任务通俗来讲就是运用计算机的高性能处理能力来模拟人脑处理图像的过程，我们肉眼看到一只狗，能够识别出来是狗，因为狗有狗的特征，有他的颜色、形状等等特征，通过RGB"
             "三色映射到我们的视觉中，大脑处理让我们分辨出来这是狗。但是一张图片在计算机上的表示就是一堆数据，这些数据也是可以进行学习和处理的，那我们可以假设设计一个“类大脑的处理程序”"
             "输入一张图片（当然，表示起来都是数字），经过这个程序，输出一个辨别的结果，这就是一个简单的分类任务。")
-image = Image.open('page1/image/head.png')
-st.image(image,caption='图片数据', use_column_width=True, output_format='PNG')
+show_image('page1/image/head.png', caption='图片数据', use_column_width=True)
 st.markdown("可以发现上面的一张马赛克黑白图，是可以表示成一堆数据，我们可以用列表、数组、或者矩阵这样的方式来存储它，你是知道的，计算机处理数字的能力是当然强于我们的，所以视觉任务的"
             "核心就落点在设计一个“类大脑的处理程序”")
 
@@ -38,10 +37,8 @@ st.markdown("随着近年来深度学习的高速发展，现在的计算机视
             "由许多“神经元”构成，这些神经元有着自己的功能，能够前向和反向的传播给网络，及时的调整整体的学习信息"
             "我们的任务就是搭建一个合理的神经网络模型，能够根据一些给定的训练数据集，学习数据集的信息特征，将学习到的参数"
             "用于预测中。我们可以从下图大致了解视觉任务和神经网络的关系。")
-image = Image.open('page1/image/deeplearning.png')
-st.image(image,caption='深度学习', use_column_width=True, output_format='PNG')
-image = Image.open('page1/image/relation.png')
-st.image(image,caption='深度学习一般方法', use_column_width=True, output_format='PNG')
+show_image('page1/image/deeplearning.png', caption='深度学习', use_column_width=True)
+show_image('page1/image/relation.png', caption='深度学习一般方法', use_column_width=True)
 st.markdown("---")
 st.markdown("##  2️⃣肝脏肿瘤分割🧮")
 st.success("""
@@ -77,8 +74,7 @@ st.success("""
 * 即训即用，支持端边云多硬件和多操作系统
 * 算法总数超过600个，包含领先的预训练模型
 """)
-image = Image.open('page1/image/paddle.png')
-st.image(image,caption='飞浆组件', use_column_width=True, output_format='PNG')
+show_image('page1/image/paddle.png', caption='飞浆组件', use_column_width=True)
 
 st.markdown("---")
 st.markdown("## 4️⃣骨架网络🦴")
@@ -92,8 +88,7 @@ st.success("""
 st.markdown("UNet由一个编码器和解码器构成，解码器。编码器主要由一组卷积块构成，不断进行下采样以获得丰富的特征信息，下采样过程"
             "中通道数会不断减少，尺寸也变小，但是语义信息逐渐丰富；解码器由一组反卷积构成，上采样过程中恢复图片尺寸，并对"
             "丰富信息进行表征；这个U型的来源是在下采样过程中产生的特征会拼接到上采样中，所以把网络给掰弯了成了个U型")
-image = Image.open('page1/image/UNet.png')
-st.image(image,caption='UNet网络', use_column_width=True, output_format='PNG')
+show_image('page1/image/UNet.png', caption='UNet网络', use_column_width=True)
 
 st.markdown("## 5️⃣后续处理🪚")
 st.markdown("这里只是带大家简单了解一些任务的过程，所以不会详细介绍模型设计、训练和预测等细节。我们在上一节中选好了骨架网络"
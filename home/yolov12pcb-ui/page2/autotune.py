@@ -0,0 +1,329 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from history import model_version
+from warmstart import default_snapshot_dir, host_fingerprint
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 主机画像中的可调参数及未调优时的默认值
+DEFAULTS = {"batch_size": 8, "intra_threads": None, "inter_threads": None, "replicas": 1, "encode_workers": 4,
+            "imgsz": 640}
+BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+
+_threads_applied = False
+
+
+def default_profile_path():
+    return os.environ.get("PCB_HOST_PROFILE") or os.path.join(default_snapshot_dir(), "host_profile.json")
+
+
+def host_key():
+    """主机标识：指令集特征 + CPU 核数 + GPU 型号，同型号机器共用调优结果"""
+    parts = [host_fingerprint(), f"{os.cpu_count()}c"]
+    try:
+        import torch
+        if torch.cuda.is_available():
+            parts.append(torch.cuda.get_device_name(0).replace(" ", "_"))
+    except ImportError:
+        pass
+    return "-".join(parts)
+
+
+def load_host_profile(model_path, path=None):
+    """
+    读取当前主机、当前模型的调优结果
+
+    Returns:
+        dict: 调优参数，画像不存在或不匹配时为 None
+    """
+    path = path or default_profile_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"主机画像读取失败: {str(e)}")
+        return None
+    entry = profile.get(host_key(), {}).get(model_version(model_path))
+    return dict(DEFAULTS, **entry["config"]) if entry else None
+
+
+def save_host_profile(model_path, config, measured=None, path=None):
+    path = path or default_profile_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    profile = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    profile.setdefault(host_key(), {})[model_version(model_path)] = {
+        "config": config, "measured": measured, "created": datetime.now().isoformat(timespec="seconds")}
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def apply_threads(config):
+    """
+    设置计算库线程数（torch 算子内/算子间、OpenCV、OpenMP）
+
+    torch 的算子间线程数每个进程只能设置一次，重复调用时忽略。
+    """
+    global _threads_applied
+    intra, inter = config.get("intra_threads"), config.get("inter_threads")
+    if intra:
+        os.environ["OMP_NUM_THREADS"] = str(intra)
+        import cv2
+        cv2.setNumThreads(intra)
+    try:
+        import torch
+    except ImportError:
+        return
+    if intra:
+        torch.set_num_threads(intra)
+    if inter and not _threads_applied:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError as e:
+            logger.warning(f"算子间线程数未生效: {str(e)}")
+    _threads_applied = True
+
+
+def run_trial(model_path, device, image_paths, config, rounds=3, write=False):
+    """
+    在当前进程中按给定配置测量吞吐与延迟（由 tune 在独立子进程中调用，保证线程设置互不影响）
+
+    replicas 个工作线程各自驱动一个副本，从共享队列中取批次推理；
+    write=True 时改为测量含绘制、编码、写盘的完整批量流程。
+
+    Returns:
+        dict: throughput（张/秒）、p50_ms / p95_ms（每批完成时间，即批内请求的延迟）
+    """
+    apply_threads(config)
+    from inference import PCBInference
+    from pool import ModelPool
+
+    pool = ModelPool(lambda: PCBInference(model_path, device=device, imgsz=config["imgsz"], host_profile=None),
+                     config["replicas"])
+    batch_size = config["batch_size"]
+    images = [pool.preprocess_image(path) for path in image_paths]
+    # 每个副本先跑一批，排除首批开销
+    for replica in pool.replicas:
+        list(replica.detect_batch(images[:batch_size], batch_size))
+
+    if write:
+        output_dir = tempfile.mkdtemp(prefix="autotune_")
+        try:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                pool.predict_batch(image_paths, output_dir, max_workers=config["encode_workers"],
+                                   batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return {"throughput": rounds * len(image_paths) / elapsed}
+
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)] * rounds
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not batches:
+                    return
+                batch = batches.pop()
+            batch_start = time.perf_counter()
+            list(pool.detect_batch(batch, batch_size))
+            with lock:
+                latencies.append((time.perf_counter() - batch_start) * 1000)
+
+    total = sum(len(batch) for batch in batches)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(config["replicas"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {"throughput": total / elapsed, "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95))}
+
+
+def _resolution_trial(model_path, device, image_paths, sizes):
+    from inference import PCBInference
+    from resolution import benchmark_resolutions
+
+    inference = PCBInference(model_path, device=device, imgsz="auto", imgsz_options=sizes, host_profile=None)
+    return {"resolutions": benchmark_resolutions(inference, image_paths, sizes, repeats=1)}
+
+
+def _spawn(task, timeout):
+    """在子进程中执行一次测量，返回结果字典（失败时包含 error）"""
+    command = [sys.executable, os.path.abspath(__file__), "trial", json.dumps(task)]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"error": "超时"}
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "子进程失败"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _thread_candidates(cores):
+    candidates = []
+    n = 1
+    while n < cores:
+        candidates.append(n)
+        n *= 2
+    return candidates + [cores]
+
+
+def tune(model_path, device, image_paths, slo_ms, sizes=(640,), min_recall=0.98, max_replicas=4,
+         batch_sizes=BATCH_SIZES, rounds=3, timeout=600):
+    """
+    分阶段搜索：线程数 -> 推理尺寸 -> 批大小 × 副本数 -> 编码线程数
+
+    每次测量在独立子进程中进行。选择 p95 延迟不超过 slo_ms 的配置中吞吐最高的一个；
+    都超过时选 p95 最低的配置。
+
+    Args:
+        model_path (str): 模型路径
+        device (str): 推理设备
+        image_paths (list): 样本图片
+        slo_ms (float): 单个请求（所在批次完成）的 p95 延迟上限
+        sizes (tuple): 候选推理尺寸，召回（相对最大尺寸）低于 min_recall 的尺寸不参与
+        min_recall (float): 尺寸的最低相对召回
+        max_replicas (int): 最大副本数（受显存限制）
+        batch_sizes (tuple): 候选批大小
+        rounds (int): 每次测量遍历样本的轮数
+        timeout (float): 单次测量超时（秒）
+
+    Returns:
+        dict: config（最优配置）、measured（其测量结果）、trials（全部测量记录）
+    """
+    cores = os.cpu_count() or 1
+    trials = []
+
+    def measure(config, write=False):
+        config = dict(DEFAULTS, **config)
+        result = _spawn({"model": model_path, "device": device, "images": image_paths, "config": config,
+                         "rounds": rounds, "write": write}, timeout)
+        trials.append({"config": config, "write": write, **result})
+        logger.info(f"{config} -> {result}")
+        return result
+
+    # 1. 线程数：单副本、单张推理的延迟
+    best_threads, best_latency = {}, None
+    for intra in _thread_candidates(cores):
+        for inter in (1, 2):
+            result = measure({"intra_threads": intra, "inter_threads": inter, "batch_size": 1,
+                              "imgsz": sizes[0]})
+            if "error" not in result and (best_latency is None or result["p95_ms"] < best_latency):
+                best_threads, best_latency = {"intra_threads": intra, "inter_threads": inter}, result["p95_ms"]
+
+    # 2. 推理尺寸：只保留相对召回达标的尺寸
+    allowed = list(sizes)
+    if len(sizes) > 1:
+        result = _spawn({"kind": "resolution", "model": model_path, "device": device, "images": image_paths,
+                         "sizes": list(sizes)}, timeout)
+        if "error" not in result:
+            allowed = [r["imgsz"] for r in result["resolutions"] if r["recall"] >= min_recall]
+            logger.info(f"召回达标的推理尺寸: {allowed}")
+
+    # 3. 批大小 × 副本数：批越大延迟越高，超过 SLO 后不再增大
+    intra = best_threads.get("intra_threads") or cores
+    replica_options = [r for r in (1, 2, 4, 8) if r <= max_replicas and r * intra <= max(cores, intra)] or [1]
+    candidates = []
+    for imgsz in allowed:
+        for replicas in replica_options:
+            for batch_size in batch_sizes:
+                config = dict(best_threads, imgsz=imgsz, replicas=replicas, batch_size=batch_size)
+                result = measure(config)
+                if "error" in result:
+                    break
+                candidates.append((dict(DEFAULTS, **config), result))
+                if result["p95_ms"] > slo_ms:
+                    break
+    if not candidates:
+        raise RuntimeError("所有配置都测量失败")
+    within = [c for c in candidates if c[1]["p95_ms"] <= slo_ms]
+    if within:
+        config, measured = max(within, key=lambda c: c[1]["throughput"])
+    else:
+        logger.warning(f"没有配置满足 p95 <= {slo_ms}ms, 选择延迟最低的配置")
+        config, measured = min(candidates, key=lambda c: c[1]["p95_ms"])
+
+    # 4. 编码线程数：完整批量流程（绘制、编码、写盘）的吞吐
+    best_write = None
+    for workers in [w for w in (1, 2, 4, 8) if w <= cores]:
+        result = measure(dict(config, encode_workers=workers), write=True)
+        if "error" not in result and (best_write is None or result["throughput"] > best_write[1]):
+            best_write = (workers, result["throughput"])
+    if best_write:
+        config["encode_workers"] = best_write[0]
+        measured = dict(measured, write_throughput=best_write[1])
+    return {"config": config, "measured": measured, "trials": trials}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按主机自动调优批大小、线程数、副本数与推理尺寸")
+    subparsers = parser.add_subparsers(dest="command")
+    trial_parser = subparsers.add_parser("trial", help="（内部）执行一次测量")
+    trial_parser.add_argument("task")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", help="样本图片目录")
+    parser.add_argument("--limit", type=int, default=64, help="最多使用的样本数")
+    parser.add_argument("--slo-ms", type=float, default=200.0, help="p95 延迟上限（毫秒）")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[640])
+    parser.add_argument("--min-recall", type=float, default=0.98)
+    parser.add_argument("--max-replicas", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--profile", default=None, help="主机画像路径，默认 ~/.cache/pcb-inference/host_profile.json")
+    parser.add_argument("--report", default="autotune_report.json")
+    args = parser.parse_args()
+
+    if args.command == "trial":
+        task = json.loads(args.task)
+        if task.get("kind") == "resolution":
+            result = _resolution_trial(task["model"], task["device"], task["images"], tuple(task["sizes"]))
+        else:
+            result = run_trial(task["model"], task["device"], task["images"], task["config"], task["rounds"],
+                               task["write"])
+        print(json.dumps(result))
+        return
+
+    from quantize import list_images
+
+    if not args.images:
+        parser.error("需要 --images")
+    images = list_images(args.images, args.limit)
+    result = tune(args.model, args.device, images, args.slo_ms, tuple(args.sizes), args.min_recall,
+                  args.max_replicas, rounds=args.rounds)
+    path = save_host_profile(args.model, result["config"], result["measured"], args.profile)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"最优配置: {result['config']}")
+    print(f"吞吐 {result['measured']['throughput']:.1f} 张/秒, p95 {result['measured']['p95_ms']:.0f}ms")
+    print(f"主机画像已保存: {path}, 全部测量记录: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
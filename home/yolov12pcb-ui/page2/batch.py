@@ -0,0 +1,166 @@
+import csv
+import functools
+import io
+import json
+import logging
+import os
+import zipfile
+from collections import Counter
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+# 压缩包中单张图片解压后的最大字节数
+MAX_MEMBER_BYTES = 64 * 1024 * 1024
+
+DETECTION_FIELDS = ["image", "class_id", "class_name", "confidence", "x1", "y1", "x2", "y2"]
+
+
+def _image_members(uploaded_files, max_files, max_member_bytes):
+    """
+    逐个列出可检测的图片，不读取内容
+
+    Yields:
+        tuple: (文件名, 读取函数)；读取函数必须在取下一项之前调用，之后压缩包会被关闭
+    """
+    count = 0
+    for uploaded in uploaded_files:
+        name = uploaded.name
+        if name.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(io.BytesIO(uploaded.getvalue())) as archive:
+                    for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                        base = os.path.basename(info.filename)
+                        if info.is_dir() or base.startswith('.') or not base.lower().endswith(IMAGE_EXTENSIONS):
+                            continue
+                        # 按声明的解压后大小过滤，防止压缩炸弹；ZipFile 读取时不会超过声明的大小
+                        if info.file_size > max_member_bytes:
+                            logger.warning(f"压缩包 {name} 中的 {info.filename} 解压后 {info.file_size} 字节，"
+                                           f"超过上限 {max_member_bytes}，已跳过")
+                            continue
+                        # 达到上限后不再列出其余成员
+                        if count >= max_files:
+                            break
+                        count += 1
+                        yield base, functools.partial(archive.read, info)
+            except zipfile.BadZipFile:
+                logger.error(f"无法解析压缩包: {name}")
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            count += 1
+            yield name, uploaded.getvalue
+
+        if count >= max_files:
+            logger.warning(f"图片数量达到上限 {max_files}，其余文件已忽略")
+            return
+
+
+def expand_uploads(uploaded_files, max_files=1000, max_member_bytes=MAX_MEMBER_BYTES):
+    """
+    展开上传文件，zip 压缩包中的图片逐个取出
+
+    按需逐张解压，调用方处理完一张再读取下一张，内存中不会同时保留所有图片。
+
+    Args:
+        uploaded_files (list): st.file_uploader 返回的文件列表
+        max_files (int): 最多处理的图片数量
+        max_member_bytes (int): 压缩包成员解压后的最大字节数，超过的成员跳过
+
+    Yields:
+        tuple: (文件名, 图片字节)，按上传顺序排列
+    """
+    for name, read in _image_members(uploaded_files, max_files, max_member_bytes):
+        try:
+            data = read()
+        except (zipfile.BadZipFile, OSError) as e:
+            logger.error(f"读取 {name} 失败: {str(e)}")
+            continue
+        yield name, data
+
+
+def count_uploads(uploaded_files, max_files=1000, max_member_bytes=MAX_MEMBER_BYTES):
+    """expand_uploads 将产出的图片数量（只读取压缩包目录，不解压），用于显示进度"""
+    return sum(1 for _ in _image_members(uploaded_files, max_files, max_member_bytes))
+
+
+def detection_rows(image_name, detections):
+    """单张图片的检测结果展开为表格行"""
+    names = detections.get("names", {})
+    rows = []
+    for (x1, y1, x2, y2), score, cls in zip(detections["boxes"], detections["scores"], detections["classes"]):
+        rows.append({
+            "image": image_name,
+            "class_id": int(cls),
+            "class_name": names.get(int(cls), str(int(cls))),
+            "confidence": round(float(score), 4),
+            "x1": round(float(x1), 1), "y1": round(float(y1), 1),
+            "x2": round(float(x2), 1), "y2": round(float(y2), 1),
+        })
+    return rows
+
+
+def summarize(items, rows):
+    """
+    汇总批量检测结果
+
+    Args:
+        items (list): 每张图片的条目，含 name/count/error
+        rows (list): 全部检测框表格行
+
+    Returns:
+        dict: 图片数、缺陷板数、失败数以及按类别统计的缺陷表
+    """
+    per_class = Counter(row["class_name"] for row in rows)
+    boards_per_class = Counter()
+    for name, cls in {(row["image"], row["class_name"]) for row in rows}:
+        boards_per_class[cls] += 1
+    return {
+        "images": len(items),
+        "defective": sum(1 for item in items if item.get("count")),
+        "failed": sum(1 for item in items if item.get("error")),
+        "defects": len(rows),
+        "classes": [
+            {"类别": cls, "缺陷数": count, "涉及板数": boards_per_class[cls]}
+            for cls, count in per_class.most_common()
+        ],
+    }
+
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=DETECTION_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def build_archive(items, rows, load_image_bytes):
+    """
+    打包批量检测结果
+
+    Args:
+        items (list): 每张图片的条目，含 name 和 handle
+        rows (list): 全部检测框表格行
+        load_image_bytes (callable): load_image_bytes(handle) -> 标注后的JPEG字节
+
+    Returns:
+        bytes: zip 文件内容，包含标注图片、detections.json 和 detections.csv
+    """
+    buffer = io.BytesIO()
+    used_names = Counter()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for item in items:
+            if not item.get("handle"):
+                continue
+            data = load_image_bytes(item["handle"])
+            if data is None:
+                continue
+            base = os.path.splitext(item["name"])[0]
+            used_names[base] += 1
+            suffix = f"_{used_names[base] - 1}" if used_names[base] > 1 else ""
+            # JPEG 已压缩，不再做 deflate
+            archive.writestr(f"images/detected_{base}{suffix}.jpg", data, compress_type=zipfile.ZIP_STORED)
+        archive.writestr("detections.json", json.dumps(rows, ensure_ascii=False, indent=2))
+        archive.writestr("detections.csv", rows_to_csv(rows))
+    return buffer.getvalue()
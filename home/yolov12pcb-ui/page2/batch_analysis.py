@@ -0,0 +1,306 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import re
+import time
+
+import numpy as np
+import requests
+
+from pipeline import _read_stream, classify_verdict, upload_file
+from render import encode_image
+from similar import crop_defects
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 多板批量分析：把多块板的结构化检测结果（和可选的缺陷裁剪图）合并成一次工作流请求，
+# 工作流输入 boards 为 JSON 字符串，crops 为图片列表，输出文本中包含
+# {"boards": [{"id": ..., "verdict": "defect" | "pass", "analysis": ...}]}
+
+BOARDS_INPUT = "boards"
+CROPS_INPUT = "crops"
+
+
+def board_summary(board_id, detections, image_size=None, max_defects=20):
+    """
+    单块板的紧凑结构化描述（按类别计数 + 置信度最高的若干缺陷框）
+
+    Returns:
+        dict: id、size、counts、defects（[类别, 置信度, x1, y1, x2, y2]）
+    """
+    names = detections.get("names", {})
+    classes = [names.get(int(c), str(int(c))) for c in detections["classes"]]
+    counts = {}
+    for name in classes:
+        counts[name] = counts.get(name, 0) + 1
+    order = np.argsort(-np.asarray(detections["scores"]))[:max_defects]
+    defects = [[classes[i], round(float(detections["scores"][i]), 2)] +
+               [int(round(float(v))) for v in detections["boxes"][i]] for i in order]
+    summary = {"id": str(board_id), "counts": counts, "defects": defects}
+    if image_size is not None:
+        summary["size"] = [int(image_size[0]), int(image_size[1])]
+    if len(detections["boxes"]) > max_defects:
+        summary["truncated"] = len(detections["boxes"]) - max_defects
+    return summary
+
+
+def defect_crops(image, detections, max_crops=3, max_side=160, quality=80):
+    """置信度最高的若干缺陷裁剪图，缩小到 max_side 后编码为 JPEG"""
+    if image is None or not len(detections["boxes"]):
+        return []
+    order = np.argsort(-np.asarray(detections["scores"]))[:max_crops]
+    crops = []
+    for crop in crop_defects(image, np.asarray(detections["boxes"])[order]):
+        scale = max_side / max(crop.shape[:2])
+        if scale < 1:
+            import cv2
+            crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+        crops.append(encode_image(np.ascontiguousarray(crop), "JPEG", quality))
+    return crops
+
+
+def pack_boards(summaries, crops=None, max_boards=10, max_chars=6000, max_upload_bytes=2 * 1024 * 1024):
+    """
+    按预算把板分组：每组的板数、结构化描述长度（近似 token 预算）和上传图片总大小都不超过上限
+
+    单块板超过预算时单独成组。
+
+    Returns:
+        list: 每组板的序号列表
+    """
+    batches, current, chars, size = [], [], 2, 0
+    for i, summary in enumerate(summaries):
+        board_chars = len(json.dumps(summary, ensure_ascii=False)) + 2
+        board_bytes = sum(len(c) for c in crops[i]) if crops else 0
+        if current and (len(current) >= max_boards or chars + board_chars > max_chars or
+                        size + board_bytes > max_upload_bytes):
+            batches.append(current)
+            current, chars, size = [], 2, 0
+        current.append(i)
+        chars += board_chars
+        size += board_bytes
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_verdicts(text, board_ids):
+    """
+    从工作流输出文本中解析每块板的结论
+
+    支持 ```json 代码块、{"boards": [...]} 或直接的列表；结论字段不是 defect/pass 时按关键词归类。
+
+    Returns:
+        dict: {板 id: {"verdict", "analysis"}}，未出现在输出中的板不包含在内
+    """
+    match = re.search(r"```(?:json)?\s*(.*?)```", text, re.S)
+    candidate = match.group(1) if match else text
+    start = min([i for i in (candidate.find("{"), candidate.find("[")) if i >= 0], default=-1)
+    if start < 0:
+        return {}
+    try:
+        parsed, _ = json.JSONDecoder().raw_decode(candidate[start:])
+    except ValueError:
+        return {}
+    items = parsed.get("boards", []) if isinstance(parsed, dict) else parsed
+    wanted = {str(board_id) for board_id in board_ids}
+    verdicts = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict) or str(item.get("id")) not in wanted:
+            continue
+        analysis = str(item.get("analysis", ""))
+        verdict = str(item.get("verdict", "")).lower()
+        if verdict not in ("defect", "pass"):
+            verdict = classify_verdict(f"{item.get('verdict', '')} {analysis}")
+        verdicts[str(item["id"])] = {"verdict": verdict, "analysis": analysis}
+    return verdicts
+
+
+def run_batch_workflow(summaries, crops, dify_api_url, dify_api_key, response_mode="blocking",
+                       user="streamlit_user", session=None):
+    """
+    一次工作流请求分析一组板
+
+    Returns:
+        dict: success、verdicts（按板 id）、raw_text、timings；失败时为 error
+    """
+    http = session or requests
+    timings = {}
+    try:
+        upload_start = time.time()
+        files = []
+        for board_crops in crops:
+            for data in board_crops:
+                file_id = upload_file(http, dify_api_url, dify_api_key, data, "defect_crop.jpg")
+                files.append({"type": "image", "transfer_method": "local_file", "upload_file_id": file_id})
+        timings["upload"] = time.time() - upload_start
+
+        inputs = {BOARDS_INPUT: json.dumps(summaries, ensure_ascii=False)}
+        if files:
+            inputs[CROPS_INPUT] = files
+        workflow_start = time.time()
+        response = http.post(
+            f"{dify_api_url}/workflows/run",
+            json={"inputs": inputs, "response_mode": response_mode, "user": user},
+            headers={"Authorization": f"Bearer {dify_api_key}", "Content-Type": "application/json"},
+            timeout=600,
+            stream=response_mode == "streaming"
+        )
+        if response.status_code != 200:
+            raise Exception(f"工作流执行失败: HTTP {response.status_code}")
+        result = _read_stream(response) if response_mode == "streaming" else response.json()
+        timings["workflow"] = time.time() - workflow_start
+        text = result.get("data", {}).get("outputs", {}).get("text", "")
+        return {"success": True, "verdicts": parse_verdicts(text, [s["id"] for s in summaries]),
+                "raw_text": text, "timings": timings}
+    except Exception as e:
+        return {"success": False, "error": str(e), "timings": timings}
+
+
+def analyze_lot(boards, dify_api_url, dify_api_key, max_boards=10, max_chars=6000,
+                max_upload_bytes=2 * 1024 * 1024, max_concurrency=4, crops_per_board=0, response_mode="blocking",
+                retries=1, progress=None):
+    """
+    批量分析一批板
+
+    按预算分组后并发请求（同时最多 max_concurrency 个请求），请求失败或输出中缺少的板
+    重新分组重试，最多 retries 轮。
+
+    Args:
+        boards (list): 每块板一个字典：id、detections，可选 size (宽, 高) 和 image（用于裁剪缺陷图）
+        dify_api_url (str): Dify API 地址
+        dify_api_key (str): 批量分析工作流的 API Key
+        max_boards (int): 每个请求最多的板数
+        max_chars (int): 每个请求结构化描述的最大字符数
+        max_upload_bytes (int): 每个请求上传图片的总大小上限
+        max_concurrency (int): 并发请求数
+        crops_per_board (int): 每块板附带的缺陷裁剪图数量，0 表示只发送结构化结果
+        response_mode (str): "blocking" 或 "streaming"
+        retries (int): 失败或缺失板的重试轮数
+        progress (callable): progress(已完成板数, 总板数)
+
+    Returns:
+        dict: results（按输入顺序，每块板 id / verdict / analysis / error）、requests、time
+    """
+    start = time.time()
+    summaries, crops = [], []
+    for board in boards:
+        image = board.get("image")
+        summaries.append(board_summary(board["id"], board["detections"], board.get("size")))
+        crops.append(defect_crops(image, board["detections"], crops_per_board) if crops_per_board else [])
+    results = [{"id": s["id"], "verdict": None, "analysis": None, "error": None} for s in summaries]
+    todo = list(range(len(boards)))
+    request_times = []
+    done = 0
+
+    with requests.Session() as session:
+        for attempt in range(retries + 1):
+            if not todo:
+                break
+            batches = [[todo[j] for j in batch] for batch in
+                       pack_boards([summaries[i] for i in todo], [crops[i] for i in todo] if crops_per_board else None,
+                                   max_boards, max_chars, max_upload_bytes)]
+            logger.info(f"第 {attempt + 1} 轮: {len(todo)} 块板, {len(batches)} 个请求")
+            missing = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = {executor.submit(run_batch_workflow, [summaries[i] for i in batch],
+                                           [crops[i] for i in batch], dify_api_url, dify_api_key,
+                                           response_mode, "streamlit_user", session): batch for batch in batches}
+                for future in concurrent.futures.as_completed(futures):
+                    batch = futures[future]
+                    response = future.result()
+                    request_times.append(sum(response["timings"].values()))
+                    for i in batch:
+                        verdict = response.get("verdicts", {}).get(summaries[i]["id"])
+                        if verdict is not None:
+                            results[i].update(verdict, error=None)
+                            done += 1
+                        else:
+                            results[i]["error"] = response.get("error") or "工作流输出中缺少该板的结论"
+                            missing.append(i)
+                    if progress is not None:
+                        progress(done, len(boards))
+            todo = sorted(missing)
+
+    for i in todo:
+        results[i]["verdict"] = "unknown"
+    return {"results": results, "requests": len(request_times), "time": time.time() - start,
+            "mean_request_time": float(np.mean(request_times)) if request_times else 0.0,
+            "failed": len(todo)}
+
+
+def _synthetic_boards(count, seed=0):
+    """模拟检测结果：约一半的板有缺陷"""
+    rng = np.random.default_rng(seed)
+    names = {0: "missing_hole", 1: "mouse_bite", 2: "open_circuit", 3: "short", 4: "spur", 5: "spurious_copper"}
+    boards = []
+    for n in range(count):
+        k = int(rng.integers(0, 4)) if rng.random() < 0.5 else 0
+        boxes = rng.random((k, 4)).astype(np.float32) * 600
+        boxes[:, 2:] = boxes[:, :2] + 20
+        boards.append({"id": f"board_{n:04d}", "detections": {
+            "boxes": boxes, "scores": rng.random(k).astype(np.float32), "classes": rng.integers(0, 6, k),
+            "names": names}})
+    return boards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多板批量 Dify 分析")
+    parser.add_argument("--url", default=None, help="Dify API 地址，不指定时使用本地模拟服务")
+    parser.add_argument("--key", default="mock")
+    parser.add_argument("--images", default=None, help="图片目录（需要 --model），不指定时使用模拟检测结果")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--boards", type=int, default=100, help="模拟检测结果的板数")
+    parser.add_argument("--max-boards", type=int, default=10)
+    parser.add_argument("--max-chars", type=int, default=6000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--crops", type=int, default=0, help="每块板附带的缺陷裁剪图数")
+    parser.add_argument("--workflow-latency", type=float, default=2.0, help="模拟服务的工作流延迟（秒）")
+    parser.add_argument("--output", default="lot_analysis.json")
+    args = parser.parse_args()
+
+    if args.images:
+        from inference import PCBInference
+        from quantize import list_images
+
+        inference = PCBInference(args.model, device=args.device)
+        paths = list_images(args.images)
+        boards = [{"id": paths[i], "image": image, "size": image.size, "detections": detections}
+                  for i, image, detections in inference.detect_batch(paths) if image is not None]
+    else:
+        boards = _synthetic_boards(args.boards)
+
+    server = None
+    url = args.url
+    if url is None:
+        from loadtest import MockDifyServer
+
+        server = MockDifyServer(workflow_latency=args.workflow_latency, latency_sigma=0.1,
+                                per_board_latency=args.workflow_latency * 0.05).start()
+        url = server.url
+    try:
+        report = analyze_lot(boards, url, args.key, args.max_boards, args.max_chars,
+                             max_concurrency=args.concurrency, crops_per_board=args.crops)
+    finally:
+        if server is not None:
+            server.stop()
+
+    verdicts = {}
+    for result in report["results"]:
+        verdicts[result["verdict"]] = verdicts.get(result["verdict"], 0) + 1
+    print(f"{len(boards)} 块板, {report['requests']} 个请求, 耗时 {report['time']:.1f}s, "
+          f"平均每请求 {report['mean_request_time']:.2f}s, 结论: {verdicts}")
+    if server is not None:
+        # 模拟服务下逐板串行请求的预期耗时
+        print(f"逐板串行预计: {len(boards) * (args.workflow_latency * 1.05):.1f}s")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
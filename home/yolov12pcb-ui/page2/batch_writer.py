@@ -0,0 +1,134 @@
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from render import CV2_FORMATS, draw_detections, encode_image, to_rgb_array
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _output_name(index, source, fmt):
+    """输出文件名带输入序号，不同目录下的同名图片不会互相覆盖"""
+    ext = CV2_FORMATS[fmt.upper()][0]
+    if isinstance(source, str):
+        return f"detected_{index:06d}_{os.path.splitext(os.path.basename(source))[0]}{ext}"
+    return f"detected_{index:06d}{ext}"
+
+
+def _manifest(index, source, path, image, detections, size_bytes, encode_time):
+    names = detections.get("names", {})
+    counts = {}
+    for cls in detections["classes"]:
+        name = names.get(int(cls), str(int(cls)))
+        counts[name] = counts.get(name, 0) + 1
+    rows = np.concatenate([detections["boxes"], detections["scores"][:, None],
+                           detections["classes"][:, None].astype(np.float32)], axis=1)
+    return {
+        "index": index,
+        "source": source if isinstance(source, str) else None,
+        "path": path,
+        "width": image.size[0],
+        "height": image.size[1],
+        "num_detections": len(detections["boxes"]),
+        "class_counts": counts,
+        # [x1, y1, x2, y2, 置信度, 类别]
+        "detections": [[round(float(v), 1) for v in row[:4]] + [round(float(row[4]), 4), int(row[5])]
+                       for row in rows],
+        "bytes": size_bytes,
+        "timings": dict(detections.get("timings", {}), encode=encode_time),
+        "error": None,
+    }
+
+
+def drain(batch):
+    """逐项产出批次结果并释放批次对它的引用，已交给调用方的图片不再随批次驻留内存"""
+    batch.reverse()
+    while batch:
+        yield batch.pop()
+
+
+def write_batch(detector, image_list, output_dir="results", show_labels=True, show_conf=True, batch_size=8,
+                encode_workers=2, fmt="JPEG", quality=85, encoder="pil", encode_options=None, max_pending=None,
+                manifest_name="manifest.jsonl", conf_threshold=0.25, iou_threshold=0.45, max_size=1920):
+    """
+    内存有界的批量推理：检测结果直接绘制、编码并写盘，只返回轻量清单
+
+    推理线程按批产出结果，绘制与编码交给独立的编码线程池；在途（已推理未写盘）的
+    图片数量不超过 max_pending 加一个推理批次，内存占用与图片总数无关。
+
+    Args:
+        detector: PCBInference 或 ModelPool（需要 detect_batch）
+        image_list (list): 图片路径或图片对象
+        output_dir (str): 输出目录
+        show_labels (bool): 是否显示标签
+        show_conf (bool): 是否显示置信度
+        batch_size (int): 推理批大小
+        encode_workers (int): 编码线程数
+        fmt (str): 输出格式 JPEG / PNG / WEBP
+        quality (int): JPEG/WEBP 质量
+        encoder (str): "pil" 或 "cv2"
+        encode_options (dict): 额外编码参数，默认 optimize=False
+        max_pending (int): 最多在途图片数，默认 encode_workers 的两倍
+        manifest_name (str): 清单文件名（JSON Lines，按输入顺序），None 表示不写
+        conf_threshold (float): 置信度阈值
+        iou_threshold (float): NMS IoU阈值
+        max_size (int): 图片最大尺寸限制
+
+    Returns:
+        list: 按输入顺序的清单，每项包含输出路径、检测框与计数、耗时；失败项的 error 非空
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    encode_options = dict({"optimize": False} if encoder == "pil" else {}, **(encode_options or {}))
+    max_pending = max_pending or encode_workers * 2
+    slots = threading.BoundedSemaphore(max_pending)
+    manifests = [None] * len(image_list)
+    start = time.time()
+
+    def encode(i, image, detections):
+        encode_start = time.time()
+        path = os.path.join(output_dir, _output_name(i, image_list[i], fmt))
+        try:
+            canvas = to_rgb_array(image)
+            if len(detections["boxes"]) > 0:
+                draw_detections(canvas, detections, show_labels, show_conf)
+            data = encode_image(canvas, fmt, quality, encoder, **encode_options)
+            with open(path, "wb") as f:
+                f.write(data)
+            manifests[i] = _manifest(i, image_list[i], path, image, detections, len(data),
+                                     time.time() - encode_start)
+        except Exception as e:
+            logger.error(f"写入结果 {path} 失败: {str(e)}")
+            manifests[i] = {"index": i, "source": image_list[i] if isinstance(image_list[i], str) else None,
+                            "path": None, "error": str(e)}
+        finally:
+            slots.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix="encoder") as executor:
+        for i, image, detections in detector.detect_batch(image_list, batch_size=batch_size,
+                                                          conf_threshold=conf_threshold,
+                                                          iou_threshold=iou_threshold, max_size=max_size):
+            if image is None:
+                manifests[i] = {"index": i, "source": image_list[i] if isinstance(image_list[i], str) else None,
+                                "path": None, "error": "图片读取失败"}
+                continue
+            # 编码跟不上推理时在这里等待，避免结果在内存中堆积
+            slots.acquire()
+            executor.submit(encode, i, image, detections)
+            if (i + 1) % 500 == 0:
+                logger.info(f"批量推理进度: {i + 1}/{len(image_list)}")
+
+    if manifest_name:
+        with open(os.path.join(output_dir, manifest_name), "w", encoding="utf-8") as f:
+            for manifest in manifests:
+                f.write(json.dumps(manifest, ensure_ascii=False) + "\n")
+
+    failed = sum(1 for m in manifests if m["error"])
+    logger.info(f"批量推理完成: {len(image_list)} 张, 失败 {failed} 张, 耗时: {time.time() - start:.2f}s")
+    return manifests
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from quantize import list_images
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LowResScreener:
+    """
+    低分辨率初筛：用检测模型本身在小尺寸上推理一次，最高置信度作为可疑分数
+
+    不需要额外训练，代价约为全尺寸推理的 (imgsz/640)^2。
+    初筛尺寸必须是推理器预热成功的尺寸（静态形状的引擎只支持导出尺寸），否则改用最小的已预热尺寸。
+    """
+
+    kind = "lowres"
+
+    def __init__(self, inference, imgsz=320, conf_floor=0.01):
+        """
+        Args:
+            inference (PCBInference): 检测推理器（共用已加载的模型）
+            imgsz (int): 初筛推理尺寸
+            conf_floor (float): 初筛时的最低置信度，低于它的候选直接视为 0 分
+        """
+        self.inference = inference
+        self.imgsz = imgsz
+        self.conf_floor = conf_floor
+        self.screen_size = self._validate_size()
+
+    def _validate_size(self):
+        """按推理器的预热结果确定实际初筛尺寸；后台预热中的尺寸先保留，失败后再替换，没有可用尺寸时返回 None"""
+        readiness = self.inference.readiness()
+        if self.imgsz in readiness["warmed"] or self.imgsz in readiness["pending"]:
+            return self.imgsz
+        if not readiness["warmed"]:
+            logger.warning(f"初筛尺寸 {self.imgsz} 未能预热且没有其他已预热的尺寸，暂停初筛，所有图片送完整检测")
+            return None
+        fallback = min(readiness["warmed"])
+        logger.warning(f"初筛尺寸 {self.imgsz} 未能预热（已预热: {readiness['warmed']}），改用 {fallback}；"
+                       f"阈值是在 {self.imgsz} 上标定的，建议重新标定")
+        return fallback
+
+    def score_batch(self, images):
+        """
+        整批在初筛尺寸上调用一次模型
+
+        Returns:
+            np.ndarray: 每张图的最高置信度；初筛停用时全部为 1（都送完整检测）
+        """
+        readiness = self.inference.readiness()
+        if self.screen_size in readiness["failed"] or (self.screen_size is None and readiness["warmed"]):
+            self.screen_size = self._validate_size()
+        if self.screen_size is None:
+            return np.ones(len(images), dtype=np.float32)
+        with self.inference._lock:
+            outputs = self.inference._model_batch(list(images), self.screen_size, self.conf_floor, 0.45)
+        return np.asarray([float(d["scores"].max()) if len(d["scores"]) else 0.0 for d in outputs],
+                          dtype=np.float32)
+
+    def config(self):
+        return {"kind": self.kind, "imgsz": self.screen_size or self.imgsz, "conf_floor": self.conf_floor}
+
+
+class ClassifierScreener:
+    """
+    板级分类器初筛：ultralytics 分类模型（如 yolo11n-cls 微调的 clean/defective 二分类），在 CPU 上运行
+    """
+
+    kind = "classifier"
+
+    def __init__(self, model_path, positive_class="defective", device="cpu", imgsz=224):
+        """
+        Args:
+            model_path (str): 分类模型路径
+            positive_class (str): 表示有缺陷的类别名
+            device (str): 推理设备
+            imgsz (int): 分类输入尺寸
+        """
+        from ultralytics import YOLO
+
+        self.model_path = model_path
+        self.positive_class = positive_class
+        self.device = device
+        self.imgsz = imgsz
+        self.model = YOLO(model_path, task="classify")
+        names = {v: k for k, v in self.model.names.items()}
+        if positive_class not in names:
+            raise ValueError(f"分类模型中没有类别 {positive_class}: {list(names)}")
+        self.positive_index = names[positive_class]
+        self._lock = threading.Lock()
+
+    def score_batch(self, images):
+        with self._lock:
+            results = self.model(list(images), imgsz=self.imgsz, device=self.device, verbose=False)
+        return np.asarray([float(r.probs.data[self.positive_index]) for r in results], dtype=np.float32)
+
+    def config(self):
+        return {"kind": self.kind, "model_path": self.model_path, "positive_class": self.positive_class,
+                "device": self.device, "imgsz": self.imgsz}
+
+
+class Cascade:
+    """
+    两级检测的第一级：可疑分数低于阈值的板直接判为无缺陷，跳过完整检测
+    """
+
+    def __init__(self, screener, threshold=0.05, calibration=None):
+        """
+        Args:
+            screener: LowResScreener 或 ClassifierScreener
+            threshold (float): 可疑阈值，分数不低于该值的板送完整检测
+            calibration (dict): 标定信息（目标召回、验证集上的召回与跳过率）
+        """
+        self.screener = screener
+        self.threshold = threshold
+        self.calibration = calibration or {}
+        self._lock = threading.Lock()
+        self.stats = {"screened": 0, "skipped": 0, "screen_time": 0.0}
+
+    def screen(self, images):
+        """
+        Returns:
+            tuple: (可疑分数数组, 是否需要完整检测的布尔数组)
+        """
+        start = time.time()
+        scores = self.screener.score_batch(images)
+        suspicious = scores >= self.threshold
+        with self._lock:
+            self.stats["screened"] += len(scores)
+            self.stats["skipped"] += int((~suspicious).sum())
+            self.stats["screen_time"] += time.time() - start
+        return scores, suspicious
+
+    def metrics(self):
+        with self._lock:
+            screened = self.stats["screened"]
+            return dict(self.stats, threshold=self.threshold,
+                        skip_rate=self.stats["skipped"] / screened if screened else 0.0,
+                        mean_screen_ms=1000 * self.stats["screen_time"] / screened if screened else 0.0,
+                        calibration=self.calibration)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"screener": self.screener.config(), "threshold": self.threshold,
+                       "calibration": self.calibration}, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path, inference):
+        """从标定文件恢复初筛级，低分辨率初筛共用 inference 的模型"""
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls.from_config(config, inference)
+
+    @classmethod
+    def from_config(cls, config, inference):
+        """
+        从配置恢复初筛级
+
+        Args:
+            config (dict): 含 screener（screener.config() 的结果）、threshold，可选 calibration
+            inference (PCBInference): 低分辨率初筛共用其模型
+        """
+        screener_config = dict(config["screener"])
+        kind = screener_config.pop("kind")
+        if kind == "lowres":
+            screener = LowResScreener(inference, **screener_config)
+        elif kind == "classifier":
+            screener = ClassifierScreener(**screener_config)
+        else:
+            raise ValueError(f"不支持的初筛类型: {kind}")
+        logger.info(f"已加载初筛级: {kind}, 阈值 {config['threshold']:.4f}")
+        return cls(screener, config["threshold"], config.get("calibration"))
+
+
+def calibrate_threshold(scores, labels, target_recall=0.99):
+    """
+    选择满足目标召回的最大阈值
+
+    Args:
+        scores (np.ndarray): 可疑分数
+        labels (np.ndarray): 1 表示有缺陷，0 表示无缺陷
+        target_recall (float): 有缺陷板的目标召回
+
+    Returns:
+        dict: threshold、验证集上的 recall 与 skip_rate（无缺陷板被跳过的比例）
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    labels = np.asarray(labels).astype(bool)
+    positives = np.sort(scores[labels])
+    if positives.size == 0:
+        raise ValueError("标定集中没有有缺陷的样本")
+    # 允许漏掉的有缺陷板数量，阈值取第 missed 小的正样本分数
+    missed = int(np.floor((1.0 - target_recall) * positives.size))
+    threshold = float(positives[missed])
+    recall = float((positives >= threshold).mean())
+    negatives = scores[~labels]
+    return {
+        "threshold": threshold,
+        "target_recall": target_recall,
+        "recall": recall,
+        "clean_skip_rate": float((negatives < threshold).mean()) if negatives.size else 0.0,
+        "skip_rate": float((scores < threshold).mean()),
+        "positives": int(positives.size),
+        "negatives": int(negatives.size),
+    }
+
+
+def labeled_images(image_dir):
+    """按 clean/ 与 defective/ 子目录读取带标签的标定图片"""
+    clean = list_images(os.path.join(image_dir, "clean"))
+    defective = list_images(os.path.join(image_dir, "defective"))
+    return clean + defective, np.array([0] * len(clean) + [1] * len(defective))
+
+
+def pseudo_labels(inference, images, conf_threshold=0.25):
+    """没有人工标签时，以完整检测是否检出缺陷作为标签"""
+    labels = []
+    for path in images:
+        _, detections = inference.detect(path, conf_threshold, screen=False)
+        labels.append(1 if len(detections["boxes"]) else 0)
+    return np.array(labels)
+
+
+def calibrate(screener, images, labels, target_recall=0.99, batch_size=16):
+    """在标定集上打分并选择阈值，返回标定好的 Cascade"""
+    scores = []
+    for start in range(0, len(images), batch_size):
+        batch = []
+        for path in images[start:start + batch_size]:
+            with Image.open(path) as image:
+                batch.append(image.convert("RGB"))
+        scores.append(screener.score_batch(batch))
+    result = calibrate_threshold(np.concatenate(scores), labels, target_recall)
+    result["created"] = datetime.now().isoformat(timespec="seconds")
+    logger.info(f"初筛阈值 {result['threshold']:.4f}: 召回 {result['recall']:.4f}, "
+                f"无缺陷板跳过率 {result['clean_skip_rate']:.2%}")
+    return Cascade(screener, result["threshold"], result)
+
+
+def main():
+    from inference import PCBInference
+    from resolution import DEFAULT_SIZES
+
+    parser = argparse.ArgumentParser(description="两级检测初筛标定")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True, help="标定图片目录（含 clean/ defective/ 子目录，或配合 --pseudo-labels）")
+    parser.add_argument("--pseudo-labels", action="store_true", help="用完整检测结果作为标签")
+    parser.add_argument("--classifier", default=None, help="板级分类模型，默认使用低分辨率检测初筛")
+    parser.add_argument("--imgsz", type=int, default=320, help="低分辨率初筛尺寸")
+    parser.add_argument("--target-recall", type=float, default=0.99)
+    parser.add_argument("--output", default="cascade.json")
+    args = parser.parse_args()
+
+    # 与页面一致使用自适应尺寸，并预热初筛尺寸
+    inference = PCBInference(args.model, device=args.device, imgsz="auto",
+                             imgsz_options=tuple(sorted(set(DEFAULT_SIZES) | {args.imgsz})))
+    if args.pseudo_labels:
+        images = list_images(args.images)
+        labels = pseudo_labels(inference, images)
+    else:
+        images, labels = labeled_images(args.images)
+    screener = ClassifierScreener(args.classifier) if args.classifier else LowResScreener(inference, args.imgsz)
+    cascade = calibrate(screener, images, labels, args.target_recall)
+    cascade.save(args.output)
+    print(json.dumps(cascade.calibration, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
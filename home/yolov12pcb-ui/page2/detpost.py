@@ -0,0 +1,287 @@
+import argparse
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from quantize import letterbox, list_images
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def box_iou(a, b):
+    """两组 xyxy 框的 IoU 矩阵 (len(a), len(b))"""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), dtype=np.float32)
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def _per_class(value, num_classes, default):
+    """阈值参数统一为按类别的数组：标量、{类别: 值} 字典或序列"""
+    if value is None:
+        value = default
+    if isinstance(value, dict):
+        array = np.full(num_classes, default, dtype=np.float32)
+        for cls, v in value.items():
+            if 0 <= int(cls) < num_classes:
+                array[int(cls)] = v
+        return array
+    if np.isscalar(value):
+        return np.full(num_classes, value, dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def nms(boxes, scores, classes, iou_thresholds):
+    """
+    按类别 NMS，每个类别使用自己的 IoU 阈值
+
+    每个类别调用一次 OpenCV 的 C++ 实现，候选框上千时也不会在 Python 中逐框循环。
+
+    Args:
+        boxes (np.ndarray): (N, 4) xyxy
+        scores (np.ndarray): (N,)
+        classes (np.ndarray): (N,) 类别
+        iou_thresholds (np.ndarray): 按类别的 IoU 阈值
+
+    Returns:
+        np.ndarray: 保留框的下标，按分数降序
+    """
+    keep = []
+    for cls in np.unique(classes):
+        idx = np.flatnonzero(classes == cls)
+        xywh = np.concatenate([boxes[idx, :2], boxes[idx, 2:] - boxes[idx, :2]], axis=1)
+        kept = cv2.dnn.NMSBoxes(xywh, scores[idx], 0.0, float(iou_thresholds[cls]))
+        keep.append(idx[np.asarray(kept, dtype=np.int64).reshape(-1)])
+    keep = np.concatenate(keep) if keep else np.zeros((0,), dtype=np.int64)
+    return keep[np.argsort(-scores[keep], kind='stable')]
+
+
+def postprocess(raw, conf_threshold=0.25, iou_threshold=0.45, max_det=300, max_candidates=30000,
+                class_top_k=None, num_classes=None):
+    """
+    直接在 YOLO 原始输出张量上做后处理
+
+    Args:
+        raw (np.ndarray): 单张图的原始输出 (4+nc, N)，前4行为 cx, cy, w, h
+        conf_threshold: 置信度阈值，标量或按类别（dict/序列）
+        iou_threshold: NMS IoU阈值，标量或按类别
+        max_det (int): 最多保留的检测数
+        max_candidates (int): 进入 NMS 的最多候选框数
+        class_top_k: 每个类别最多保留的检测数，标量或按类别，None 表示不限制
+        num_classes (int): 类别数，默认由张量推断
+
+    Returns:
+        tuple: (boxes (M,4) xyxy, scores (M,), classes (M,))，坐标在网络输入空间
+    """
+    raw = np.asarray(raw, dtype=np.float32)
+    num_classes = num_classes or raw.shape[0] - 4
+    conf = _per_class(conf_threshold, num_classes, 0.25)
+    iou = _per_class(iou_threshold, num_classes, 0.45)
+
+    # 1. 向量化预过滤：任一类别分数都达不到最低阈值的候选直接丢弃
+    class_scores = raw[4:4 + num_classes]
+    best = class_scores.max(axis=0)
+    candidates = np.flatnonzero(best > conf.min())
+    if candidates.size == 0:
+        return _empty()
+    classes = class_scores[:, candidates].argmax(axis=0)
+    scores = best[candidates]
+    passed = scores > conf[classes]
+    candidates, classes, scores = candidates[passed], classes[passed], scores[passed]
+    if candidates.size == 0:
+        return _empty()
+
+    # 2. 候选数上限
+    if candidates.size > max_candidates:
+        top = np.argpartition(-scores, max_candidates)[:max_candidates]
+        candidates, classes, scores = candidates[top], classes[top], scores[top]
+
+    cx, cy, w, h = raw[:4, candidates]
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+    # 3. 按类别 NMS
+    keep = nms(boxes, scores, classes, iou)
+    boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+    # 4. 每类 top-K 与总数上限（keep 已按分数降序）
+    if class_top_k is not None:
+        caps = _per_class(class_top_k, num_classes, np.inf)
+        rank = np.zeros(len(classes), dtype=np.int64)
+        for cls in np.unique(classes):
+            idx = np.flatnonzero(classes == cls)
+            rank[idx] = np.arange(idx.size)
+        within = rank < caps[classes]
+        boxes, scores, classes = boxes[within], scores[within], classes[within]
+
+    return boxes[:max_det], scores[:max_det], classes[:max_det].astype(np.int32)
+
+
+def _empty():
+    return np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.int32)
+
+
+def scale_boxes(boxes, image_size, imgsz):
+    """把网络输入空间（letterbox）的坐标映射回原图"""
+    width, height = image_size
+    ratio = min(imgsz / height, imgsz / width)
+    pad_x = (imgsz - round(width * ratio)) // 2
+    pad_y = (imgsz - round(height * ratio)) // 2
+    boxes = (boxes - np.array([pad_x, pad_y, pad_x, pad_y], dtype=np.float32)) / ratio
+    return np.clip(boxes, 0, [width, height, width, height]).astype(np.float32)
+
+
+class FastPostprocessor:
+    """
+    快速推理路径
+
+    只借用 ultralytics 的推理后端执行网络前向，预处理与后处理在 numpy 上完成，
+    跳过 ultralytics 的 Results 对象构造。
+    """
+
+    def __init__(self, yolo, device, imgsz=640):
+        self.yolo = yolo
+        self.device = device
+        self.imgsz = imgsz
+        # 推理后端是否支持多图批次，首次批量前向时探测
+        self._batched = None
+
+    def _backend(self):
+        predictor = getattr(self.yolo, "predictor", None)
+        if predictor is None or predictor.model is None:
+            # 首次调用时 ultralytics 才会创建推理后端
+            self.yolo(np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8), device=self.device, verbose=False)
+            predictor = self.yolo.predictor
+        return predictor.model, predictor.device
+
+    def forward(self, image, imgsz=None):
+        """网络前向，返回原始输出 (4+nc, N)"""
+        import torch
+
+        backend, device = self._backend()
+        tensor = torch.from_numpy(letterbox(image, imgsz or self.imgsz)).to(device)
+        if getattr(backend, "fp16", False):
+            tensor = tensor.half()
+        with torch.inference_mode():
+            output = backend(tensor)
+        if isinstance(output, (list, tuple)):
+            output = output[0]
+        return output[0].float().cpu().numpy()
+
+    def forward_batch(self, images, imgsz=None):
+        """
+        一个批次一次网络前向，返回每张图的原始输出
+
+        静态批大小的引擎不支持多图批次时退回逐张前向（只探测一次）。
+        """
+        import torch
+
+        imgsz = imgsz or self.imgsz
+        if len(images) == 1 or self._batched is False:
+            return [self.forward(image, imgsz) for image in images]
+        backend, device = self._backend()
+        tensor = torch.from_numpy(np.concatenate([letterbox(image, imgsz) for image in images])).to(device)
+        if getattr(backend, "fp16", False):
+            tensor = tensor.half()
+        try:
+            with torch.inference_mode():
+                output = backend(tensor)
+        except Exception as e:
+            if self._batched:
+                raise
+            self._batched = False
+            logger.warning(f"推理后端不支持批量前向，改为逐张前向: {str(e)}")
+            return [self.forward(image, imgsz) for image in images]
+        self._batched = True
+        if isinstance(output, (list, tuple)):
+            output = output[0]
+        return list(output.float().cpu().numpy())
+
+    def __call__(self, image, conf_threshold=0.25, iou_threshold=0.45, max_det=300, class_top_k=None,
+                 imgsz=None):
+        """
+        Returns:
+            tuple: (boxes, scores, classes)，坐标在原图空间
+        """
+        imgsz = imgsz or self.imgsz
+        return self.decode(self.forward(image, imgsz), image, conf_threshold, iou_threshold, max_det,
+                           class_top_k, imgsz)
+
+    def decode(self, raw, image, conf_threshold=0.25, iou_threshold=0.45, max_det=300, class_top_k=None,
+               imgsz=None):
+        """原始输出 -> 原图空间的 (boxes, scores, classes)，不涉及模型调用"""
+        imgsz = imgsz or self.imgsz
+        boxes, scores, classes = postprocess(raw, conf_threshold, iou_threshold, max_det,
+                                             class_top_k=class_top_k)
+        if len(boxes):
+            boxes = scale_boxes(boxes, image.size, imgsz)
+        return boxes, scores, classes
+
+
+def compare_paths(model_path, images, device="0", conf_threshold=0.25, iou_threshold=0.45, match_iou=0.9):
+    """
+    等价性检查：同一批图片分别走 ultralytics 路径和快速路径，逐框比对
+
+    Returns:
+        dict: 图片数、两条路径的检测总数、未匹配数、最大坐标/分数偏差与耗时
+    """
+    from inference import PCBInference
+
+    reference = PCBInference(model_path, device=device, postprocess="ultralytics")
+    fast = PCBInference(model_path, device=device, postprocess="fast")
+    report = {"images": 0, "reference": 0, "fast": 0, "unmatched": 0,
+              "max_box_error": 0.0, "max_score_error": 0.0, "reference_time": 0.0, "fast_time": 0.0}
+
+    for image in images:
+        ref_start = time.time()
+        _, ref = reference.detect(image, conf_threshold, iou_threshold)
+        fast_start = time.time()
+        _, out = fast.detect(image, conf_threshold, iou_threshold)
+        report["reference_time"] += fast_start - ref_start
+        report["fast_time"] += time.time() - fast_start
+        report["images"] += 1
+        report["reference"] += len(ref["boxes"])
+        report["fast"] += len(out["boxes"])
+
+        iou = box_iou(ref["boxes"], out["boxes"])
+        iou = np.where(ref["classes"][:, None] == out["classes"][None, :], iou, 0.0)
+        if iou.size:
+            best = iou.argmax(axis=1)
+            matched = iou[np.arange(len(best)), best] >= match_iou
+            report["unmatched"] += int((~matched).sum()) + max(0, len(out["boxes"]) - int(matched.sum()))
+            if matched.any():
+                pairs = (np.flatnonzero(matched), best[matched])
+                report["max_box_error"] = max(report["max_box_error"], float(
+                    np.abs(ref["boxes"][pairs[0]] - out["boxes"][pairs[1]]).max()))
+                report["max_score_error"] = max(report["max_score_error"], float(
+                    np.abs(ref["scores"][pairs[0]] - out["scores"][pairs[1]]).max()))
+        else:
+            report["unmatched"] += len(ref["boxes"]) + len(out["boxes"])
+
+    report["equivalent"] = report["unmatched"] == 0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="快速后处理与 ultralytics 后处理等价性检查")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True, help="测试图片目录")
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    report = compare_paths(args.model, list_images(args.images, args.limit), device=args.device)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if not report["equivalent"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
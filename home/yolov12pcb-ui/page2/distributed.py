@@ -0,0 +1,525 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from batch_writer import _manifest, write_batch
+from quantize import list_images
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 分片分布式批量检测。作业目录（多机时放在共享存储上）结构：
+#   job.json        作业配置（模型、分片大小、租约时长、输出选项）
+#   images.txt      图片清单（相对 image_root 的路径，每行一个）
+#   queue.db        分片租约队列（SQLite）
+#   results/        每个分片一个 shard_XXXXX.jsonl，按清单顺序
+#   images/         可选的检测结果图，每个分片一个子目录
+#   merged.jsonl    合并后的结果，summary.json 为汇总
+# 分片结果只由清单和模型决定，先写临时文件再原子替换，重复处理同一分片结果相同，
+# 崩溃后重新启动 worker 即可续跑；租约过期未完成的分片会被其他 worker 重新领取。
+
+JOB_FILE = "job.json"
+IMAGES_FILE = "images.txt"
+QUEUE_FILE = "queue.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    start INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    token TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    images INTEGER,
+    failed INTEGER,
+    elapsed REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS idx_shards_status ON shards(status, id);
+"""
+
+
+def shard_name(shard_id):
+    return f"shard_{shard_id:05d}"
+
+
+def load_job(job_dir):
+    with open(os.path.join(job_dir, JOB_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_images(job_dir):
+    with open(os.path.join(job_dir, IMAGES_FILE), "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+class LeaseQueue:
+    """
+    SQLite 分片租约队列
+
+    worker 领取分片时获得带期限的租约并定期续租；租约过期的分片可被其他 worker 重新领取，
+    累计尝试 max_attempts 次仍未完成的分片标记为 failed。
+    共享存储（NFS 等）不支持 WAL，这里使用默认的回滚日志，并用 BEGIN IMMEDIATE 保证领取的原子性。
+    """
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        """
+        Args:
+            db_path (str): 队列数据库路径
+            lease_seconds (float): 租约时长（秒），应明显大于一个分片的处理时间或续租间隔
+            max_attempts (int): 每个分片的最多尝试次数
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def populate(self, total, shard_size):
+        """按清单长度建立分片，已建立时不重复"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0] == 0:
+                conn.executemany("INSERT INTO shards (id, start, count, updated) VALUES (?, ?, ?, ?)",
+                                 [(n, start, min(shard_size, total - start), time.time())
+                                  for n, start in enumerate(range(0, total, shard_size))])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def lease(self, worker):
+        """
+        领取一个待处理或租约已过期的分片
+
+        Returns:
+            dict: id、start、count、token、attempts，没有可领取的分片时为 None
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE shards SET status = 'failed', error = COALESCE(error, '租约多次过期'), updated = ? "
+                         "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                         (now, now, self.max_attempts))
+            row = conn.execute("SELECT * FROM shards WHERE status = 'pending' OR "
+                               "(status = 'leased' AND lease_until < ?) ORDER BY attempts, id LIMIT 1",
+                               (now,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["status"] == "leased":
+                logger.warning(f"分片 {row['id']} 的租约已过期（{row['worker']}），重新领取")
+            token = uuid.uuid4().hex
+            conn.execute("UPDATE shards SET status = 'leased', worker = ?, token = ?, lease_until = ?, "
+                         "attempts = attempts + 1, updated = ? WHERE id = ?",
+                         (worker, token, now + self.lease_seconds, now, row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return {"id": row["id"], "start": row["start"], "count": row["count"], "token": token,
+                "attempts": row["attempts"] + 1}
+
+    def renew(self, shard_id, token):
+        """续租，租约已被他人领取时返回 False"""
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE shards SET lease_until = ?, updated = ? "
+                                  "WHERE id = ? AND token = ? AND status = 'leased'",
+                                  (time.time() + self.lease_seconds, time.time(), shard_id, token))
+            return cursor.rowcount == 1
+
+    def complete(self, shard_id, images, failed, elapsed):
+        """
+        标记分片完成
+
+        分片结果文件已原子写入，不论租约是否仍属于当前 worker 都可以标记完成（重复标记无副作用）。
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE shards SET status = 'done', lease_until = NULL, error = NULL, images = ?, "
+                         "failed = ?, elapsed = ?, updated = ? WHERE id = ? AND status != 'done'",
+                         (images, failed, elapsed, time.time(), shard_id))
+
+    def fail(self, shard_id, token, error):
+        """处理失败：未达到最多尝试次数时放回队列"""
+        with self._connect() as conn:
+            conn.execute("UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "lease_until = NULL, error = ?, updated = ? WHERE id = ? AND token = ? AND status = 'leased'",
+                         (self.max_attempts, error, time.time(), shard_id, token))
+
+    def retry_failed(self):
+        """失败的分片重新排队，返回数量"""
+        with self._connect() as conn:
+            return conn.execute("UPDATE shards SET status = 'pending', attempts = 0, error = NULL, updated = ? "
+                                "WHERE status = 'failed'", (time.time(),)).rowcount
+
+    def shards(self):
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute("SELECT * FROM shards ORDER BY id")]
+
+    def status(self):
+        """
+        Returns:
+            dict: 各状态的分片数、已完成图片数、活跃 worker，以及 finished（没有待处理和处理中的分片）
+        """
+        now = time.time()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        done_images, workers = 0, set()
+        for shard in self.shards():
+            status = shard["status"]
+            if status == "leased" and shard["lease_until"] < now:
+                status = "pending"
+            counts[status] += 1
+            if status == "done":
+                done_images += shard["images"] or 0
+            elif status == "leased":
+                workers.add(shard["worker"])
+        return dict(counts, shards=sum(counts.values()), images_done=done_images, workers=sorted(workers),
+                    finished=counts["pending"] == 0 and counts["leased"] == 0)
+
+
+def init_job(job_dir, images, model_path, image_root=None, shard_size=500, lease_seconds=600, max_attempts=3,
+             render=False, fmt="JPEG", quality=85, conf_threshold=0.25, iou_threshold=0.45):
+    """
+    创建分片作业（协调端）
+
+    同一作业目录用相同的清单重复初始化时直接返回已有作业，清单不同时报错。
+
+    Args:
+        job_dir (str): 作业目录
+        images (list): 图片路径列表
+        model_path (str): 模型路径（worker 可用 --model 覆盖为本机路径）
+        image_root (str): 图片根目录，清单中记录相对路径；worker 可用 --image-root 覆盖
+        shard_size (int): 每个分片的图片数
+        lease_seconds (float): 租约时长（秒）
+        max_attempts (int): 每个分片的最多尝试次数
+        render (bool): 是否同时输出检测结果图
+        fmt (str): 结果图格式
+        quality (int): 结果图质量
+        conf_threshold (float): 置信度阈值
+        iou_threshold (float): NMS IoU阈值
+
+    Returns:
+        dict: 作业配置
+    """
+    image_root = os.path.abspath(image_root or os.path.commonpath([os.path.abspath(p) for p in images]))
+    if os.path.isfile(image_root):
+        image_root = os.path.dirname(image_root)
+    relative = [os.path.relpath(os.path.abspath(p), image_root) for p in images]
+    digest = hashlib.sha256("\n".join(relative).encode("utf-8")).hexdigest()[:16]
+
+    job_path = os.path.join(job_dir, JOB_FILE)
+    if os.path.exists(job_path):
+        job = load_job(job_dir)
+        if job["manifest_digest"] != digest:
+            raise ValueError(f"作业目录 {job_dir} 已存在不同清单的作业")
+        logger.info(f"作业已存在，继续使用: {job_dir}")
+        return job
+
+    os.makedirs(os.path.join(job_dir, "results"), exist_ok=True)
+    with open(os.path.join(job_dir, IMAGES_FILE), "w", encoding="utf-8") as f:
+        f.writelines(path + "\n" for path in relative)
+    job = {"model": model_path, "image_root": image_root, "images": len(relative), "manifest_digest": digest,
+           "shard_size": shard_size, "lease_seconds": lease_seconds, "max_attempts": max_attempts,
+           "render": render, "fmt": fmt, "quality": quality, "conf_threshold": conf_threshold,
+           "iou_threshold": iou_threshold, "created": time.time()}
+    LeaseQueue(os.path.join(job_dir, QUEUE_FILE), lease_seconds, max_attempts).populate(len(relative), shard_size)
+    # job.json 最后写入，作为作业初始化完成的标志
+    with open(job_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False, indent=2)
+    os.replace(job_path + ".tmp", job_path)
+    logger.info(f"作业已创建: {len(relative)} 张图片, {(len(relative) + shard_size - 1) // shard_size} 个分片")
+    return job
+
+
+class ShardWorker:
+    """
+    分片 worker：循环领取分片、推理并写出分片结果，直到队列为空
+
+    模型在领取到第一个分片时才加载，空闲 worker 不占用显存。
+    """
+
+    def __init__(self, job_dir, model_path=None, device="0", image_root=None, worker_id=None, batch_size=None,
+                 **inference_kwargs):
+        """
+        Args:
+            job_dir (str): 作业目录
+            model_path (str): 覆盖作业中的模型路径
+            device (str): 推理设备
+            image_root (str): 覆盖作业中的图片根目录（本机挂载路径不同时）
+            worker_id (str): worker 标识，默认 主机名-进程号
+            batch_size (int): 推理批大小，None 表示使用主机画像中的设置
+            **inference_kwargs: 传给 PCBInference 的其他参数
+        """
+        self.job_dir = job_dir
+        self.job = load_job(job_dir)
+        self.model_path = model_path or self.job["model"]
+        self.device = device
+        self.image_root = image_root or self.job["image_root"]
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.inference_kwargs = inference_kwargs
+        self.queue = LeaseQueue(os.path.join(job_dir, QUEUE_FILE), self.job["lease_seconds"],
+                                self.job["max_attempts"])
+        self.images = load_images(job_dir)
+        self.inference = None
+        self.stats = {"shards": 0, "images": 0, "failed": 0, "skipped": 0, "errors": 0}
+
+    def _load_model(self):
+        if self.inference is None:
+            from inference import PCBInference
+
+            self.inference = PCBInference(self.model_path, device=self.device, **self.inference_kwargs)
+        return self.inference
+
+    def _result_path(self, shard_id):
+        return os.path.join(self.job_dir, "results", f"{shard_name(shard_id)}.jsonl")
+
+    def _existing_result(self, shard):
+        """分片结果已完整写出（上次崩溃在标记完成之前）时返回失败数，否则返回 None"""
+        path = self._result_path(shard["id"])
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        if len(rows) != shard["count"]:
+            return None
+        return sum(1 for row in rows if row["error"])
+
+    def process(self, shard):
+        """
+        处理一个分片，结果按清单顺序写入 results/shard_XXXXX.jsonl
+
+        Returns:
+            int: 失败的图片数
+        """
+        inference = self._load_model()
+        sources = self.images[shard["start"]:shard["start"] + shard["count"]]
+        paths = [os.path.join(self.image_root, source) for source in sources]
+        batch_size = self.batch_size or inference.batch_size
+        options = {"conf_threshold": self.job["conf_threshold"], "iou_threshold": self.job["iou_threshold"]}
+        if self.job["render"]:
+            rows = write_batch(inference, paths, os.path.join(self.job_dir, "images", shard_name(shard["id"])),
+                               batch_size=batch_size, encode_workers=inference.encode_workers, fmt=self.job["fmt"],
+                               quality=self.job["quality"], manifest_name=None, **options)
+        else:
+            rows = [None] * len(paths)
+            for i, image, detections in inference.detect_batch(paths, batch_size=batch_size, **options):
+                rows[i] = (_manifest(i, paths[i], None, image, detections, 0, 0.0) if image is not None else
+                           {"index": i, "path": None, "error": "图片读取失败"})
+        for i, row in enumerate(rows):
+            row["index"] = shard["start"] + i
+            row["source"] = sources[i]
+
+        path = self._result_path(shard["id"])
+        temp_path = f"{path}.{self.worker_id}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(temp_path, path)
+        return sum(1 for row in rows if row["error"])
+
+    def _heartbeat(self, shard, stop, lost):
+        while not stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(shard["id"], shard["token"]):
+                lost.set()
+                logger.warning(f"分片 {shard['id']} 的租约已失效，结果仍会写出（与重新处理的结果相同）")
+                return
+
+    def run(self, max_shards=None, wait=False, poll=10.0):
+        """
+        领取并处理分片
+
+        Args:
+            max_shards (int): 最多处理的分片数，None 表示直到队列为空
+            wait (bool): 队列为空但仍有处理中的分片时继续等待（以便接手租约过期的分片）
+            poll (float): 等待时的轮询间隔（秒）
+
+        Returns:
+            dict: 本 worker 处理的分片数、图片数、失败图片数、跳过（已有结果）的分片数、出错分片数
+        """
+        while max_shards is None or self.stats["shards"] < max_shards:
+            shard = self.queue.lease(self.worker_id)
+            if shard is None:
+                if wait and not self.queue.status()["finished"]:
+                    time.sleep(poll)
+                    continue
+                break
+            start = time.time()
+            failed = self._existing_result(shard)
+            if failed is not None:
+                self.stats["skipped"] += 1
+                logger.info(f"分片 {shard['id']} 已有完整结果，直接标记完成")
+            else:
+                stop, lost = threading.Event(), threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(shard, stop, lost), daemon=True)
+                heartbeat.start()
+                try:
+                    failed = self.process(shard)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"分片 {shard['id']} 处理失败（第 {shard['attempts']} 次）: {str(e)}")
+                    self.queue.fail(shard["id"], shard["token"], str(e))
+                    continue
+                finally:
+                    stop.set()
+                    heartbeat.join()
+            self.queue.complete(shard["id"], shard["count"], failed, time.time() - start)
+            self.stats["shards"] += 1
+            self.stats["images"] += shard["count"]
+            self.stats["failed"] += failed
+            logger.info(f"[{self.worker_id}] 分片 {shard['id']} 完成: {shard['count']} 张, 失败 {failed} 张, "
+                        f"耗时 {time.time() - start:.1f}s")
+        return dict(self.stats)
+
+
+def merge_results(job_dir, allow_partial=False):
+    """
+    合并分片结果为 merged.jsonl（按清单顺序）并生成 summary.json
+
+    Args:
+        job_dir (str): 作业目录
+        allow_partial (bool): 存在未完成的分片时是否仍然合并（缺失的图片不写入）
+
+    Returns:
+        dict: 汇总（图片数、失败数、有缺陷的图片数、各类别缺陷数、缺失分片）
+    """
+    job = load_job(job_dir)
+    queue = LeaseQueue(os.path.join(job_dir, QUEUE_FILE), job["lease_seconds"], job["max_attempts"])
+    shards = queue.shards()
+    missing = [shard["id"] for shard in shards
+               if not os.path.exists(os.path.join(job_dir, "results", f"{shard_name(shard['id'])}.jsonl"))]
+    if missing and not allow_partial:
+        raise RuntimeError(f"{len(missing)} 个分片尚未完成: {missing[:10]}")
+
+    summary = {"images": 0, "failed": 0, "defective": 0, "detections": 0, "class_counts": {},
+               "shards": len(shards), "missing_shards": missing}
+    merged_path = os.path.join(job_dir, "merged.jsonl")
+    with open(merged_path + ".tmp", "w", encoding="utf-8") as out:
+        for shard in shards:
+            if shard["id"] in missing:
+                continue
+            with open(os.path.join(job_dir, "results", f"{shard_name(shard['id'])}.jsonl"), "r",
+                      encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    summary["images"] += 1
+                    if row["error"]:
+                        summary["failed"] += 1
+                    elif row["num_detections"]:
+                        summary["defective"] += 1
+                        summary["detections"] += row["num_detections"]
+                        for name, count in row["class_counts"].items():
+                            summary["class_counts"][name] = summary["class_counts"].get(name, 0) + count
+                    out.write(line)
+    os.replace(merged_path + ".tmp", merged_path)
+    summary["elapsed"] = sum(shard["elapsed"] or 0.0 for shard in shards)
+    with open(os.path.join(job_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    logger.info(f"合并完成: {summary['images']} 张, 有缺陷 {summary['defective']} 张, 失败 {summary['failed']} 张")
+    return summary
+
+
+def run_local(job_dir, devices=("0",), workers_per_device=1, extra_args=()):
+    """在本机按设备启动多个 worker 进程，全部结束后合并结果"""
+    slots = [device for device in devices for _ in range(workers_per_device)]
+    commands = [[sys.executable, os.path.abspath(__file__), "work", job_dir, "--device", device,
+                 "--worker-id", f"{socket.gethostname()}-{n}-{device}", *extra_args]
+                for n, device in enumerate(slots)]
+    processes = [subprocess.Popen(command) for command in commands]
+    codes = [process.wait() for process in processes]
+    if any(codes):
+        logger.warning(f"有 worker 异常退出: {codes}")
+    return merge_results(job_dir, allow_partial=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片分布式批量检测")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    init = sub.add_parser("init", help="创建作业（协调端）")
+    init.add_argument("job_dir")
+    init.add_argument("--images", required=True, help="图片目录，或每行一个路径的清单文件")
+    init.add_argument("--image-root", default=None, help="图片根目录，默认取所有图片的公共目录")
+    init.add_argument("--model", default="best.engine")
+    init.add_argument("--shard-size", type=int, default=500)
+    init.add_argument("--lease-seconds", type=float, default=600)
+    init.add_argument("--max-attempts", type=int, default=3)
+    init.add_argument("--render", action="store_true", help="同时输出检测结果图")
+    init.add_argument("--fmt", default="JPEG")
+    init.add_argument("--quality", type=int, default=85)
+    init.add_argument("--conf", type=float, default=0.25)
+    init.add_argument("--iou", type=float, default=0.45)
+
+    work = sub.add_parser("work", help="启动 worker")
+    work.add_argument("job_dir")
+    work.add_argument("--model", default=None, help="本机模型路径，默认使用作业中的路径")
+    work.add_argument("--image-root", default=None, help="本机图片根目录，默认使用作业中的路径")
+    work.add_argument("--device", default="0")
+    work.add_argument("--worker-id", default=None)
+    work.add_argument("--batch-size", type=int, default=None)
+    work.add_argument("--max-shards", type=int, default=None)
+    work.add_argument("--wait", action="store_true", help="队列为空时等待其他 worker 的租约过期")
+
+    run = sub.add_parser("run", help="本机多进程运行并合并")
+    run.add_argument("job_dir")
+    run.add_argument("--devices", default="0", help="逗号分隔的设备列表")
+    run.add_argument("--workers-per-device", type=int, default=1)
+
+    for name, help_text in (("status", "查看进度"), ("retry", "失败分片重新排队"), ("merge", "合并结果")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument("job_dir")
+        if name == "merge":
+            command.add_argument("--allow-partial", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        if os.path.isdir(args.images):
+            images = list_images(args.images)
+        else:
+            with open(args.images, "r", encoding="utf-8") as f:
+                images = [line.strip() for line in f if line.strip()]
+        init_job(args.job_dir, images, args.model, args.image_root, args.shard_size, args.lease_seconds,
+                 args.max_attempts, args.render, args.fmt, args.quality, args.conf, args.iou)
+    elif args.command == "work":
+        stats = ShardWorker(args.job_dir, args.model, args.device, args.image_root, args.worker_id,
+                            args.batch_size).run(args.max_shards, args.wait)
+        print(json.dumps(stats, ensure_ascii=False))
+    elif args.command == "run":
+        summary = run_local(args.job_dir, args.devices.split(","), args.workers_per_device)
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    elif args.command == "merge":
+        print(json.dumps(merge_results(args.job_dir, args.allow_partial), ensure_ascii=False, indent=2))
+    else:
+        job = load_job(args.job_dir)
+        queue = LeaseQueue(os.path.join(args.job_dir, QUEUE_FILE), job["lease_seconds"], job["max_attempts"])
+        if args.command == "retry":
+            print(f"已重新排队 {queue.retry_failed()} 个分片")
+        print(json.dumps(queue.status(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 配准在缩小后的灰度图上进行，最长边像素数
+REGISTER_SIZE = 1024
+
+
+def to_gray(image):
+    """PIL.Image 或 RGB 数组转灰度数组"""
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert('L'))
+    image = np.asarray(image)
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def _downscale(gray, max_side=REGISTER_SIZE):
+    scale = min(1.0, max_side / max(gray.shape[:2]))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)),
+                          interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+class ReferenceBoard:
+    """
+    参考板（金板）
+
+    保存参考图以及预先计算好的 ORB 特征，同一板型的所有检测共用。
+    """
+
+    def __init__(self, board_type, image, n_features=4000):
+        self.board_type = board_type
+        self.image = np.asarray(image.convert('RGB') if isinstance(image, Image.Image) else image)
+        self.gray = to_gray(self.image)
+        self.small, self.scale = _downscale(self.gray)
+        self.orb = cv2.ORB_create(nfeatures=n_features)
+        self.keypoints, self.descriptors = self.orb.detectAndCompute(self.small, None)
+        logger.info(f"参考板 {board_type} 特征提取完成: {len(self.keypoints)} 个特征点")
+
+    @property
+    def size(self):
+        return self.image.shape[1], self.image.shape[0]
+
+
+class ReferenceLibrary:
+    """
+    参考板库
+
+    板型名称是用户输入的自由文本，参考图按板型名称的哈希保存为 <目录>/<哈希>.png，
+    names.json 记录哈希到板型名称的映射；特征在首次使用时计算并缓存在内存中。
+    """
+
+    NAMES_FILE = "names.json"
+
+    def __init__(self, root_dir="references"):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self._boards = {}
+        self._lock = threading.Lock()
+        self._names_path = os.path.join(root_dir, self.NAMES_FILE)
+        self._names = {}
+        if os.path.exists(self._names_path):
+            with open(self._names_path, "r", encoding="utf-8") as f:
+                self._names = json.load(f)
+
+    @staticmethod
+    def _key(board_type):
+        return hashlib.sha256(board_type.encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, board_type):
+        return os.path.join(self.root_dir, f"{self._key(board_type)}.png")
+
+    def board_types(self):
+        return sorted(name for key, name in self._names.items()
+                      if os.path.exists(os.path.join(self.root_dir, f"{key}.png")))
+
+    def add(self, board_type, image, preprocess=None):
+        """
+        保存参考图并刷新缓存的特征
+
+        Args:
+            board_type (str): 板型名称
+            image: 参考图（路径、文件对象或 PIL.Image）
+            preprocess (callable): 保存前的预处理，应与待检图一致（如 PCBInference.preprocess_image），
+                使参考图与待检图处于同一尺寸空间
+        """
+        board_type = board_type.strip()
+        if not board_type:
+            raise ValueError("板型名称不能为空")
+        if preprocess is not None:
+            image = preprocess(image)
+        elif isinstance(image, str) or hasattr(image, 'read'):
+            image = Image.open(image)
+        image = image.convert('RGB')
+        image.save(self._path(board_type))
+        with self._lock:
+            self._names[self._key(board_type)] = board_type
+            with open(self._names_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self._names, f, ensure_ascii=False, indent=2)
+            os.replace(self._names_path + ".tmp", self._names_path)
+            self._boards[board_type] = ReferenceBoard(board_type, image)
+        return self._boards[board_type]
+
+    def get(self, board_type):
+        with self._lock:
+            board = self._boards.get(board_type)
+            if board is None:
+                path = self._path(board_type)
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"参考板不存在: {board_type}")
+                board = ReferenceBoard(board_type, Image.open(path))
+                self._boards[board_type] = board
+            return board
+
+
+def register(image, reference, min_matches=12, use_ecc=True):
+    """
+    将待检图配准到参考板坐标系
+
+    先用 ORB 特征匹配 + RANSAC 求单应矩阵；特征不足时退回 ECC 仿射配准。
+
+    Args:
+        image: 待检图 (PIL.Image 或 RGB 数组)
+        reference (ReferenceBoard): 参考板
+        min_matches (int): 求单应矩阵所需的最少匹配数
+        use_ecc (bool): 特征配准失败时是否尝试 ECC
+
+    Returns:
+        np.ndarray: 3x3 变换矩阵（待检图 -> 参考板，全分辨率），失败时为 None
+    """
+    gray = to_gray(image)
+    small, scale = _downscale(gray)
+    # 缩放矩阵：全分辨率 <-> 配准分辨率
+    to_small = np.diag([scale, scale, 1.0])
+    from_ref_small = np.diag([1.0 / reference.scale, 1.0 / reference.scale, 1.0])
+
+    keypoints, descriptors = reference.orb.detectAndCompute(small, None)
+    if descriptors is not None and reference.descriptors is not None:
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        matches = matcher.match(descriptors, reference.descriptors)
+        if len(matches) >= min_matches:
+            src = np.float32([keypoints[m.queryIdx].pt for m in matches])
+            dst = np.float32([reference.keypoints[m.trainIdx].pt for m in matches])
+            homography, inliers = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+            if homography is not None and inliers is not None and inliers.sum() >= min_matches:
+                return from_ref_small @ homography @ to_small
+
+    if not use_ecc:
+        return None
+    try:
+        if small.shape != reference.small.shape:
+            small = cv2.resize(small, (reference.small.shape[1], reference.small.shape[0]))
+            to_small = np.diag([reference.small.shape[1] / gray.shape[1],
+                                reference.small.shape[0] / gray.shape[0], 1.0])
+        warp = np.eye(2, 3, dtype=np.float32)
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+        _, warp = cv2.findTransformECC(reference.small, small, warp, cv2.MOTION_AFFINE, criteria, None, 5)
+        # ECC 求得的是 参考板 -> 待检图，取逆
+        affine = np.vstack([warp, [0, 0, 1]]).astype(np.float64)
+        return from_ref_small @ np.linalg.inv(affine) @ to_small
+    except cv2.error as e:
+        logger.warning(f"ECC 配准失败: {e}")
+        return None
+
+
+def difference_map(aligned, reference, threshold=40, blur=5, open_size=3, dilate_size=15, valid=None):
+    """
+    计算与参考板的差异掩膜
+
+    Args:
+        aligned: 已配准到参考板坐标系的待检图
+        reference (ReferenceBoard): 参考板
+        threshold (int): 灰度差阈值
+        blur (int): 高斯模糊核大小，抑制配准误差和噪声
+        open_size (int): 开运算核大小，去除孤立噪点
+        dilate_size (int): 膨胀核大小，把相邻差异合并为一个区域
+        valid (np.ndarray): 有效区域掩膜，配准后待检图未覆盖的部分不参与比较
+
+    Returns:
+        np.ndarray: uint8 差异掩膜（0/255）
+    """
+    gray = to_gray(aligned)
+    ref = reference.gray
+    if blur > 1:
+        gray = cv2.GaussianBlur(gray, (blur, blur), 0)
+        ref = cv2.GaussianBlur(ref, (blur, blur), 0)
+    diff = cv2.absdiff(gray, ref)
+    _, mask = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+    if valid is not None:
+        mask &= valid
+    if open_size > 1:
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((open_size, open_size), np.uint8))
+    if dilate_size > 1:
+        mask = cv2.dilate(mask, np.ones((dilate_size, dilate_size), np.uint8))
+    return mask
+
+
+def changed_regions(mask, min_area=64, pad=32, min_size=96):
+    """
+    从差异掩膜提取待检测区域
+
+    Args:
+        mask (np.ndarray): 差异掩膜
+        min_area (int): 小于该面积的差异忽略
+        pad (int): 区域外扩像素，给检测器保留上下文
+        min_size (int): 区域最小边长
+
+    Returns:
+        np.ndarray: (N, 4) int 区域框 x0, y0, x1, y1，互不重叠
+    """
+    num, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+    if len(stats) == 0:
+        return np.zeros((0, 4), dtype=np.int32)
+
+    height, width = mask.shape[:2]
+    x0 = stats[:, cv2.CC_STAT_LEFT]
+    y0 = stats[:, cv2.CC_STAT_TOP]
+    x1 = x0 + stats[:, cv2.CC_STAT_WIDTH]
+    y1 = y0 + stats[:, cv2.CC_STAT_HEIGHT]
+    # 外扩并保证最小尺寸
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    half_w = np.maximum((x1 - x0) / 2 + pad, min_size / 2)
+    half_h = np.maximum((y1 - y0) / 2 + pad, min_size / 2)
+    boxes = np.stack([cx - half_w, cy - half_h, cx + half_w, cy + half_h], axis=1)
+    boxes = np.clip(boxes, 0, [width, height, width, height]).astype(np.int32)
+    return merge_boxes(boxes)
+
+
+def merge_boxes(boxes):
+    """合并相交的区域框，直到没有重叠"""
+    boxes = boxes.copy()
+    while len(boxes) > 1:
+        lt = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+        rb = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+        overlap = np.all(rb > lt, axis=2)
+        np.fill_diagonal(overlap, False)
+        if not overlap.any():
+            break
+        i, j = np.argwhere(overlap)[0]
+        merged = np.concatenate([np.minimum(boxes[i, :2], boxes[j, :2]), np.maximum(boxes[i, 2:], boxes[j, 2:])])
+        boxes = np.vstack([np.delete(boxes, [i, j], axis=0), merged[None]])
+    return boxes
+
+
+def transform_boxes(boxes, matrix):
+    """用 3x3 变换矩阵变换框的四个角点，返回外接框"""
+    if len(boxes) == 0:
+        return boxes
+    x0, y0, x1, y1 = boxes.T
+    corners = np.stack([np.stack([x0, y0], 1), np.stack([x1, y0], 1),
+                        np.stack([x0, y1], 1), np.stack([x1, y1], 1)], axis=1).astype(np.float32)
+    mapped = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), matrix).reshape(-1, 4, 2)
+    return np.concatenate([mapped.min(axis=1), mapped.max(axis=1)], axis=1).astype(np.float32)
+
+
+class GoldenInspector:
+    """
+    金板比对检测
+
+    待检图配准到参考板后做差分，只把发生变化的区域裁剪出来批量送检，
+    与参考板一致的板子完全跳过模型推理。
+    """
+
+    def __init__(self, inference, library, threshold=40, min_area=64, max_region_ratio=0.5):
+        """
+        Args:
+            inference (PCBInference): 推理器
+            library (ReferenceLibrary): 参考板库
+            threshold (int): 差分灰度阈值
+            min_area (int): 最小差异面积
+            max_region_ratio (float): 变化区域超过整图该比例时直接整图检测
+        """
+        self.inference = inference
+        self.library = library
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_region_ratio = max_region_ratio
+        self.stats = {"boards": 0, "clean": 0, "regions": 0, "full_frame": 0}
+
+    def detect(self, image_input, board_type, conf_threshold=0.25, iou_threshold=0.45, max_size=1920):
+        """
+        与 PCBInference.detect 接口一致，额外返回 regions 与 mode
+
+        Returns:
+            tuple: (预处理后的PIL.Image, 检测结果字典)
+        """
+        start = time.time()
+        reference = self.library.get(board_type)
+        image = self.inference.preprocess_image(image_input, max_size)
+        self.stats["boards"] += 1
+
+        matrix = register(image, reference)
+        if matrix is None:
+            logger.warning("配准失败，改为整图检测")
+            return self._full_frame(image, conf_threshold, iou_threshold, max_size, start)
+
+        aligned = cv2.warpPerspective(np.asarray(image), matrix, reference.size, flags=cv2.INTER_LINEAR)
+        valid = cv2.warpPerspective(np.full(image.size[::-1], 255, np.uint8), matrix, reference.size,
+                                    flags=cv2.INTER_NEAREST)
+        valid = cv2.erode(valid, np.ones((7, 7), np.uint8))
+        regions = changed_regions(difference_map(aligned, reference, self.threshold, valid=valid), self.min_area)
+        gating_time = time.time() - start
+
+        region_area = float(np.prod(regions[:, 2:] - regions[:, :2], axis=1).sum()) if len(regions) else 0.0
+        if region_area > self.max_region_ratio * reference.size[0] * reference.size[1]:
+            logger.info("变化区域过大，改为整图检测")
+            return self._full_frame(image, conf_threshold, iou_threshold, max_size, start)
+
+        detections = self.inference._to_detections(None)
+        detections["mode"] = "golden"
+        if len(regions) == 0:
+            self.stats["clean"] += 1
+            logger.info(f"与参考板一致，跳过推理，耗时: {gating_time:.3f}s")
+            detections["regions"] = regions
+            detections["timings"] = {"gating": gating_time, "inference": 0.0}
+            return image, detections
+
+        # 变化区域批量送检，再映射回待检图坐标
+        crops = [Image.fromarray(aligned[y0:y1, x0:x1]) for x0, y0, x1, y1 in regions]
+        self.stats["regions"] += len(crops)
+        inference_start = time.time()
+        boxes, scores, classes = [], [], []
+        for i, crop_image, crop_detections in self.inference.detect_batch(
+                crops, batch_size=len(crops), conf_threshold=conf_threshold,
+                iou_threshold=iou_threshold, max_size=max_size, screen=False):
+            if crop_detections is None or len(crop_detections["boxes"]) == 0:
+                continue
+            # 大于 max_size 的裁剪区域（如大尺寸参考板）会被预处理缩小，先换算回裁剪区域坐标再加偏移
+            scale = np.array(crops[i].size, dtype=np.float32) / np.array(crop_image.size, dtype=np.float32)
+            boxes.append(crop_detections["boxes"] * np.tile(scale, 2)
+                         + np.tile(regions[i, :2], 2).astype(np.float32))
+            scores.append(crop_detections["scores"])
+            classes.append(crop_detections["classes"])
+            detections["names"] = crop_detections["names"]
+        inference_time = time.time() - inference_start
+
+        if boxes:
+            inverse = np.linalg.inv(matrix)
+            detections["boxes"] = transform_boxes(np.concatenate(boxes), inverse)
+            detections["scores"] = np.concatenate(scores)
+            detections["classes"] = np.concatenate(classes)
+        detections["regions"] = transform_boxes(regions.astype(np.float32), np.linalg.inv(matrix))
+        detections["timings"] = {"gating": gating_time, "inference": inference_time}
+        logger.info(f"金板比对: {len(regions)} 个变化区域, 检测到 {len(detections['boxes'])} 个目标, "
+                    f"耗时: {time.time() - start:.3f}s")
+        return image, detections
+
+    def _full_frame(self, image, conf_threshold, iou_threshold, max_size, start):
+        self.stats["full_frame"] += 1
+        image, detections = self.inference.detect(image, conf_threshold, iou_threshold, max_size)
+        detections["mode"] = "full"
+        detections["regions"] = np.zeros((0, 4), dtype=np.float32)
+        detections["timings"]["gating"] = time.time() - start
+        return image, detections
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    image_hash TEXT NOT NULL,
+    image_name TEXT,
+    board_type TEXT,
+    model_version TEXT,
+    conf_threshold REAL,
+    iou_threshold REAL,
+    width INTEGER,
+    height INTEGER,
+    num_detections INTEGER NOT NULL,
+    timings TEXT
+);
+CREATE TABLE IF NOT EXISTS detections (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    ts REAL NOT NULL,
+    board_type TEXT,
+    class_id INTEGER NOT NULL,
+    class_name TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL
+);
+CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs(ts);
+CREATE INDEX IF NOT EXISTS idx_runs_board_ts ON runs(board_type, ts);
+CREATE INDEX IF NOT EXISTS idx_runs_hash ON runs(image_hash);
+CREATE INDEX IF NOT EXISTS idx_det_class_board_ts ON detections(class_name, board_type, ts, confidence);
+CREATE INDEX IF NOT EXISTS idx_det_board_ts ON detections(board_type, ts);
+CREATE INDEX IF NOT EXISTS idx_det_run ON detections(run_id);
+"""
+
+
+def image_hash(image_input):
+    """
+    图片内容摘要
+
+    Args:
+        image_input: 文件路径、字节、文件对象或 PIL.Image；文件对象按其完整内容计算
+
+    Returns:
+        str: 32位十六进制摘要
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image_input, str):
+        with open(image_input, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    elif isinstance(image_input, (bytes, bytearray, memoryview)):
+        digest.update(image_input)
+    elif hasattr(image_input, "getvalue"):
+        digest.update(image_input.getvalue())
+    elif hasattr(image_input, "read"):
+        position = image_input.tell()
+        image_input.seek(0)
+        for chunk in iter(lambda: image_input.read(1 << 20), b""):
+            digest.update(chunk)
+        image_input.seek(position)
+    elif isinstance(image_input, Image.Image):
+        digest.update(image_input.tobytes())
+    else:
+        digest.update(np.ascontiguousarray(image_input).tobytes())
+    return digest.hexdigest()
+
+
+def model_version(model_path):
+    """模型版本标识：文件名 + 大小/修改时间/文件头摘要"""
+    if not os.path.exists(model_path):
+        return os.path.basename(model_path)
+    stat = os.stat(model_path)
+    digest = hashlib.blake2b(f"{stat.st_size}:{int(stat.st_mtime)}".encode(), digest_size=6)
+    with open(model_path, "rb") as f:
+        digest.update(f.read(1 << 20))
+    return f"{os.path.basename(model_path)}@{digest.hexdigest()}"
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+class InspectionHistory:
+    """
+    检测历史库
+
+    每次检测记录一行 runs，每个检测框记录一行 detections（冗余保存时间和板型，
+    使 "某板型某类缺陷某时间段置信度>x" 的查询只走一个复合索引）。
+    写入由后台线程批量提交，调用方不会被磁盘 IO 阻塞。
+    """
+
+    def __init__(self, db_path="inspection_history.db", batch_size=500, flush_interval=1.0):
+        """
+        Args:
+            db_path (str): SQLite 数据库路径
+            batch_size (int): 累积多少条记录提交一次
+            flush_interval (float): 最长多少秒提交一次
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._flushed = threading.Condition()
+        self._pending = 0
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # --- 写入 ---
+    def record(self, image_input, detections, image_name=None, board_type=None, model=None,
+               conf_threshold=None, iou_threshold=None, image_size=None, timestamp=None, digest=None):
+        """
+        异步记录一次检测
+
+        Args:
+            image_input: 用于计算摘要的原始图片（已提供 digest 时可为 None）
+            detections (dict): 结构化检测结果
+            image_name (str): 图片名
+            board_type (str): 板型
+            model (str): 模型版本
+            conf_threshold (float): 置信度阈值
+            iou_threshold (float): IoU阈值
+            image_size (tuple): 图片尺寸 (宽, 高)
+            timestamp: 检测时间，默认当前时间
+            digest (str): 已知的图片摘要
+        """
+        names = detections.get("names", {})
+        boxes = np.asarray(detections["boxes"], dtype=np.float64)
+        classes = np.asarray(detections["classes"]).astype(int)
+        scores = np.asarray(detections["scores"], dtype=np.float64)
+        run = (
+            _timestamp(timestamp) or time.time(),
+            digest or image_hash(image_input),
+            image_name,
+            board_type,
+            model,
+            None if isinstance(conf_threshold, dict) else conf_threshold,
+            None if isinstance(iou_threshold, dict) else iou_threshold,
+            image_size[0] if image_size else None,
+            image_size[1] if image_size else None,
+            len(boxes),
+            json.dumps(detections.get("timings", {})),
+        )
+        rows = [(int(c), names.get(int(c), str(int(c))), float(s), *map(float, b))
+                for b, s, c in zip(boxes, scores, classes)]
+        with self._flushed:
+            self._pending += 1
+        self._queue.put((run, rows))
+
+    def flush(self, timeout=30):
+        """等待已提交的记录全部写入"""
+        deadline = time.time() + timeout
+        with self._flushed:
+            while self._pending > 0 and time.time() < deadline:
+                self._flushed.wait(timeout=0.1)
+        return self._pending == 0
+
+    def close(self):
+        self.flush()
+        self._closed.set()
+        self._writer.join(timeout=5)
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while not (self._closed.is_set() and self._queue.empty()):
+                batch = []
+                deadline = time.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get(timeout=max(0.0, deadline - time.time())))
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        start = time.time()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                detection_rows = []
+                for run, rows in batch:
+                    cursor.execute(
+                        "INSERT INTO runs (ts, image_hash, image_name, board_type, model_version, conf_threshold, "
+                        "iou_threshold, width, height, num_detections, timings) VALUES (?,?,?,?,?,?,?,?,?,?,?)", run)
+                    run_id, ts, board_type = cursor.lastrowid, run[0], run[3]
+                    detection_rows.extend((run_id, ts, board_type) + row for row in rows)
+                cursor.executemany(
+                    "INSERT INTO detections (run_id, ts, board_type, class_id, class_name, confidence, "
+                    "x1, y1, x2, y2) VALUES (?,?,?,?,?,?,?,?,?,?)", detection_rows)
+            logger.debug(f"写入检测历史 {len(batch)} 条, 耗时: {time.time() - start:.3f}s")
+        except sqlite3.Error as e:
+            logger.error(f"写入检测历史失败: {str(e)}")
+        finally:
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+
+    # --- 查询 ---
+    def query_detections(self, class_name=None, board_type=None, since=None, until=None, min_conf=None,
+                         limit=1000):
+        """
+        查询检测框
+
+        Args:
+            class_name (str): 缺陷类别
+            board_type (str): 板型
+            since: 起始时间（datetime、ISO字符串或时间戳）
+            until: 结束时间
+            min_conf (float): 最低置信度
+            limit (int): 最多返回条数
+
+        Returns:
+            list: 字典列表，包含检测框与所属检测记录信息
+        """
+        conditions, params = [], []
+        for column, op, value in (("d.class_name", "=", class_name), ("d.board_type", "=", board_type),
+                                  ("d.ts", ">=", _timestamp(since)), ("d.ts", "<", _timestamp(until)),
+                                  ("d.confidence", ">", min_conf)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = (f"SELECT d.run_id, d.ts, d.board_type, d.class_id, d.class_name, d.confidence, "
+               f"d.x1, d.y1, d.x2, d.y2, r.image_hash, r.image_name, r.model_version "
+               f"FROM detections d JOIN runs r ON r.id = d.run_id {where} ORDER BY d.ts DESC LIMIT ?")
+        return self._fetch(sql, params + [limit])
+
+    def query_runs(self, board_type=None, since=None, until=None, image_hash_value=None, defective=None,
+                   limit=1000):
+        """查询检测记录，defective=True/False 只返回有/无缺陷的记录"""
+        conditions, params = [], []
+        for column, op, value in (("board_type", "=", board_type), ("ts", ">=", _timestamp(since)),
+                                  ("ts", "<", _timestamp(until)), ("image_hash", "=", image_hash_value)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        if defective is not None:
+            conditions.append("num_detections > 0" if defective else "num_detections = 0")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._fetch(f"SELECT * FROM runs {where} ORDER BY ts DESC LIMIT ?", params + [limit])
+
+    def class_counts(self, board_type=None, since=None, until=None, min_conf=None):
+        """按类别统计缺陷数"""
+        conditions, params = [], []
+        for column, op, value in (("board_type", "=", board_type), ("ts", ">=", _timestamp(since)),
+                                  ("ts", "<", _timestamp(until)), ("confidence", ">", min_conf)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._fetch(f"SELECT class_name, COUNT(*) AS count FROM detections {where} "
+                           f"GROUP BY class_name ORDER BY count DESC", params)
+
+    def _fetch(self, sql, params):
+        conn = self._connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+    # --- 归档 ---
+    def export_parquet(self, output_dir, since=None, until=None):
+        """
+        按日期分区导出检测框为 Parquet，便于离线分析
+
+        Returns:
+            int: 导出的行数
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rows = self.query_detections(since=since, until=until, limit=-1)
+        if not rows:
+            return 0
+        table = pa.Table.from_pylist(rows)
+        dates = [datetime.fromtimestamp(row["ts"]).strftime("%Y-%m-%d") for row in rows]
+        table = table.append_column("date", pa.array(dates))
+        pq.write_to_dataset(table, root_path=output_dir, partition_cols=["date"])
+        return len(rows)
@@ -1,28 +1,106 @@
-import cv2
+import contextlib
 import numpy as np
 from PIL import Image
 import os
 from ultralytics import YOLO
 import logging
+import threading
 import time
 
+from render import draw_detections, to_rgb_array
+from quantize import default_registry_path, resolve_variant
+from detpost import FastPostprocessor
+from history import model_version
+from resolution import AdaptiveResolution, DEFAULT_SIZES
+from warmstart import SnapshotCache
+from batch_writer import drain, write_batch
+from cascade import Cascade
+from autotune import DEFAULTS as TUNING_DEFAULTS, apply_threads, load_host_profile
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class PCBInference:
-    def __init__(self, model_path="best.engine", device="0"):
+    def __init__(self, model_path="best.engine", device="0", precision=None, registry_path=None,
+                 postprocess="ultralytics", class_top_k=None, history=None, imgsz=None, imgsz_options=None,
+                 refine=False, defect_px=None, warm_start=False, snapshot_dir=None, background_warmup=False,
+                 cascade=None, slow_capture=None, host_profile="auto"):
         """
         初始化推理器
         
         Args:
             model_path (str): TensorRT模型文件路径
             device (str): 设备选择，"0" 表示第一块GPU
+            precision (str): 指定精度变体 (fp32/fp16/int8)，从量化注册表中加载，
+                             None 表示直接使用 model_path
+            registry_path (str): 量化注册表路径，默认与模型同目录
+            postprocess (str): 后处理路径，"ultralytics" 或 "fast"（直接处理原始输出张量，
+                               支持按类别的置信度/IoU阈值）
+            class_top_k: 快速路径下每个类别最多保留的检测数，标量或 {类别: 数量}
+            history (InspectionHistory): 检测历史库，设置后 predict_image 会记录每次检测
+            imgsz: 推理尺寸，"auto" 表示按图片尺寸和缺陷尺度在 imgsz_options 中自适应选择，
+                   None 表示使用主机画像中的尺寸（没有画像时为 640）
+            imgsz_options (tuple): 自适应模式下的候选尺寸，默认 320/640/960/1280，每个尺寸都会预热
+            refine (bool): 自适应模式下启用两阶段推理，粗推理结果存疑时用大一级尺寸复查
+            defect_px (float): 原图中最小缺陷的预估边长，None 表示根据检测结果自动估计
+            warm_start (bool): 使用模型快照缓存（按模型摘要和主机特征复用优化后的模型）
+            snapshot_dir (str): 快照缓存目录，默认 ~/.cache/pcb-inference
+            background_warmup (bool): 只同步预热首选尺寸，其余尺寸在后台预热，通过 readiness() 查询进度
+            cascade: 两级检测的初筛级（Cascade 或其标定文件路径），可疑分数低于阈值的板跳过完整检测
+            slow_capture (SlowRequestCapture): 慢请求捕获，detect/predict_image 超过阈值时写入诊断包
+            host_profile: autotune.py 生成的主机画像，"auto" 表示默认路径（存在时加载），None 表示不加载；
+                          画像提供线程数、默认批大小、编码线程数和推理尺寸
         """
+        if postprocess not in ("ultralytics", "fast"):
+            raise ValueError(f"不支持的后处理路径: {postprocess}")
+        self.postprocess = postprocess
+        self.class_top_k = class_top_k
         self.model_path = model_path
         self.device = device
+        self.precision = precision
+        self.variant = None
+        if precision:
+            self.variant = resolve_variant(registry_path or default_registry_path(model_path), precision)
+            self.model_path = self.variant["path"]
+            self.device = self.variant.get("device", device)
+            logger.info(f"使用 {precision} 模型变体: {self.model_path}")
         self.model = None
+        # 主机画像：在加载模型前设置线程数
+        self.profile = None
+        if host_profile:
+            self.profile = load_host_profile(self.model_path, None if host_profile == "auto" else host_profile)
+            if self.profile:
+                apply_threads(self.profile)
+                logger.info(f"已加载主机画像: {self.profile}")
+        tuning = self.profile or TUNING_DEFAULTS
+        self.batch_size = tuning["batch_size"]
+        self.encode_workers = tuning["encode_workers"]
+        if imgsz is None:
+            imgsz = tuning["imgsz"]
+        # 首选推理尺寸：固定尺寸时即为该尺寸，自适应时取主机画像（或默认配置）中的尺寸
+        self.preferred_imgsz = tuning["imgsz"] if imgsz == "auto" else imgsz
+        # ultralytics/TensorRT 后端不保证可重入，同一实例上的模型调用串行执行；
+        # 需要并行时使用 pool.ModelPool 加载多个副本
+        self._lock = threading.RLock()
+        self.history = history
+        self.imgsz = imgsz
+        self.refine = refine
+        self.resolution = None
+        if imgsz == "auto":
+            self.resolution = AdaptiveResolution(imgsz_options or DEFAULT_SIZES, defect_px=defect_px,
+                                                 default_size=self.preferred_imgsz)
+        self.warm_start = warm_start
+        self.snapshot_dir = snapshot_dir
+        self.background_warmup = background_warmup
+        self._ready = threading.Event()
+        self._warmup = {"warmed": [], "failed": [], "pending": [], "load_time": None, "warmup_time": None,
+                        "loaded_path": None}
+        self.cascade = None
+        self.slow_capture = slow_capture
         self.load_model()
+        self.model_version = model_version(self.model_path)
+        self.cascade = Cascade.load(cascade, self) if isinstance(cascade, str) else cascade
     
     def load_model(self):
         """加载TensorRT模型"""
@@ -30,22 +108,85 @@ class PCBInference:
             if not os.path.exists(self.model_path):
                 raise FileNotFoundError(f"模型文件不存在: {self.model_path}")
             
-            logger.info(f"正在加载TensorRT模型: {self.model_path}")
+            load_start = time.time()
+            load_path = SnapshotCache(self.snapshot_dir).resolve(self.model_path) if self.warm_start else self.model_path
+            logger.info(f"正在加载模型: {load_path}")
             
-            # 显式指定设备和优化参数
-            self.model = YOLO(self.model_path)
+            # 显式指定设备和优化参数（导出/量化后的模型不一定带任务元数据）
+            self.model = YOLO(load_path, task="detect")
+            self._warmup["loaded_path"] = load_path
             
-            # 预热模型 - 这很重要！
-            logger.info("正在预热模型...")
-            dummy_img = np.zeros((640, 640, 3), dtype=np.uint8)
-            _ = self.model(dummy_img, device=self.device, verbose=False)
+            # 预热模型 - 这很重要！每个推理尺寸单独预热，首选尺寸优先，其余按与首选尺寸的差距
+            sizes = self.resolution.candidates if self.resolution else (self.imgsz,)
+            sizes = sorted(sizes, key=lambda size: (abs(size - self.preferred_imgsz), size))
+            self._warmup["pending"] = list(sizes)
+            if self.resolution:
+                self.resolution.restrict(())
+            self._warm(sizes[:1])
+            if not self._warmup["warmed"]:
+                # 首选尺寸不可用时同步尝试其余尺寸
+                self._warm(sizes[1:])
+                if not self._warmup["warmed"]:
+                    raise RuntimeError("没有可用的推理尺寸")
+            self._warmup["load_time"] = time.time() - load_start
             
-            logger.info("模型加载和预热完成!")
+            self.fast_postprocessor = FastPostprocessor(self.model, self.device) if self.postprocess == "fast" else None
+            if self._warmup["pending"] and self.background_warmup:
+                threading.Thread(target=self._warm, args=(list(self._warmup["pending"]), load_start),
+                                 name="model-warmup", daemon=True).start()
+                logger.info(f"模型已可用, 其余尺寸后台预热中: {self._warmup['pending']}")
+            else:
+                self._warm(list(self._warmup["pending"]), load_start)
+                logger.info("模型加载和预热完成!")
             
         except Exception as e:
             logger.error(f"模型加载失败: {str(e)}")
             raise
     
+    def _warm(self, sizes, load_start=None):
+        """逐个尺寸预热，成功的尺寸加入自适应候选；全部完成后标记就绪"""
+        for size in sizes:
+            logger.info(f"正在预热模型 (imgsz={size})...")
+            dummy_img = np.zeros((size, size, 3), dtype=np.uint8)
+            try:
+                with self._lock:
+                    _ = self.model(dummy_img, imgsz=size, device=self.device, verbose=False)
+                self._warmup["warmed"].append(size)
+            except Exception as e:
+                # 静态形状的 TensorRT 引擎只支持导出时的尺寸
+                if self.resolution is None:
+                    raise
+                self._warmup["failed"].append(size)
+                logger.warning(f"模型不支持推理尺寸 {size}, 已从候选中移除: {str(e)}")
+            finally:
+                self._warmup["pending"].remove(size)
+            if self.resolution:
+                self.resolution.restrict(self._warmup["warmed"])
+        if load_start is not None and not self._warmup["pending"]:
+            self._warmup["warmup_time"] = time.time() - load_start
+            self._ready.set()
+
+    def readiness(self):
+        """
+        就绪探针
+
+        Returns:
+            dict: ready（所有尺寸预热完成）、serving（至少一个尺寸可用）、各尺寸状态与耗时
+        """
+        return {
+            "ready": self._ready.is_set(),
+            "serving": bool(self._warmup["warmed"]),
+            "warmed": sorted(self._warmup["warmed"]),
+            "failed": sorted(self._warmup["failed"]),
+            "pending": list(self._warmup["pending"]),
+            "load_time": self._warmup["load_time"],
+            "warmup_time": self._warmup["warmup_time"],
+            "model_path": self._warmup["loaded_path"],
+        }
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
     def preprocess_image(self, image_input, max_size=1920):
         """
         预处理图片，优化尺寸
@@ -64,6 +205,9 @@ class PCBInference:
             image = Image.open(image_input)
         elif isinstance(image_input, Image.Image):
             image = image_input
+        elif isinstance(image_input, np.ndarray):
+            # 视频帧等 RGB 数组
+            image = Image.fromarray(image_input)
         elif hasattr(image_input, 'read'):
             image = Image.open(image_input)
         else:
@@ -86,147 +230,346 @@ class PCBInference:
         
         return image
     
-    def predict_image(self, image_input, save_path=None, show_labels=True, show_conf=True, 
-                     conf_threshold=0.25, iou_threshold=0.45, max_size=1920):
+    def select_imgsz(self, image_size):
+        """按图片尺寸选择推理尺寸，非自适应模式下返回固定尺寸"""
+        if self.resolution is None:
+            return self.imgsz
+        return self.resolution.select(image_size)
+
+    def detect(self, image_input, conf_threshold=0.25, iou_threshold=0.45, max_size=1920, imgsz=None,
+               screen=True):
         """
-        对图片进行推理预测（优化版）
-        
+        推理并返回结构化检测结果（不做绘制）
+
         Args:
             image_input: 输入图片
-            save_path (str): 保存结果图片的路径
-            show_labels (bool): 是否显示标签
-            show_conf (bool): 是否显示置信度
-            conf_threshold (float): 置信度阈值
-            iou_threshold (float): NMS IoU阈值
+            conf_threshold: 置信度阈值，快速路径下也可以是 {类别: 阈值}
+            iou_threshold: NMS IoU阈值，快速路径下也可以是 {类别: 阈值}
             max_size (int): 图片最大尺寸限制
-            
+            imgsz (int): 指定推理尺寸，None 表示按推理器配置选择
+            screen (bool): 配置了初筛级时是否先初筛（指定 imgsz 时不初筛）
+
         Returns:
-            PIL.Image: 带有检测结果的图片
+            tuple: (预处理后的PIL.Image, 检测结果字典)
+                检测结果包含 boxes (N,4 xyxy)、scores (N,)、classes (N,)、names、imgsz、timings，
+                经过初筛时另有 cascade: {score, skipped}，经过两阶段复查时另有 refined_from（粗推理尺寸）
         """
-        try:
-            # 性能计时
-            total_start = time.time()
-            
-            # 1. 预处理
-            preprocess_start = time.time()
-            image = self.preprocess_image(image_input, max_size)
-            preprocess_time = time.time() - preprocess_start
-            
-            logger.info(f"预处理完成，图片尺寸: {image.size}, 耗时: {preprocess_time:.3f}s")
-            
-            # 2. 推理
-            inference_start = time.time()
+        with self._track("detect", image_input, conf_threshold=conf_threshold, iou_threshold=iou_threshold,
+                         max_size=max_size, imgsz=imgsz, screen=screen) as record:
+            image, detections = self._detect(image_input, conf_threshold, iou_threshold, max_size, imgsz, screen)
+            record.update(image_size=image.size, imgsz=detections["imgsz"], timings=detections["timings"],
+                          cascade=detections.get("cascade"), detections=detections)
+        return image, detections
+
+    def _track(self, name, image_input, **params):
+        """配置了慢请求捕获时跟踪本次请求，否则为空操作"""
+        if self.slow_capture is None:
+            return contextlib.nullcontext({})
+        return self.slow_capture.track(name, image_input, params, self)
+
+    def _detect(self, image_input, conf_threshold, iou_threshold, max_size, imgsz, screen):
+        # 1. 预处理
+        preprocess_start = time.time()
+        image = self.preprocess_image(image_input, max_size)
+        preprocess_time = time.time() - preprocess_start
+
+        logger.info(f"预处理完成，图片尺寸: {image.size}, 耗时: {preprocess_time:.3f}s")
+
+        # 2. 初筛：判为无缺陷的板直接返回空结果
+        cascade = None
+        if screen and imgsz is None and self.cascade is not None:
+            screen_start = time.time()
+            scores, suspicious = self.cascade.screen([image])
+            cascade = {"score": float(scores[0]), "skipped": not bool(suspicious[0])}
+            preprocess_time += time.time() - screen_start
+            if cascade["skipped"]:
+                detections = self._to_detections(None)
+                detections.update(imgsz=None, cascade=cascade,
+                                  timings={"preprocess": preprocess_time, "inference": 0.0})
+                logger.info(f"初筛判定无缺陷 (分数 {cascade['score']:.3f}), 跳过完整检测")
+                return image, detections
+
+        # 3. 推理
+        size = imgsz or self.select_imgsz(image.size)
+        inference_start = time.time()
+        detections = self._infer(image, size, conf_threshold, iou_threshold)
+
+        # 4. 两阶段推理：粗推理结果存疑时用大一级尺寸复查
+        refined_from = None
+        if imgsz is None and self.refine and self.resolution is not None:
+            finer = self.resolution.next_size(size)
+            if finer is not None and self.resolution.needs_refine(detections, image.size, size):
+                logger.info(f"粗推理结果存疑, 使用 imgsz={finer} 复查")
+                refined_from, size = size, finer
+                detections = self._infer(image, size, conf_threshold, iou_threshold)
+        inference_time = time.time() - inference_start
+
+        if imgsz is None and self.resolution is not None:
+            self.resolution.observe(detections)
+        detections["imgsz"] = size
+        if refined_from is not None:
+            detections["refined_from"] = refined_from
+        if cascade is not None:
+            detections["cascade"] = cascade
+        detections["timings"] = {"preprocess": preprocess_time, "inference": inference_time}
+        return image, detections
+
+    def _check_thresholds(self, conf_threshold, iou_threshold):
+        """ultralytics 路径只支持标量阈值，按类别阈值需要快速后处理路径"""
+        if self.fast_postprocessor is None and (isinstance(conf_threshold, dict) or isinstance(iou_threshold, dict)):
+            raise ValueError("按类别的置信度/IoU阈值需要使用快速后处理路径 (postprocess=\"fast\")")
+
+    def _fast_detections(self, raw, image, imgsz, conf_threshold, iou_threshold):
+        boxes, scores, classes = self.fast_postprocessor.decode(raw, image, conf_threshold, iou_threshold,
+                                                                class_top_k=self.class_top_k, imgsz=imgsz)
+        return {"boxes": boxes, "scores": scores, "classes": classes, "names": dict(self.model.names)}
+
+    def _infer(self, image, imgsz, conf_threshold, iou_threshold):
+        """单张图片在指定尺寸上推理"""
+        self._check_thresholds(conf_threshold, iou_threshold)
+        if self.fast_postprocessor is not None:
+            with self._lock:
+                raw = self.fast_postprocessor.forward(image, imgsz)
+            return self._fast_detections(raw, image, imgsz, conf_threshold, iou_threshold)
+
+        with self._lock:
             results = self.model(
                 image,
                 device=self.device,
                 conf=conf_threshold,
                 iou=iou_threshold,
-                imgsz=640,  # 固定推理尺寸
+                imgsz=imgsz,
                 verbose=False,  # 关闭详细输出
                 stream=False,   # 不使用流式处理
                 save=False,     # 不自动保存
                 show=False      # 不显示
             )
+        return self._to_detections(results[0] if results else None)
+
+    def detect_batch(self, image_inputs, batch_size=None, conf_threshold=0.25, iou_threshold=0.45,
+                     max_size=1920, screen=True):
+        """
+        分批推理，逐张产出结构化检测结果
+
+        一个批次只调用一次模型，适合多文件上传和批量检测；
+        产出顺序与输入顺序一致，便于调用方更新进度。
+
+        Args:
+            image_inputs (list): 输入图片列表
+            batch_size (int): 每批图片数量，None 表示使用主机画像中的批大小
+            conf_threshold: 置信度阈值，快速路径下也可以是 {类别: 阈值}
+            iou_threshold: NMS IoU阈值，快速路径下也可以是 {类别: 阈值}
+            max_size (int): 图片最大尺寸限制
+            screen (bool): 配置了初筛级时是否先初筛，初筛判为无缺陷的图片不进入模型批次
+
+        Yields:
+            tuple: (序号, 预处理后的PIL.Image, 检测结果字典)，失败时后两项为 None
+        """
+        batch_size = batch_size or self.batch_size
+        for start in range(0, len(image_inputs), batch_size):
+            yield from drain(self.infer_batch(image_inputs[start:start + batch_size], start, conf_threshold,
+                                              iou_threshold, max_size, screen))
+
+    def infer_batch(self, image_inputs, start=0, conf_threshold=0.25, iou_threshold=0.45, max_size=1920,
+                    screen=True):
+        """
+        单个批次的预处理、初筛与推理，参数见 detect_batch
+
+        Returns:
+            list: 按输入顺序的 [(序号, 预处理后的PIL.Image, 检测结果字典), ...]，失败项后两项为 None
+        """
+        entries, images = [], []
+        for i, image_input in enumerate(image_inputs, start=start):
+            try:
+                images.append(self.preprocess_image(image_input, max_size))
+                entries.append((i, len(images) - 1))
+            except Exception as e:
+                logger.error(f"预处理图片 {i} 失败: {str(e)}")
+                entries.append((i, None))
+        if not images:
+            return [(i, None, None) for i, _ in entries]
+
+        cascade = [None] * len(images)
+        targets = list(range(len(images)))
+        if screen and self.cascade is not None:
+            scores, suspicious = self.cascade.screen(images)
+            cascade = [{"score": float(v), "skipped": not bool(k)} for v, k in zip(scores, suspicious)]
+            targets = [n for n in targets if suspicious[n]]
+
+        results = [None] * len(images)
+        size, inference_time = None, 0.0
+        if targets:
+            # 同一批次共用一个推理尺寸，取批内各图所需的最大尺寸
+            size = max(self.select_imgsz(images[n].size) for n in targets)
+            inference_start = time.time()
+            with self._lock:
+                outputs = self._model_batch([images[n] for n in targets], size, conf_threshold, iou_threshold)
             inference_time = time.time() - inference_start
+            for n, detections in zip(targets, outputs):
+                results[n] = detections
+            logger.info(f"批次推理完成: {len(targets)}/{len(images)} 张, 耗时: {inference_time:.3f}s")
+
+        batch = []
+        for i, n in entries:
+            if n is None:
+                batch.append((i, None, None))
+                continue
+            detections = results[n] if results[n] is not None else self._to_detections(None)
+            detections["imgsz"] = size if results[n] is not None else None
+            if cascade[n] is not None:
+                detections["cascade"] = cascade[n]
+            detections["timings"] = {"inference": inference_time / len(targets) if results[n] is not None
+                                     else 0.0}
+            batch.append((i, images[n], detections))
+        return batch
+
+    def _model_batch(self, images, size, conf_threshold, iou_threshold):
+        """一个批次调用一次模型并转换为结构化结果，调用方持有 self._lock"""
+        self._check_thresholds(conf_threshold, iou_threshold)
+        if self.fast_postprocessor is not None:
+            raws = self.fast_postprocessor.forward_batch(images, size)
+            return [self._fast_detections(raw, image, size, conf_threshold, iou_threshold)
+                    for raw, image in zip(raws, images)]
+        results = self.model(
+            images,
+            device=self.device,
+            conf=conf_threshold,
+            iou=iou_threshold,
+            imgsz=size,
+            verbose=False,
+            stream=False,
+            save=False,
+            show=False
+        )
+        return [self._to_detections(result) for result in results]
+
+    def _to_detections(self, result):
+        """将 ultralytics 结果转换为 numpy 结构化结果"""
+        names = dict(getattr(self.model, "names", None) or {})
+        if result is None or result.boxes is None or len(result.boxes) == 0:
+            return {
+                "boxes": np.zeros((0, 4), dtype=np.float32),
+                "scores": np.zeros((0,), dtype=np.float32),
+                "classes": np.zeros((0,), dtype=np.int32),
+                "names": dict(result.names) if result is not None else names,
+            }
+        boxes = result.boxes
+        return {
+            "boxes": boxes.xyxy.cpu().numpy().astype(np.float32),
+            "scores": boxes.conf.cpu().numpy().astype(np.float32),
+            "classes": boxes.cls.cpu().numpy().astype(np.int32),
+            "names": dict(result.names),
+        }
+
+    def predict_image(self, image_input, save_path=None, show_labels=True, show_conf=True, 
+                     conf_threshold=0.25, iou_threshold=0.45, max_size=1920):
+        """
+        对图片进行推理预测（优化版）
+        
+        Args:
+            image_input: 输入图片
+            save_path (str): 保存结果图片的路径
+            show_labels (bool): 是否显示标签
+            show_conf (bool): 是否显示置信度
+            conf_threshold (float): 置信度阈值
+            iou_threshold (float): NMS IoU阈值
+            max_size (int): 图片最大尺寸限制
             
-            # 3. 后处理
-            postprocess_start = time.time()
-            
-            if results and len(results) > 0:
-                result = results[0]
-                
-                # 使用优化的绘制参数
-                annotated_img = result.plot(
-                    labels=show_labels,
-                    conf=show_conf,
-                    line_width=max(1, min(3, image.size[0] // 500)),  # 动态线宽
-                    font_size=max(8, min(16, image.size[0] // 100)),  # 动态字体
-                    pil=False  # 返回numpy数组，更快
-                )
-                
-                # 高效的颜色空间转换
-                if annotated_img.dtype != np.uint8:
-                    annotated_img = annotated_img.astype(np.uint8)
-                
-                # BGR到RGB转换
-                annotated_img_rgb = cv2.cvtColor(annotated_img, cv2.COLOR_BGR2RGB)
-                result_image = Image.fromarray(annotated_img_rgb)
-                
-                # 检测结果统计
-                detections = len(result.boxes) if result.boxes is not None else 0
-                logger.info(f"检测到 {detections} 个目标")
-                
-            else:
-                # 没有检测到目标，返回原图
-                result_image = image
-                logger.info("未检测到目标")
-            
-            postprocess_time = time.time() - postprocess_start
-            
-            # 4. 保存结果
-            save_start = time.time()
-            if save_path:
-                # 优化保存参数
-                result_image.save(save_path, "JPEG", quality=90, optimize=True)
-                logger.info(f"结果已保存到: {save_path}")
-            save_time = time.time() - save_start
-            
-            # 总时间统计
-            total_time = time.time() - total_start
-            
-            logger.info(f"性能统计 - 预处理: {preprocess_time:.3f}s, "
-                       f"推理: {inference_time:.3f}s, "
-                       f"后处理: {postprocess_time:.3f}s, "
-                       f"保存: {save_time:.3f}s, "
-                       f"总计: {total_time:.3f}s")
-            
-            return result_image
-            
+        Returns:
+            PIL.Image: 带有检测结果的图片
+        """
+        try:
+            with self._track("predict_image", image_input, conf_threshold=conf_threshold,
+                             iou_threshold=iou_threshold, max_size=max_size) as record:
+                return self._predict_image(image_input, save_path, show_labels, show_conf, conf_threshold,
+                                           iou_threshold, max_size, record)
         except Exception as e:
             logger.error(f"推理失败: {str(e)}")
             raise
-    
-    def predict_batch(self, image_list, output_dir="results", show_labels=True, 
-                     show_conf=True, max_workers=4):
-        """
-        批量推理多张图片（优化版）
-        """
-        import concurrent.futures
-        import threading
+
+    def _predict_image(self, image_input, save_path, show_labels, show_conf, conf_threshold, iou_threshold,
+                       max_size, record):
+        # 性能计时
+        total_start = time.time()
         
-        os.makedirs(output_dir, exist_ok=True)
-        results = []
+        # 1-2. 预处理与推理
+        image, detections = self.detect(image_input, conf_threshold, iou_threshold, max_size)
+        preprocess_time = detections["timings"]["preprocess"]
+        inference_time = detections["timings"]["inference"]
         
-        def process_single_image(args):
-            i, image_path = args
-            try:
-                logger.info(f"处理图片 {i+1}/{len(image_list)}: {image_path}")
-                
-                base_name = os.path.splitext(os.path.basename(image_path))[0]
-                save_path = os.path.join(output_dir, f"detected_{base_name}.jpg")
-                
-                result_img = self.predict_image(
-                    image_path, 
-                    save_path=save_path,
-                    show_labels=show_labels,
-                    show_conf=show_conf
-                )
-                
-                return result_img
-                
-            except Exception as e:
-                logger.error(f"处理图片 {image_path} 失败: {str(e)}")
-                return None
+        # 3. 后处理：直接在 uint8 缓冲区上绘制，省去 BGR/RGB 转换
+        postprocess_start = time.time()
         
-        # 并行处理（但要注意GPU内存）
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, 2)) as executor:
-            futures = [executor.submit(process_single_image, (i, img)) 
-                      for i, img in enumerate(image_list)]
-            
-            for future in concurrent.futures.as_completed(futures):
-                results.append(future.result())
+        num_detections = len(detections["boxes"])
+        if num_detections > 0:
+            canvas = to_rgb_array(image)
+            draw_detections(canvas, detections, show_labels, show_conf)
+            result_image = Image.fromarray(canvas)
+            logger.info(f"检测到 {num_detections} 个目标")
+        else:
+            # 没有检测到目标，返回原图
+            result_image = image
+            logger.info("未检测到目标")
+        
+        postprocess_time = time.time() - postprocess_start
         
-        return results
+        if self.history is not None:
+            # 摘要取自原始输入（文件/字节），与页面按上传字节记录的摘要一致
+            self.history.record(
+                image_input,
+                detections,
+                image_name=os.path.basename(image_input) if isinstance(image_input, str) else None,
+                model=self.model_version,
+                conf_threshold=conf_threshold,
+                iou_threshold=iou_threshold,
+                image_size=image.size,
+            )
+        
+        # 4. 保存结果
+        save_start = time.time()
+        if save_path:
+            # 优化保存参数
+            result_image.save(save_path, "JPEG", quality=90, optimize=True)
+            logger.info(f"结果已保存到: {save_path}")
+        save_time = time.time() - save_start
+        
+        # 总时间统计
+        total_time = time.time() - total_start
+        
+        logger.info(f"性能统计 - 预处理: {preprocess_time:.3f}s, "
+                   f"推理: {inference_time:.3f}s, "
+                   f"后处理: {postprocess_time:.3f}s, "
+                   f"保存: {save_time:.3f}s, "
+                   f"总计: {total_time:.3f}s")
+        record.update(image_size=image.size, imgsz=detections["imgsz"], cascade=detections.get("cascade"),
+                      detections=detections,
+                      timings=dict(detections["timings"], postprocess=postprocess_time, save=save_time))
+        return result_image
+    
+    def predict_batch(self, image_list, output_dir="results", show_labels=True, 
+                     show_conf=True, max_workers=None, batch_size=None, fmt="JPEG", quality=85, encoder="pil",
+                     encode_options=None, max_pending=None):
+        """
+        批量推理多张图片，结果直接写盘（内存占用与图片数量无关）
+
+        Args:
+            image_list (list): 图片路径列表
+            output_dir (str): 输出目录
+            show_labels (bool): 是否显示标签
+            show_conf (bool): 是否显示置信度
+            max_workers (int): 编码写盘线程数，None 表示使用主机画像中的设置
+            batch_size (int): 推理批大小，None 表示使用主机画像中的设置
+            fmt (str): 输出格式 JPEG / PNG / WEBP
+            quality (int): JPEG/WEBP 质量
+            encoder (str): "pil" 或 "cv2"
+            encode_options (dict): 额外编码参数，默认不开启 optimize
+            max_pending (int): 最多在途（已推理未写盘）图片数
+
+        Returns:
+            list: 按输入顺序的结果清单（输出路径、检测框、计数），同时写入 output_dir/manifest.jsonl
+        """
+        return write_batch(self, image_list, output_dir, show_labels, show_conf, batch_size or self.batch_size,
+                           max_workers or self.encode_workers, fmt, quality, encoder, encode_options, max_pending)
 
 # 便捷函数（优化版）
 def quick_predict(image_input, model_path="best.engine", save_path=None, device="0"):
@@ -0,0 +1,373 @@
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+from pipeline import run_detection, run_analysis
+from quantize import list_images
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MOCK_ANALYSIS_TEXT = "检测到的缺陷位于焊盘附近，建议复检。结论：不合格"
+
+
+class MockDifyServer:
+    """
+    本地模拟 Dify 服务
+
+    实现 /files/upload 与 /workflows/run 两个接口，工作流延迟按对数正态分布采样，
+    可配置错误率；response_mode=streaming 时按 SSE 分段返回。
+    输入中带 boards（多板结构化检测结果，JSON 字符串）时按批量分析工作流应答，
+    返回每块板的结论 JSON。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, upload_latency=0.05, workflow_latency=2.0, latency_sigma=0.3,
+                 error_rate=0.0, stream_chunks=8, analysis_text=MOCK_ANALYSIS_TEXT, seed=0, per_board_latency=0.0):
+        """
+        Args:
+            host (str): 监听地址
+            port (int): 端口，0 表示自动分配
+            upload_latency (float): 上传接口中位延迟（秒）
+            workflow_latency (float): 工作流中位延迟（秒）
+            latency_sigma (float): 对数正态分布的 sigma
+            error_rate (float): 工作流返回 500 的概率
+            stream_chunks (int): 流式响应的分段数
+            analysis_text (str): 工作流返回的分析文本
+            per_board_latency (float): 批量分析时每块板增加的延迟（秒）
+        """
+        self.upload_latency = upload_latency
+        self.workflow_latency = workflow_latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.analysis_text = analysis_text
+        self.per_board_latency = per_board_latency
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.stats = {"uploads": 0, "workflows": 0, "errors": 0, "boards": 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _latency(self, median):
+        with self._rng_lock:
+            return median * self._rng.lognormvariate(0, self.latency_sigma) if median > 0 else 0.0
+
+    def _batch_text(self, boards):
+        """批量分析应答：有缺陷的板判为 defect，其余判为 pass"""
+        verdicts = []
+        for board in boards:
+            counts = board.get("counts", {})
+            if counts:
+                detail = "、".join(f"{name} {count} 个" for name, count in counts.items())
+                verdicts.append({"id": board["id"], "verdict": "defect", "analysis": f"发现缺陷：{detail}"})
+            else:
+                verdicts.append({"id": board["id"], "verdict": "pass", "analysis": "板面正常，未见缺陷"})
+        return "```json\n" + json.dumps({"boards": verdicts}, ensure_ascii=False) + "\n```"
+
+    def _fail(self):
+        with self._rng_lock:
+            return self._rng.random() < self.error_rate
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/files/upload"):
+                    time.sleep(server._latency(server.upload_latency))
+                    server.stats["uploads"] += 1
+                    self._send_json(201, {"id": uuid.uuid4().hex, "size": len(body)})
+                elif self.path.endswith("/workflows/run"):
+                    server.stats["workflows"] += 1
+                    payload = json.loads(body or b"{}")
+                    latency = server._latency(server.workflow_latency)
+                    text = server.analysis_text
+                    boards = payload.get("inputs", {}).get("boards")
+                    if boards:
+                        boards = json.loads(boards)
+                        server.stats["boards"] += len(boards)
+                        latency += server.per_board_latency * len(boards)
+                        text = server._batch_text(boards)
+                    if server._fail():
+                        time.sleep(latency)
+                        server.stats["errors"] += 1
+                        self._send_json(500, {"code": "internal_error", "message": "mock failure"})
+                    elif payload.get("response_mode") == "streaming":
+                        self._stream(latency, text)
+                    else:
+                        time.sleep(latency)
+                        self._send_json(200, {"data": {"status": "succeeded", "outputs": {"text": text}}})
+                else:
+                    self._send_json(404, {"message": "not found"})
+
+            def _stream(self, latency, text):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = max(1, len(text) // server.stream_chunks)
+                events = [{"event": "workflow_started", "data": {}}]
+                events += [{"event": "text_chunk", "data": {"text": text[i:i + step]}}
+                           for i in range(0, len(text), step)]
+                events.append({"event": "workflow_finished", "data": {"status": "succeeded",
+                                                                      "outputs": {"text": text}}})
+                for event in events:
+                    time.sleep(latency / len(events))
+                    chunk = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-dify", daemon=True)
+        self._thread.start()
+        logger.info(f"模拟 Dify 服务已启动: {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class ResourceSampler:
+    """后台采样本进程的 CPU、内存、线程数（以及可用时的 GPU 显存）"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _gpu_memory(self):
+        try:
+            import torch
+            if torch.cuda.is_available():
+                return torch.cuda.memory_allocated() / 1024 / 1024
+        except ImportError:
+            pass
+        return None
+
+    def _run(self):
+        import psutil
+        process = psutil.Process()
+        process.cpu_percent(None)
+        while not self._stop.wait(self.interval):
+            self.samples.append({
+                "cpu_percent": process.cpu_percent(None),
+                "rss_mb": process.memory_info().rss / 1024 / 1024,
+                "threads": process.num_threads(),
+                "gpu_mb": self._gpu_memory(),
+            })
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return {}
+        summary = {}
+        for key in ("cpu_percent", "rss_mb", "threads", "gpu_mb"):
+            values = [s[key] for s in self.samples if s[key] is not None]
+            if values:
+                summary[key] = {"mean": float(np.mean(values)), "max": float(np.max(values))}
+        summary["samples"] = len(self.samples)
+        return summary
+
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = np.asarray(values) * 1000
+    return {
+        "count": int(values.size),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def run_load(inference_model, images, dify_api_url, sessions=4, iterations=10, think_time=0.0,
+             response_mode="blocking", render_options=None, dify_api_key="mock-key"):
+    """
+    模拟多个操作员并发执行 上传 -> 检测 -> 分析
+
+    Args:
+        inference_model: PCBInference 或 ModelPool
+        images (list): 图片路径
+        dify_api_url (str): Dify（或模拟服务）地址
+        sessions (int): 并发会话数
+        iterations (int): 每个会话的操作次数
+        think_time (float): 两次操作之间的平均间隔（秒，指数分布）
+        response_mode (str): 工作流响应模式
+        render_options (dict): 生成分析图时的显示选项
+
+    Returns:
+        dict: 各阶段与端到端延迟分位数、吞吐、错误统计
+    """
+    payloads = []
+    for path in images:
+        with open(path, "rb") as f:
+            payloads.append((os.path.basename(path), f.read()))
+    render_options = render_options or {"show_labels": True, "show_conf": True, "classes": None}
+
+    lock = threading.Lock()
+    stages = {"detection": [], "render": [], "upload": [], "workflow": [], "end_to_end": []}
+    errors = {"detection": 0, "analysis": 0}
+    messages = {}
+
+    def operator(session_index):
+        rng = random.Random(session_index)
+        http = requests.Session()
+        session_id = f"load-{session_index}"
+        for n in range(iterations):
+            if think_time > 0:
+                time.sleep(rng.expovariate(1.0 / think_time))
+            name, data = payloads[(session_index + n) % len(payloads)]
+            start = time.time()
+            if hasattr(inference_model, "session"):
+                with inference_model.session(session_id):
+                    detection = run_detection(data, inference_model, image_name=name)
+            else:
+                detection = run_detection(data, inference_model, image_name=name)
+            detected = time.time()
+            if not detection["success"]:
+                with lock:
+                    errors["detection"] += 1
+                    messages[detection["error"]] = messages.get(detection["error"], 0) + 1
+                continue
+            jpeg = detection["renderer"].render_bytes(**render_options)
+            rendered = time.time()
+            analysis = run_analysis(jpeg, dify_api_url, dify_api_key, response_mode=response_mode,
+                                    user=session_id, session=http)
+            finished = time.time()
+            with lock:
+                stages["detection"].append(detected - start)
+                stages["render"].append(rendered - detected)
+                for key, value in analysis["timings"].items():
+                    stages[key].append(value)
+                if analysis["success"]:
+                    stages["end_to_end"].append(finished - start)
+                else:
+                    errors["analysis"] += 1
+                    messages[analysis["error"]] = messages.get(analysis["error"], 0) + 1
+
+    sampler = ResourceSampler().start()
+    threads = [threading.Thread(target=operator, args=(i,), name=f"operator-{i}") for i in range(sessions)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    resources = sampler.stop()
+
+    attempted = sessions * iterations
+    completed = len(stages["end_to_end"])
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "config": {"sessions": sessions, "iterations": iterations, "think_time": think_time,
+                   "response_mode": response_mode, "images": len(payloads), "dify_api_url": dify_api_url},
+        "elapsed_s": elapsed,
+        "attempted": attempted,
+        "completed": completed,
+        "throughput_rps": completed / max(elapsed, 1e-9),
+        "error_rate": (attempted - completed) / max(attempted, 1),
+        "errors": errors,
+        "error_messages": messages,
+        "latency": {stage: _percentiles(values) for stage, values in stages.items()},
+        "resources": resources,
+        "pool": inference_model.info() if hasattr(inference_model, "info") else None,
+    }
+
+
+def main():
+    from inference import PCBInference
+    from pool import ModelPool
+
+    parser = argparse.ArgumentParser(description="检测 -> 分析流程压测（本地模拟 Dify）")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True, help="测试图片目录")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--dify-url", default=None, help="使用真实 Dify 地址，默认启动本地模拟服务")
+    parser.add_argument("--workflow-latency", type=float, default=2.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--output", default="loadtest_report.json")
+    args = parser.parse_args()
+
+    pool = ModelPool(lambda: PCBInference(args.model, device=args.device, imgsz="auto"), replicas=args.replicas)
+    images = list_images(args.images, args.limit)
+    response_mode = "streaming" if args.streaming else "blocking"
+
+    if args.dify_url:
+        report = run_load(pool, images, args.dify_url, args.sessions, args.iterations, args.think_time,
+                          response_mode, dify_api_key=os.environ.get("DIFY_API_KEY", ""))
+    else:
+        with MockDifyServer(workflow_latency=args.workflow_latency, latency_sigma=args.latency_sigma,
+                            error_rate=args.error_rate) as server:
+            report = run_load(pool, images, server.url, args.sessions, args.iterations, args.think_time,
+                              response_mode)
+            report["mock_server"] = dict(server.stats)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    latency = report["latency"]["end_to_end"]
+    print(f"完成 {report['completed']}/{report['attempted']}, 吞吐: {report['throughput_rps']:.2f} req/s, "
+          f"端到端 p50: {latency.get('p50_ms', 0):.0f}ms, p95: {latency.get('p95_ms', 0):.0f}ms, "
+          f"报告: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
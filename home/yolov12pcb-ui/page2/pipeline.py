@@ -0,0 +1,165 @@
+import io
+import json
+import logging
+import time
+
+import requests
+from PIL import Image
+
+from render import OverlayRenderer
+from history import image_hash
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# segtool 的检测 -> 分析流程，不依赖 Streamlit，页面和压测工具共用
+
+
+def run_detection(image_bytes, inference_model, image_name=None, board_type=None, golden_inspector=None,
+                  history=None, conf_threshold=0.25, iou_threshold=0.45):
+    """
+    检测一张上传图片
+
+    Args:
+        image_bytes (bytes): 图片文件内容
+        inference_model: PCBInference 或 ModelPool
+        image_name (str): 图片名（记录历史用）
+        board_type (str): 板型，设置且提供 golden_inspector 时走金板比对
+        golden_inspector (GoldenInspector): 金板比对检测器
+        history (InspectionHistory): 检测历史库
+        conf_threshold (float): 置信度阈值
+        iou_threshold (float): NMS IoU阈值
+
+    Returns:
+        dict: success、renderer（底图+结构化结果）、time；失败时为 error
+    """
+    try:
+        start_time = time.time()
+        image_input = io.BytesIO(image_bytes)
+        if board_type and golden_inspector is not None:
+            # 金板比对：只检测与参考板不同的区域
+            image, detections = golden_inspector.detect(image_input, board_type, conf_threshold, iou_threshold)
+        else:
+            image, detections = inference_model.detect(image_input, conf_threshold, iou_threshold)
+        inference_time = time.time() - start_time
+        if history is not None:
+            history.record(None, detections, image_name=image_name, board_type=board_type,
+                           model=inference_model.model_version, conf_threshold=conf_threshold,
+                           iou_threshold=iou_threshold, image_size=image.size, digest=image_hash(image_bytes))
+        return {"success": True, "renderer": OverlayRenderer(image, detections=detections), "time": inference_time}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+
+# 分析文本 -> 结论的关键词（与页面展示一致）
+DEFECT_KEYWORDS = ("缺陷", "缺失", "问题", "错误", "故障", "异常")
+PASS_KEYWORDS = ("正常", "良好", "无问题", "合格", "完好")
+
+
+def classify_verdict(analysis_text):
+    """
+    按关键词把分析文本归为结论
+
+    Returns:
+        str: "defect"（发现缺陷）、"pass"（检测通过）或 "unknown"
+    """
+    if any(keyword in analysis_text for keyword in DEFECT_KEYWORDS):
+        return "defect"
+    if any(keyword in analysis_text for keyword in PASS_KEYWORDS):
+        return "pass"
+    return "unknown"
+
+
+def _to_jpeg(image_bytes):
+    """检测结果已是 JPEG 时直接上传，其他格式转为白底 JPEG"""
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return image_bytes
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P': image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    img_buffer = io.BytesIO()
+    image.save(img_buffer, format='JPEG', quality=95)
+    return img_buffer.getvalue()
+
+
+def _read_stream(response):
+    """解析 Dify 流式响应（SSE），返回 workflow_finished 事件的数据"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        event = json.loads(line[5:].strip())
+        if event.get("event") == "workflow_finished":
+            return {"data": event.get("data", {})}
+    raise Exception("流式响应未包含 workflow_finished 事件")
+
+
+def upload_file(http, dify_api_url, dify_api_key, data, filename="pcb_analysis.jpg"):
+    """上传一张 JPEG 到 Dify，返回文件 id"""
+    response = http.post(
+        f"{dify_api_url}/files/upload",
+        files={'file': (filename, data, 'image/jpeg')},
+        data={'type': 'image'},
+        headers={"Authorization": f"Bearer {dify_api_key}"},
+        timeout=60
+    )
+    if response.status_code != 201:
+        raise Exception(f"文件上传失败: {response.text}")
+    return response.json().get('id')
+
+
+def run_analysis(detection_result, dify_api_url, dify_api_key, response_mode="blocking", user="streamlit_user",
+                 session=None):
+    """
+    上传检测结果图并调用 Dify 工作流
+
+    Args:
+        detection_result (bytes): 检测结果图片
+        dify_api_url (str): Dify API 地址
+        dify_api_key (str): Dify API Key
+        response_mode (str): "blocking" 或 "streaming"
+        user (str): Dify 用户标识
+        session (requests.Session): 复用连接的会话，默认每次新建连接
+
+    Returns:
+        dict: success、analysis_text、raw_response、timings（upload / workflow）；失败时为 error
+    """
+    http = session or requests
+    timings = {}
+    try:
+        img_bytes = _to_jpeg(detection_result)
+
+        upload_start = time.time()
+        file_id = upload_file(http, dify_api_url, dify_api_key, img_bytes)
+        timings["upload"] = time.time() - upload_start
+
+        workflow_payload = {
+            "inputs": {"imUrl": {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}},
+            "response_mode": response_mode, "user": user
+        }
+        workflow_start = time.time()
+        workflow_response = http.post(
+            f"{dify_api_url}/workflows/run",
+            json=workflow_payload,
+            headers={"Authorization": f"Bearer {dify_api_key}", "Content-Type": "application/json"},
+            timeout=120,
+            stream=response_mode == "streaming"
+        )
+
+        if workflow_response.status_code == 200:
+            result = _read_stream(workflow_response) if response_mode == "streaming" else workflow_response.json()
+            timings["workflow"] = time.time() - workflow_start
+            analysis_text = result.get("data", {}).get("outputs", {}).get("text", "")
+            if analysis_text:
+                return {"success": True, "analysis_text": analysis_text, "raw_response": result, "timings": timings}
+            else:
+                raise Exception("工作流执行成功，但没有返回分析文本")
+        else:
+            raise Exception(f"工作流执行失败: HTTP {workflow_response.status_code}")
+    except Exception as e:
+        return {"success": False, "error": str(e), "timings": timings}
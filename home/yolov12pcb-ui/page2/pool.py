@@ -0,0 +1,276 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from batch_writer import drain, write_batch
+from quantize import list_images
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ModelPool:
+    """
+    推理器副本池
+
+    每个副本是独立加载的 PCBInference，同一时刻只借给一个调用方；
+    副本数决定并行度，副本内部的模型调用始终是串行的。
+    等待的请求按会话轮转分配副本：一个会话提交再多请求，
+    其他会话的请求也只需等待一轮，不会被饿死。
+    """
+
+    def __init__(self, factory, replicas=1, timeout=None):
+        """
+        Args:
+            factory (callable): 无参函数，返回一个 PCBInference
+            replicas (int): 副本数量，None 表示使用第一个副本加载的主机画像中的副本数
+            timeout (float): 借用副本的默认等待超时（秒），None 表示一直等待
+        """
+        if replicas is not None and replicas < 1:
+            raise ValueError("副本数量至少为 1")
+        if replicas is None:
+            first = factory()
+            replicas = max(1, (first.profile or {}).get("replicas", 1))
+            self.replicas = [first]
+        else:
+            self.replicas = []
+        # 副本并行加载与预热
+        with concurrent.futures.ThreadPoolExecutor(max_workers=replicas) as executor:
+            self.replicas += list(executor.map(lambda _: factory(), range(replicas - len(self.replicas))))
+        self.timeout = timeout
+        self._idle = list(self.replicas)
+        self._cond = threading.Condition()
+        # 会话 -> 等待中的请求票据，顺序即轮转顺序
+        self._waiting = OrderedDict()
+        self._local = threading.local()
+        self.stats = {"checkouts": 0, "timeouts": 0, "wait_time": 0.0, "max_wait": 0.0}
+        logger.info(f"推理器副本池已就绪: {replicas} 个副本")
+
+    # --- 会话 ---
+    @contextmanager
+    def session(self, session_id):
+        """在当前线程内把后续调用归属到指定会话"""
+        previous = getattr(self._local, "session", None)
+        self._local.session = session_id
+        try:
+            yield self
+        finally:
+            self._local.session = previous
+
+    def _current_session(self):
+        return getattr(self._local, "session", None) or "default"
+
+    # --- 借用与归还 ---
+    def _is_next(self, session, ticket):
+        head_session, tickets = next(iter(self._waiting.items()))
+        return head_session == session and tickets[0] is ticket
+
+    def checkout(self, session=None, timeout=None):
+        """
+        借出一个空闲副本
+
+        Args:
+            session (str): 会话标识，默认取当前线程绑定的会话
+            timeout (float): 等待超时（秒）
+
+        Returns:
+            PCBInference: 副本，用完后必须 checkin
+        """
+        session = session or self._current_session()
+        timeout = self.timeout if timeout is None else timeout
+        ticket = object()
+        start = time.time()
+        with self._cond:
+            self._waiting.setdefault(session, deque()).append(ticket)
+            served = False
+            try:
+                while not (self._idle and self._is_next(session, ticket)):
+                    remaining = None if timeout is None else timeout - (time.time() - start)
+                    if remaining is not None and remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise TimeoutError(f"等待推理器副本超时 ({timeout}s)")
+                    self._cond.wait(remaining)
+                served = True
+            finally:
+                tickets = self._waiting[session]
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._waiting[session]
+                elif served:
+                    # 本会话已被服务一次，排到队尾
+                    self._waiting.move_to_end(session)
+                self._cond.notify_all()
+            replica = self._idle.pop()
+            wait = time.time() - start
+            self.stats["checkouts"] += 1
+            self.stats["wait_time"] += wait
+            self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+        return replica
+
+    def checkin(self, replica):
+        with self._cond:
+            self._idle.append(replica)
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self, session=None, timeout=None):
+        replica = self.checkout(session, timeout)
+        try:
+            yield replica
+        finally:
+            self.checkin(replica)
+
+    def info(self):
+        with self._cond:
+            return dict(self.stats, replicas=len(self.replicas), idle=len(self._idle),
+                        waiting=sum(len(t) for t in self._waiting.values()), sessions=len(self._waiting))
+
+    def readiness(self):
+        """就绪探针：所有副本都完成预热才算就绪"""
+        replicas = [replica.readiness() for replica in self.replicas]
+        return {
+            "ready": all(r["ready"] for r in replicas),
+            "serving": any(r["serving"] for r in replicas),
+            "replicas": replicas,
+        }
+
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        return all(replica.wait_ready(None if deadline is None else max(0.0, deadline - time.time()))
+                   for replica in self.replicas)
+
+    # --- 与 PCBInference 相同的推理接口 ---
+    def detect(self, *args, **kwargs):
+        with self.lease() as replica:
+            return replica.detect(*args, **kwargs)
+
+    def detect_batch(self, image_inputs, batch_size=None, **kwargs):
+        """
+        分批推理，每个批次单独借用副本，批次之间让出给其他会话
+
+        只在批次推理期间占用副本，调用方处理结果时不占用；结果逐项交出，
+        在途图片最多为一个批次。
+        """
+        batch_size = batch_size or self.replicas[0].batch_size
+        for start in range(0, len(image_inputs), batch_size):
+            with self.lease() as replica:
+                batch = replica.infer_batch(image_inputs[start:start + batch_size], start, **kwargs)
+            yield from drain(batch)
+
+    def predict_image(self, *args, **kwargs):
+        with self.lease() as replica:
+            return replica.predict_image(*args, **kwargs)
+
+    def predict_batch(self, image_list, output_dir="results", show_labels=True, show_conf=True, max_workers=None,
+                      batch_size=None, **kwargs):
+        """批量推理并写盘，每个推理批次单独借用副本，返回按输入顺序的结果清单"""
+        return write_batch(self, image_list, output_dir, show_labels, show_conf,
+                           batch_size=batch_size or self.replicas[0].batch_size,
+                           encode_workers=max_workers or self.replicas[0].encode_workers, **kwargs)
+
+    def __getattr__(self, name):
+        # 预处理、版本号等不涉及模型调用的属性直接取第一个副本
+        if name.startswith("__") or name == "replicas":
+            raise AttributeError(name)
+        return getattr(self.replicas[0], name)
+
+
+def stress_test(pool, images, sessions=4, requests_per_session=20, heavy_threads=4, conf_threshold=0.25):
+    """
+    并发压力测试
+
+    先串行得到每张图的参考结果，再由多个会话并发请求并逐框比对。
+    第 0 个会话用 heavy_threads 个线程同时提交（模拟批量任务），
+    其余会话各一个线程（模拟交互请求），用于观察公平性。
+
+    Returns:
+        dict: 请求数、错误数、结果不一致数、每个会话的延迟统计、吞吐
+    """
+    loaded = [pool.preprocess_image(image) for image in images]
+    reference = [pool.detect(image, conf_threshold) for image in loaded]
+
+    lock = threading.Lock()
+    report = {"requests": 0, "errors": 0, "mismatches": 0, "sessions": {}}
+    latencies = {f"session-{s}": [] for s in range(sessions)}
+
+    def worker(session_id, count, offset):
+        with pool.session(session_id):
+            for n in range(count):
+                index = (offset + n) % len(loaded)
+                start = time.perf_counter()
+                try:
+                    # 固定为参考结果的推理尺寸，排除自适应尺寸随时间变化的影响
+                    _, detections = pool.detect(loaded[index], conf_threshold,
+                                                imgsz=reference[index][1].get("imgsz"))
+                except Exception as e:
+                    logger.error(f"{session_id} 请求失败: {str(e)}")
+                    with lock:
+                        report["errors"] += 1
+                    continue
+                elapsed = (time.perf_counter() - start) * 1000
+                expected = reference[index][1]
+                same = (detections["boxes"].shape == expected["boxes"].shape
+                        and np.allclose(detections["boxes"], expected["boxes"], atol=1e-3)
+                        and np.array_equal(detections["classes"], expected["classes"]))
+                with lock:
+                    report["requests"] += 1
+                    report["mismatches"] += 0 if same else 1
+                    latencies[session_id].append(elapsed)
+
+    threads = []
+    for s in range(sessions):
+        session_id = f"session-{s}"
+        workers = heavy_threads if s == 0 else 1
+        for w in range(workers):
+            threads.append(threading.Thread(target=worker, args=(session_id, requests_per_session, s + w)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    for session_id, times in latencies.items():
+        if times:
+            report["sessions"][session_id] = {
+                "requests": len(times),
+                "p50_ms": float(np.percentile(times, 50)),
+                "p95_ms": float(np.percentile(times, 95)),
+            }
+    report["throughput"] = report["requests"] / max(elapsed, 1e-9)
+    report["pool"] = pool.info()
+    report["correct"] = report["errors"] == 0 and report["mismatches"] == 0
+    return report
+
+
+def main():
+    from inference import PCBInference
+
+    parser = argparse.ArgumentParser(description="推理器副本池并发压力测试")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True, help="测试图片目录")
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20, help="每个会话线程的请求数")
+    parser.add_argument("--limit", type=int, default=16)
+    args = parser.parse_args()
+
+    pool = ModelPool(lambda: PCBInference(args.model, device=args.device), replicas=args.replicas)
+    report = stress_test(pool, list_images(args.images, args.limit), args.sessions, args.requests)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report["correct"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 页面显示用的默认尺寸：三列布局下单列约 500px，按 2 倍像素密度取整
+DISPLAY_SIZE = 960
+GALLERY_SIZE = 256
+
+
+def content_key(data):
+    """图片内容摘要，用作缓存键"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def probe_image(data):
+    """
+    只读取文件头获取图片信息，不解码像素
+
+    Args:
+        data (bytes): 图片字节
+
+    Returns:
+        dict: width/height/format/mode
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return {"width": image.size[0], "height": image.size[1], "format": image.format, "mode": image.mode}
+
+
+def encode_preview(image, quality=80):
+    """编码为渐进式JPEG，慢网络下浏览器可先显示低清轮廓"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, progressive=True)
+    return buffer.getvalue()
+
+
+def make_thumbnail(data, max_side=DISPLAY_SIZE, quality=80):
+    """
+    生成显示分辨率的缩略图
+
+    JPEG 通过 draft 模式在解码阶段直接按 1/2、1/4、1/8 缩小，
+    避免解码完整的大图。
+
+    Args:
+        data (bytes): 图片字节
+        max_side (int): 缩略图最长边
+        quality (int): JPEG质量
+
+    Returns:
+        bytes: 渐进式JPEG字节
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (max_side, max_side))
+        image = image.convert('RGB') if image.mode != 'RGB' else image
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return encode_preview(image, quality)
+
+
+def thumbnail_array(array, max_side=DISPLAY_SIZE, quality=80):
+    """RGB 数组生成显示分辨率的缩略图JPEG字节"""
+    image = Image.fromarray(np.asarray(array))
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return encode_preview(image, quality)
+
+
+def crop_region(source, center, zoom, viewport=DISPLAY_SIZE, quality=90):
+    """
+    按需裁剪原图局部，用于放大查看
+
+    Args:
+        source: 图片字节或 RGB 数组（全分辨率）
+        center (tuple): 归一化中心点 (x, y)，取值 0~1
+        zoom (float): 放大倍数，1 表示整幅图缩放到视口
+        viewport (int): 输出最长边
+
+    Returns:
+        tuple: (JPEG字节, 裁剪框 (x0, y0, x1, y1))
+    """
+    if isinstance(source, (bytes, bytearray)):
+        with Image.open(io.BytesIO(source)) as image:
+            image = image.convert('RGB')
+    else:
+        image = Image.fromarray(np.asarray(source))
+
+    width, height = image.size
+    zoom = max(1.0, float(zoom))
+    crop_w, crop_h = max(1, int(width / zoom)), max(1, int(height / zoom))
+    cx, cy = int(center[0] * width), int(center[1] * height)
+    x0 = min(max(0, cx - crop_w // 2), width - crop_w)
+    y0 = min(max(0, cy - crop_h // 2), height - crop_h)
+    box = (x0, y0, x0 + crop_w, y0 + crop_h)
+
+    region = image.crop(box)
+    if max(region.size) > viewport:
+        region.thumbnail((viewport, viewport), Image.Resampling.LANCZOS)
+    return encode_preview(region, quality), box
+
+
+class PreviewCache:
+    """
+    进程级缩略图缓存
+
+    以内容摘要和尺寸为键，多个会话上传同一张图只生成一次。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def thumbnail(self, data, max_side=DISPLAY_SIZE, key=None):
+        """
+        Args:
+            data (bytes): 图片字节
+            max_side (int): 缩略图最长边
+            key (str): 内容摘要，已知时可传入避免重复计算
+
+        Returns:
+            bytes: 缩略图JPEG字节
+        """
+        cache_key = (key or content_key(data), max_side)
+        with self._lock:
+            cached = self._items.get(cache_key)
+            if cached is not None:
+                self._items.move_to_end(cache_key)
+                return cached
+
+        thumb = make_thumbnail(data, max_side)
+        with self._lock:
+            if cache_key not in self._items:
+                self._items[cache_key] = thumb
+                self._bytes += len(thumb)
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+        return thumb
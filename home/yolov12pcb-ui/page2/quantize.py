@@ -0,0 +1,293 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.bmp")
+
+# 精度 -> 变体文件后缀
+VARIANT_SUFFIX = {"fp32": "", "fp16": "_fp16", "int8": "_int8"}
+
+
+def default_registry_path(model_path):
+    """模型变体注册表默认与模型文件放在同一目录"""
+    return os.path.join(os.path.dirname(os.path.abspath(model_path)), "model_registry.json")
+
+
+def load_registry(registry_path):
+    if not os.path.exists(registry_path):
+        return {"variants": {}}
+    with open(registry_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_registry(registry_path, registry):
+    tmp_path = registry_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(registry, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, registry_path)
+
+
+def resolve_variant(registry_path, precision):
+    """
+    从注册表中查找通过精度验证的模型变体
+
+    Args:
+        registry_path (str): 注册表路径
+        precision (str): fp32 / fp16 / int8
+
+    Returns:
+        dict: 变体记录，包含 path 和 device
+    """
+    variant = load_registry(registry_path)["variants"].get(precision)
+    if variant is None:
+        raise FileNotFoundError(f"注册表中没有 {precision} 模型变体: {registry_path}")
+    if not variant.get("accepted"):
+        raise ValueError(f"{precision} 模型变体未通过精度验证 (mAP下降 {variant.get('map_drop', 0):.4f})")
+    path = variant["path"]
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(registry_path)), path)
+    return dict(variant, path=path)
+
+
+def list_images(image_dir, limit=None):
+    paths = sorted(p for pattern in IMAGE_PATTERNS for p in glob.glob(os.path.join(image_dir, "**", pattern),
+                                                                       recursive=True))
+    return paths[:limit] if limit else paths
+
+
+def letterbox(image, imgsz=640, color=114):
+    """与 ultralytics 一致的等比缩放 + 填充，返回 NCHW float32"""
+    image = np.asarray(image.convert('RGB') if isinstance(image, Image.Image) else image)
+    height, width = image.shape[:2]
+    ratio = min(imgsz / height, imgsz / width)
+    new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((imgsz, imgsz, 3), color, dtype=np.uint8)
+    top, left = (imgsz - new_h) // 2, (imgsz - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = resized
+    return np.ascontiguousarray(canvas.transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+class CalibrationReader:
+    """
+    INT8 校准数据读取器
+
+    实现 onnxruntime CalibrationDataReader 接口，从产线图片中随机抽取校准样本。
+    """
+
+    def __init__(self, image_paths, input_name, imgsz=640):
+        self.image_paths = list(image_paths)
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self._iter = iter(self.image_paths)
+
+    def get_next(self):
+        for path in self._iter:
+            try:
+                with Image.open(path) as image:
+                    return {self.input_name: letterbox(image, self.imgsz)}
+            except Exception as e:
+                logger.warning(f"跳过校准图片 {path}: {e}")
+        return None
+
+    def rewind(self):
+        self._iter = iter(self.image_paths)
+
+
+def export_onnx(model_path, imgsz=640):
+    """导出 FP32 ONNX 基线模型（已是 ONNX 时直接返回）"""
+    if model_path.endswith(".onnx"):
+        return model_path
+    from ultralytics import YOLO
+    logger.info(f"正在导出ONNX模型: {model_path}")
+    return YOLO(model_path).export(format="onnx", imgsz=imgsz, dynamic=False, simplify=True)
+
+
+def quantize_int8(fp32_path, output_path, calibration_images, imgsz=640, per_channel=True):
+    """
+    CPU INT8 训练后静态量化（QDQ格式）
+
+    检测头的输出拼接节点保持浮点，避免坐标解码精度损失。
+    """
+    import onnx
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared_path = output_path.replace(".onnx", "_prep.onnx")
+    quant_pre_process(fp32_path, prepared_path, skip_symbolic_shape=True)
+
+    input_name = ort.InferenceSession(prepared_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    graph = onnx.load(prepared_path).graph
+    # 最后几个 Concat 是检测头的框/类别输出，保留 FP32
+    exclude = [node.name for node in graph.node if node.op_type == "Concat"][-3:]
+
+    logger.info(f"INT8 量化: 校准图片 {len(calibration_images)} 张")
+    quantize_static(
+        prepared_path,
+        output_path,
+        CalibrationReader(calibration_images, input_name, imgsz),
+        quant_format=QuantFormat.QDQ,
+        per_channel=per_channel,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_exclude=exclude,
+    )
+    os.remove(prepared_path)
+    return output_path
+
+
+def convert_fp16(fp32_path, output_path):
+    """权重与计算转为 FP16（输入输出保持 FP32）"""
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = convert_float_to_float16(onnx.load(fp32_path), keep_io_types=True)
+    onnx.save(model, output_path)
+    return output_path
+
+
+def validate_map(model_path, data_yaml, imgsz=640, device="cpu"):
+    """在验证集上计算 mAP"""
+    from ultralytics import YOLO
+    metrics = YOLO(model_path, task="detect").val(data=data_yaml, imgsz=imgsz, batch=1, device=device,
+                                                  plots=False, verbose=False)
+    return {"map50": float(metrics.box.map50), "map50_95": float(metrics.box.map)}
+
+
+def measure_latency(model_path, image_paths, imgsz=640, device="cpu", iterations=50, warmup=5):
+    """
+    测量模型延迟与内存占用
+
+    Returns:
+        dict: 平均/中位/p95 延迟(ms)、加载后常驻内存增量(MB)
+    """
+    from ultralytics import YOLO
+    import psutil
+
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    model = YOLO(model_path, task="detect")
+    images = [Image.open(p).convert('RGB') for p in image_paths[:min(len(image_paths), 10)]]
+    if not images:
+        images = [Image.new('RGB', (imgsz, imgsz), color='white')]
+
+    for i in range(warmup):
+        model(images[i % len(images)], imgsz=imgsz, device=device, verbose=False)
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        model(images[i % len(images)], imgsz=imgsz, device=device, verbose=False)
+        times.append((time.perf_counter() - start) * 1000)
+    rss_after = process.memory_info().rss
+
+    return {
+        "latency_ms": float(np.mean(times)),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "rss_mb": (rss_after - rss_before) / 1024 / 1024,
+    }
+
+
+def build_variants(model_path, calib_dir, data_yaml, precisions=("int8",), imgsz=640, calib_size=200,
+                   tolerance=0.01, registry_path=None, seed=0):
+    """
+    量化流程：导出基线 -> 量化 -> mAP 验证 -> 测速 -> 注册
+
+    Args:
+        model_path (str): .pt 或 .onnx 模型
+        calib_dir (str): 校准图片目录
+        data_yaml (str): ultralytics 数据集配置（用于 mAP 验证）
+        precisions (tuple): 要生成的精度
+        imgsz (int): 输入尺寸
+        calib_size (int): 校准图片数量
+        tolerance (float): 允许的 mAP50-95 绝对下降
+        registry_path (str): 注册表路径
+
+    Returns:
+        dict: 更新后的注册表
+    """
+    registry_path = registry_path or default_registry_path(model_path)
+    registry = load_registry(registry_path)
+
+    all_images = list_images(calib_dir)
+    if not all_images:
+        raise FileNotFoundError(f"校准目录中没有图片: {calib_dir}")
+    rng = np.random.RandomState(seed)
+    calibration = [all_images[i] for i in rng.permutation(len(all_images))[:calib_size]]
+
+    fp32_path = export_onnx(model_path, imgsz)
+    baseline = validate_map(fp32_path, data_yaml, imgsz)
+    logger.info(f"FP32 基线 mAP50-95: {baseline['map50_95']:.4f}")
+
+    base, _ = os.path.splitext(fp32_path)
+    for precision in ("fp32",) + tuple(p for p in precisions if p != "fp32"):
+        start = time.time()
+        if precision == "fp32":
+            path, metrics = fp32_path, baseline
+        else:
+            path = f"{base}{VARIANT_SUFFIX[precision]}.onnx"
+            if precision == "int8":
+                quantize_int8(fp32_path, path, calibration, imgsz)
+            elif precision == "fp16":
+                convert_fp16(fp32_path, path)
+            else:
+                raise ValueError(f"不支持的精度: {precision}")
+            metrics = validate_map(path, data_yaml, imgsz)
+
+        map_drop = baseline["map50_95"] - metrics["map50_95"]
+        performance = measure_latency(path, calibration, imgsz)
+        registry["variants"][precision] = {
+            "path": os.path.relpath(path, os.path.dirname(os.path.abspath(registry_path))),
+            "precision": precision,
+            "device": "cpu",
+            "imgsz": imgsz,
+            **metrics,
+            "baseline_map50_95": baseline["map50_95"],
+            "map_drop": map_drop,
+            "tolerance": tolerance,
+            "accepted": map_drop <= tolerance,
+            **performance,
+            "calibration_images": len(calibration) if precision == "int8" else 0,
+            "build_time_s": time.time() - start,
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+        status = "通过" if map_drop <= tolerance else "未通过"
+        logger.info(f"{precision}: mAP50-95 {metrics['map50_95']:.4f} (下降 {map_drop:.4f}, {status}), "
+                    f"延迟 {performance['latency_ms']:.1f}ms, p95 {performance['p95_ms']:.1f}ms")
+
+    save_registry(registry_path, registry)
+    return registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YOLO 模型量化与精度验证")
+    parser.add_argument("--model", required=True, help=".pt 或 .onnx 模型路径")
+    parser.add_argument("--calib-dir", required=True, help="校准图片目录")
+    parser.add_argument("--data", required=True, help="ultralytics 数据集yaml，用于 mAP 验证")
+    parser.add_argument("--precisions", default="int8", help="逗号分隔: int8,fp16")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--calib-size", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="允许的 mAP50-95 绝对下降")
+    parser.add_argument("--registry", default=None, help="注册表路径，默认与模型同目录")
+    args = parser.parse_args()
+
+    registry = build_variants(args.model, args.calib_dir, args.data, tuple(args.precisions.split(",")),
+                              args.imgsz, args.calib_size, args.tolerance, args.registry)
+    print(json.dumps(registry, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import io
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 与 ultralytics 默认一致的检测框配色 (RGB)
+DETECTION_PALETTE = (
+    "FF3838", "FF9D97", "FF701F", "FFB21D", "CFD231", "48F90A", "92CC17", "3DDB86", "1A9334", "00D4BB",
+    "2C99A8", "00C2FF", "344593", "6473FF", "0018EC", "8438FF", "520085", "CB38FF", "FF95C8", "FF37C7",
+)
+
+# UNet 三分类掩膜配色：背景/肝脏/肿瘤
+SEGMENTATION_PALETTE = ((0, 0, 0), (0, 200, 0), (230, 30, 30))
+
+
+@lru_cache(maxsize=8)
+def detection_lut(num_classes=256):
+    """检测类别 -> RGB 颜色查找表 (num_classes, 3)"""
+    base = np.array([[int(h[i:i + 2], 16) for i in (0, 2, 4)] for h in DETECTION_PALETTE], dtype=np.uint8)
+    lut = base[np.arange(num_classes) % len(base)]
+    lut.flags.writeable = False
+    return lut
+
+
+@lru_cache(maxsize=8)
+def segmentation_lut(palette=SEGMENTATION_PALETTE):
+    """
+    分割类别 -> RGB 颜色查找表 (256, 3)
+
+    未在调色板中的类别按固定随机色补齐，保证任意 uint8 掩膜都可直接索引。
+    """
+    rng = np.random.RandomState(0)
+    lut = rng.randint(0, 256, size=(256, 3)).astype(np.uint8)
+    lut[:len(palette)] = np.asarray(palette, dtype=np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def to_rgb_array(image):
+    """PIL.Image 或数组统一为连续的 uint8 RGB 数组"""
+    if isinstance(image, Image.Image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return np.asarray(image, dtype=np.uint8).copy()
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], 3, axis=2)
+    return np.ascontiguousarray(image)
+
+
+def blend_mask(canvas, mask, alpha=0.5, lut=None, classes=None):
+    """
+    在 uint8 画布上原地叠加类别掩膜
+
+    只对前景像素做整数定点混合，背景像素不参与计算。
+
+    Args:
+        canvas (np.ndarray): uint8 RGB 画布 (H, W, 3)，原地修改
+        mask (np.ndarray): uint8 类别掩膜 (H, W)
+        alpha (float): 掩膜不透明度 0~1
+        lut (np.ndarray): 类别颜色表，默认为分割配色
+        classes (iterable): 只显示这些类别，None 表示全部
+
+    Returns:
+        np.ndarray: 画布本身
+    """
+    if mask.shape != canvas.shape[:2]:
+        mask = cv2.resize(mask, (canvas.shape[1], canvas.shape[0]), interpolation=cv2.INTER_NEAREST)
+    lut = segmentation_lut() if lut is None else lut
+
+    if classes is None:
+        selected = mask > 0
+    else:
+        visible = np.zeros(256, dtype=bool)
+        visible[[c for c in classes if 0 < c < 256]] = True
+        selected = visible[mask]
+    if not selected.any():
+        return canvas
+
+    a = int(round(alpha * 256))
+    pixels = canvas[selected].astype(np.uint16)
+    colors = lut[mask[selected]].astype(np.uint16)
+    canvas[selected] = ((pixels * (256 - a) + colors * a) >> 8).astype(np.uint8)
+    return canvas
+
+
+def draw_detections(canvas, detections, show_labels=True, show_conf=True, classes=None,
+                    line_width=None, font_scale=None):
+    """
+    在 uint8 画布上原地绘制检测框
+
+    Args:
+        canvas (np.ndarray): uint8 RGB 画布 (H, W, 3)，原地修改
+        detections (dict): 结构化检测结果，含 boxes/scores/classes/names
+        show_labels (bool): 是否显示标签
+        show_conf (bool): 是否显示置信度
+        classes (iterable): 只显示这些类别，None 表示全部
+        line_width (int): 线宽，默认按图片宽度自适应
+        font_scale (float): 字体缩放，默认按线宽自适应
+
+    Returns:
+        np.ndarray: 画布本身
+    """
+    boxes = detections["boxes"]
+    if len(boxes) == 0:
+        return canvas
+
+    cls_ids = detections["classes"]
+    keep = np.ones(len(boxes), dtype=bool) if classes is None else np.isin(cls_ids, list(classes))
+    if not keep.any():
+        return canvas
+
+    width = canvas.shape[1]
+    lw = line_width or max(1, min(3, width // 500))
+    fs = font_scale or lw / 3
+    tf = max(lw - 1, 1)
+    lut = detection_lut()
+    names = detections.get("names", {})
+    boxes_i = boxes[keep].round().astype(np.int32)
+    scores = detections["scores"][keep]
+    cls_ids = cls_ids[keep]
+
+    for (x1, y1, x2, y2), score, cls in zip(boxes_i, scores, cls_ids):
+        color = tuple(int(c) for c in lut[int(cls) % len(lut)])
+        cv2.rectangle(canvas, (x1, y1), (x2, y2), color, lw, cv2.LINE_AA)
+        if not (show_labels or show_conf):
+            continue
+        text = names.get(int(cls), str(int(cls))) if show_labels else ""
+        if show_conf:
+            text = f"{text} {score:.2f}".strip()
+        (tw, th), _ = cv2.getTextSize(text, 0, fs, tf)
+        outside = y1 - th - 3 >= 0
+        ty2 = y1 - th - 3 if outside else y1 + th + 3
+        cv2.rectangle(canvas, (x1, y1), (x1 + tw, ty2), color, -1, cv2.LINE_AA)
+        cv2.putText(canvas, text, (x1, y1 - 2 if outside else y1 + th + 2), 0, fs,
+                    (255, 255, 255), tf, cv2.LINE_AA)
+    return canvas
+
+
+# OpenCV 编码器的扩展名与质量参数
+CV2_FORMATS = {
+    "JPEG": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "WEBP": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+    "PNG": (".png", None),
+}
+
+
+def encode_image(image, fmt="JPEG", quality=90, encoder="pil", **options):
+    """
+    RGB 数组编码为图片字节
+
+    Args:
+        image (np.ndarray): uint8 RGB 数组
+        fmt (str): JPEG / PNG / WEBP
+        quality (int): JPEG/WEBP 质量
+        encoder (str): "pil" 或 "cv2"（libjpeg-turbo，JPEG 编码通常更快）
+        **options: 传给 PIL 的额外参数（如 optimize、progressive、compress_level）
+    """
+    fmt = fmt.upper()
+    if encoder == "cv2":
+        ext, quality_flag = CV2_FORMATS[fmt]
+        params = [quality_flag, int(quality)] if quality_flag is not None else \
+            [cv2.IMWRITE_PNG_COMPRESSION, int(options.get("compress_level", 1))]
+        ok, buffer = cv2.imencode(ext, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+        if not ok:
+            raise ValueError(f"图片编码失败: {fmt}")
+        return buffer.tobytes()
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format=fmt, quality=quality, **options)
+    return buffer.getvalue()
+
+
+class OverlayRenderer:
+    """
+    叠加渲染器
+
+    缓存底图和结构化结果（检测框或分割掩膜），切换标签、置信度、
+    类别等显示选项时只从底图重新绘制，不再调用模型。
+    """
+
+    def __init__(self, base_image, detections=None, mask=None, cache_size=4):
+        """
+        Args:
+            base_image: 原始图片 (PIL.Image 或 RGB 数组)
+            detections (dict): 检测结果，见 PCBInference.detect
+            mask (np.ndarray): 分割类别掩膜
+            cache_size (int): 缓存的渲染结果数量
+        """
+        self.base = to_rgb_array(base_image)
+        self.base.flags.writeable = False
+        self.detections = detections
+        self.mask = None if mask is None else np.asarray(mask, dtype=np.uint8)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @property
+    def size(self):
+        return self.base.shape[1], self.base.shape[0]
+
+    @property
+    def nbytes(self):
+        """内存占用上限估算：底图、掩膜及渲染缓存"""
+        mask_bytes = 0 if self.mask is None else self.mask.nbytes
+        return self.base.nbytes * (1 + self.cache_size) + mask_bytes
+
+    def __getstate__(self):
+        # 渲染缓存可随时重建，序列化（溢出到磁盘）时不保存
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+    def class_names(self):
+        """当前结果中出现的类别 {id: name}"""
+        if self.detections is not None:
+            names = self.detections.get("names", {})
+            return {int(c): names.get(int(c), str(int(c))) for c in np.unique(self.detections["classes"])}
+        if self.mask is not None:
+            return {int(c): str(int(c)) for c in np.unique(self.mask) if c > 0}
+        return {}
+
+    def render(self, show_labels=True, show_conf=True, classes=None, alpha=0.5):
+        """
+        按显示选项渲染
+
+        Returns:
+            np.ndarray: 只读的 uint8 RGB 渲染结果
+        """
+        key = (show_labels, show_conf, None if classes is None else tuple(sorted(classes)), alpha)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+
+        canvas = self.base.copy()
+        if self.mask is not None:
+            blend_mask(canvas, self.mask, alpha=alpha, classes=classes)
+        if self.detections is not None:
+            draw_detections(canvas, self.detections, show_labels, show_conf, classes)
+        canvas.flags.writeable = False
+
+        self._cache[key] = canvas
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return canvas
+
+    def render_bytes(self, fmt="JPEG", quality=90, **options):
+        return encode_image(self.render(**options), fmt=fmt, quality=quality)
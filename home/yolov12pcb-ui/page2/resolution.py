@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from quantize import list_images
+from detpost import box_iou
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 预热的候选推理尺寸，必须是模型步长(32)的倍数
+DEFAULT_SIZES = (320, 640, 960, 1280)
+
+
+class AdaptiveResolution:
+    """
+    自适应推理尺寸策略
+
+    按图片尺寸和缺陷尺度在候选尺寸中选择最小的够用尺寸：
+    - 小图（ROI裁剪）不放大到固定 640，选不小于图片长边的最小候选尺寸；
+    - 大图保证最小缺陷缩放到网络输入后仍不小于 min_object_px 像素。
+    缺陷尺度可以固定给出，也可以根据最近的检测结果自动估计。
+    """
+
+    def __init__(self, sizes=DEFAULT_SIZES, defect_px=None, min_object_px=8, refine_band=(0.3, 0.4),
+                 refine_small_px=12, history=200, default_size=640):
+        """
+        Args:
+            sizes (tuple): 候选推理尺寸（升序）
+            defect_px (float): 原图中最小缺陷的预估边长，None 表示从检测结果估计
+            min_object_px (int): 缺陷在网络输入上的最小可检测边长
+            refine_band (tuple): 两阶段推理时，置信度落在该区间的检测会触发精细推理；
+                区间应窄且略高于置信度阈值，否则几乎每个结果都会复查
+            refine_small_px (int): 两阶段推理时，网络输入上小于该边长的检测会触发精细推理
+            history (int): 估计缺陷尺度时保留的最近检测框数量
+            default_size (int): 尚无缺陷尺度估计时的首选尺寸（配置或主机画像中的 imgsz）
+        """
+        self.candidates = tuple(sorted(sizes))
+        self.sizes = self.candidates
+        self.default_size = default_size
+        self.defect_px = defect_px
+        self.min_object_px = min_object_px
+        self.refine_band = refine_band
+        self.refine_small_px = refine_small_px
+        self._observed = []
+        self._history = history
+        self._lock = threading.Lock()
+
+    def estimated_defect_px(self):
+        """当前估计的最小缺陷边长（原图像素），取最近检测框短边的 10% 分位"""
+        if self.defect_px is not None:
+            return self.defect_px
+        with self._lock:
+            if len(self._observed) < 10:
+                return None
+            return float(np.percentile(self._observed, 10))
+
+    def observe(self, detections):
+        """记录检测框尺寸，用于估计缺陷尺度"""
+        boxes = detections["boxes"]
+        if len(boxes) == 0 or self.defect_px is not None:
+            return
+        short_side = np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        with self._lock:
+            self._observed.extend(short_side.tolist())
+            del self._observed[:-self._history]
+
+    def select(self, image_size):
+        """
+        Args:
+            image_size (tuple): 图片尺寸 (宽, 高)
+
+        Returns:
+            int: 推理尺寸
+        """
+        sizes = self.sizes
+        if not sizes:
+            raise RuntimeError(f"没有已预热的推理尺寸（候选: {list(self.candidates)}）")
+        long_side = max(image_size)
+        # 不放大：不小于长边的最小候选尺寸即可
+        fits = [s for s in sizes if s >= long_side]
+        upper = fits[0] if fits else sizes[-1]
+
+        defect_px = self.estimated_defect_px()
+        if defect_px is None:
+            return min(upper, self.default_size) if self.default_size in sizes else upper
+        for size in sizes:
+            if size > upper:
+                break
+            if defect_px * size / long_side >= self.min_object_px:
+                return size
+        return upper
+
+    def restrict(self, sizes):
+        """只在已预热的尺寸中选择"""
+        self.sizes = tuple(s for s in self.candidates if s in sizes)
+
+    def next_size(self, size):
+        """比 size 大一级的候选尺寸，已是最大时返回 None"""
+        larger = [s for s in self.sizes if s > size]
+        return larger[0] if larger else None
+
+    def needs_refine(self, detections, image_size, imgsz):
+        """粗推理结果是否需要在更大尺寸上复查"""
+        boxes = detections["boxes"]
+        if len(boxes) == 0:
+            return False
+        low, high = self.refine_band
+        scores = detections["scores"]
+        if np.any((scores >= low) & (scores < high)):
+            return True
+        scale = imgsz / max(image_size)
+        short_side = np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) * scale
+        return bool(np.any(short_side < self.refine_small_px))
+
+
+def benchmark_resolutions(inference, images, sizes=DEFAULT_SIZES, conf_threshold=0.25, match_iou=0.5,
+                          repeats=3):
+    """
+    各推理尺寸的延迟 / 召回对比
+
+    没有人工标注时，以最大尺寸的检测结果作为参考，计算各尺寸的相对召回。
+
+    Args:
+        inference (PCBInference): 推理器
+        images (list): 测试图片
+        sizes (tuple): 要比较的尺寸
+        conf_threshold (float): 置信度阈值
+        match_iou (float): 与参考结果匹配的 IoU 阈值
+        repeats (int): 每张图重复次数（取中位数）
+
+    Returns:
+        list: 每个尺寸一个字典：latency_ms / p95_ms / recall / detections
+    """
+    sizes = tuple(sorted(sizes))
+    reference = {}
+    results = {size: {"times": [], "matched": 0, "detections": 0} for size in sizes}
+
+    for index, image_input in enumerate(images):
+        image = inference.preprocess_image(image_input)
+        for size in reversed(sizes):
+            times = []
+            for _ in range(repeats):
+                _, detections = inference.detect(image, conf_threshold, imgsz=size)
+                times.append(detections["timings"]["inference"] * 1000)
+            results[size]["times"].append(float(np.median(times)))
+            results[size]["detections"] += len(detections["boxes"])
+            if size == sizes[-1]:
+                reference[index] = detections
+                results[size]["matched"] += len(detections["boxes"])
+                continue
+            ref = reference[index]
+            iou = box_iou(ref["boxes"], detections["boxes"])
+            iou = np.where(ref["classes"][:, None] == detections["classes"][None, :], iou, 0.0)
+            if iou.size:
+                results[size]["matched"] += int((iou.max(axis=1) >= match_iou).sum())
+
+    total_reference = sum(len(d["boxes"]) for d in reference.values())
+    report = []
+    for size in sizes:
+        times = results[size]["times"]
+        report.append({
+            "imgsz": size,
+            "latency_ms": float(np.mean(times)) if times else 0.0,
+            "p95_ms": float(np.percentile(times, 95)) if times else 0.0,
+            "detections": results[size]["detections"],
+            "recall": results[size]["matched"] / total_reference if total_reference else 1.0,
+        })
+    return report
+
+
+def main():
+    from inference import PCBInference
+
+    parser = argparse.ArgumentParser(description="推理尺寸延迟/召回对比")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True, help="测试图片目录")
+    parser.add_argument("--sizes", default="320,640,960,1280")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    sizes = tuple(int(s) for s in args.sizes.split(","))
+    inference = PCBInference(args.model, device=args.device, imgsz="auto", imgsz_options=sizes)
+    start = time.time()
+    report = benchmark_resolutions(inference, list_images(args.images, args.limit), sizes)
+    for row in report:
+        print(f"imgsz={row['imgsz']:>5}  延迟: {row['latency_ms']:.1f}ms  p95: {row['p95_ms']:.1f}ms  "
+              f"召回: {row['recall']:.3f}  检测数: {row['detections']}")
+    print(json.dumps({"report": report, "elapsed_s": time.time() - start}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
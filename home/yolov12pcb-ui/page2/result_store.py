@@ -0,0 +1,262 @@
+import os
+import pickle
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _sizeof(obj):
+    """估算对象占用的内存字节数"""
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return len(obj)
+    if isinstance(obj, str):
+        return len(obj.encode("utf-8"))
+    return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+# derive 区分"派生产物不存在"与"派生产物为 None"
+_MISSING = object()
+
+
+class _Entry:
+    __slots__ = ("value", "nbytes", "path", "spilled", "refs", "last_access", "parent", "children")
+
+    def __init__(self, value, nbytes, parent=None):
+        self.value = value
+        self.nbytes = nbytes
+        self.path = None
+        # 是否已溢出到磁盘（value 本身可以是 None，不能用它判断）
+        self.spilled = False
+        self.refs = 0
+        self.last_access = time.time()
+        self.parent = parent
+        self.children = set()
+
+
+class ResultStore:
+    """
+    进程级结果仓库
+
+    所有会话共享一个全局内存预算，超出预算时按 LRU 把结果溢出到磁盘，
+    会话状态里只保存短小的句柄字符串。派生产物（缩略图、下载文件等）
+    按需生成，挂在父结果下，随父结果一起释放。
+    """
+
+    def __init__(self, memory_budget=512 * 1024 * 1024, spill_dir=None, max_idle=8 * 3600):
+        """
+        Args:
+            memory_budget (int): 全局内存预算（字节）
+            spill_dir (str): 溢出目录，默认为临时目录
+            max_idle (float): 超过该秒数未访问的结果无论引用计数都会被清除，
+                              用于回收已断开会话遗留的结果
+        """
+        self.memory_budget = memory_budget
+        self.max_idle = max_idle
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="pcb_results_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._entries = {}
+        self._lru = OrderedDict()  # 仅包含驻留内存的条目
+        self._memory_used = 0
+        self._lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "spills": 0, "loads": 0, "evictions": 0}
+
+    # --- 基本操作 ---
+    def put(self, value, nbytes=None, acquire=True):
+        """
+        存入结果
+
+        Args:
+            value: 任意可 pickle 的对象
+            nbytes (int): 内存占用，默认自动估算
+            acquire (bool): 是否同时增加一次引用
+
+        Returns:
+            str: 结果句柄
+        """
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self._insert(handle, value, nbytes)
+            if acquire:
+                self._entries[handle].refs += 1
+            self._enforce_budget()
+        return handle
+
+    def get(self, handle, default=None):
+        """按句柄读取结果，已溢出的结果会重新载入内存"""
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            entry.last_access = time.time()
+            if entry.spilled:
+                self._load(handle, entry)
+                self._enforce_budget(keep=handle)
+            else:
+                self.stats["hits"] += 1
+                self._lru.move_to_end(handle)
+            return entry.value
+
+    def __contains__(self, handle):
+        with self._lock:
+            return handle in self._entries
+
+    def acquire(self, handle):
+        """增加引用计数"""
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                return False
+            entry.refs += 1
+            entry.last_access = time.time()
+            return True
+
+    def release(self, handle):
+        """减少引用计数，归零时删除结果及其派生产物"""
+        if handle is None:
+            return
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                self._remove(handle)
+
+    def replace(self, old_handle, value, nbytes=None):
+        """释放旧句柄并存入新结果，返回新句柄"""
+        self.release(old_handle)
+        return self.put(value, nbytes)
+
+    # --- 派生产物 ---
+    def derive(self, handle, name, factory, nbytes=None):
+        """
+        获取派生产物，不存在时调用 factory 生成
+
+        Args:
+            handle (str): 父结果句柄
+            name: 派生产物名称（可哈希）
+            factory (callable): factory(父结果) -> 派生产物
+
+        Returns:
+            派生产物；父结果不存在时返回 None
+        """
+        child = f"{handle}:{name}"
+        cached = self.get(child, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        parent = self.get(handle)
+        if parent is None:
+            return None
+        value = factory(parent)
+        with self._lock:
+            if handle not in self._entries:
+                return value
+            if child not in self._entries:
+                self._insert(child, value, nbytes, parent=handle)
+                self._entries[handle].children.add(child)
+                self._enforce_budget(keep=child)
+        return value
+
+    # --- 维护 ---
+    def collect(self):
+        """清除长时间未访问的结果，返回清除数量"""
+        cutoff = time.time() - self.max_idle
+        with self._lock:
+            stale = [h for h, e in self._entries.items() if e.parent is None and e.last_access < cutoff]
+            for handle in stale:
+                self._remove(handle)
+        if stale:
+            logger.info(f"清除过期结果 {len(stale)} 个")
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            for handle in [h for h, e in self._entries.items() if e.parent is None]:
+                self._remove(handle)
+
+    def close(self):
+        self.clear()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def info(self):
+        """仓库状态统计"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "resident": len(self._lru),
+                "memory_used": self._memory_used,
+                "memory_budget": self.memory_budget,
+                "spilled": sum(1 for e in self._entries.values() if e.spilled),
+                **self.stats,
+            }
+
+    # --- 内部实现（调用方需持有锁） ---
+    def _insert(self, handle, value, nbytes, parent=None):
+        nbytes = _sizeof(value) if nbytes is None else nbytes
+        self._entries[handle] = _Entry(value, nbytes, parent)
+        self._lru[handle] = None
+        self._memory_used += nbytes
+
+    def _enforce_budget(self, keep=None):
+        while self._memory_used > self.memory_budget and len(self._lru) > (1 if keep else 0):
+            handle = next(iter(self._lru))
+            if handle == keep:
+                self._lru.move_to_end(handle)
+                continue
+            entry = self._entries[handle]
+            if entry.parent is not None:
+                # 派生产物可随时重新生成，直接丢弃
+                self._remove(handle)
+                self.stats["evictions"] += 1
+            else:
+                self._spill(handle, entry)
+
+    def _spill(self, handle, entry):
+        if entry.path is None:
+            path = os.path.join(self.spill_dir, f"{handle}.pkl")
+            with open(path, "wb") as f:
+                pickle.dump(entry.value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            entry.path = path
+        entry.value = None
+        entry.spilled = True
+        del self._lru[handle]
+        self._memory_used -= entry.nbytes
+        self.stats["spills"] += 1
+
+    def _load(self, handle, entry):
+        with open(entry.path, "rb") as f:
+            entry.value = pickle.load(f)
+        entry.spilled = False
+        self._lru[handle] = None
+        self._memory_used += entry.nbytes
+        self.stats["loads"] += 1
+
+    def _remove(self, handle):
+        entry = self._entries.pop(handle, None)
+        if entry is None:
+            return
+        for child in list(entry.children):
+            self._remove(child)
+        if entry.parent is not None and entry.parent in self._entries:
+            self._entries[entry.parent].children.discard(handle)
+        if handle in self._lru:
+            del self._lru[handle]
+            self._memory_used -= entry.nbytes
+        if entry.path is not None:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,272 @@
+import argparse
+import copy
+import json
+import logging
+import time
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 本地规则分析：直接根据结构化检测结果给出结论和模板化报告，不调用 Dify。
+# 规则明确时（确信缺陷超出容限 / 所有检测都在容限内）直接出结论；
+# 结论取决于低置信度检测时判为 "unknown"，交给 Dify 工作流复核。
+
+SEVERITY_LABELS = {"critical": "严重", "major": "一般", "minor": "轻微"}
+
+# 各严重等级的默认容限：max_count 为允许的最多处数，max_area_ratio 为该类缺陷总面积占整板面积的上限
+SEVERITY_LIMITS = {
+    "critical": {"max_count": 0, "max_area_ratio": 0.0},
+    "major": {"max_count": 1, "max_area_ratio": 0.002},
+    "minor": {"max_count": 3, "max_area_ratio": 0.005},
+}
+
+DEFAULT_RULES = {
+    # 低于 ignore_conf 的检测视为噪声；介于 ignore_conf 与 confirm_conf 之间的检测为"存疑"
+    "ignore_conf": 0.25,
+    "confirm_conf": 0.5,
+    "classes": {
+        "missing_hole": {"label": "缺孔", "severity": "critical"},
+        "open_circuit": {"label": "开路", "severity": "critical"},
+        "short": {"label": "短路", "severity": "critical"},
+        "mouse_bite": {"label": "鼠咬", "severity": "major"},
+        "spurious_copper": {"label": "残铜", "severity": "major"},
+        "spur": {"label": "毛刺", "severity": "minor"},
+    },
+    # 未配置的类别
+    "default": {"severity": "major"},
+    # 板面区域规则：box 为相对整板的归一化坐标 [x1, y1, x2, y2]，按顺序取第一个包含检测框中心的区域；
+    # action 为 "ignore"（忽略该区域内的检测）或 "critical"（该区域内的缺陷一律按严重处理），
+    # 可选 name 为报告中显示的区域名称（缺省时显示坐标），classes 限定类别、board_type 限定板型
+    "regions": [],
+}
+
+
+def region_name(region):
+    """区域在报告中的名称，未配置 name 时使用归一化坐标"""
+    return region.get("name") or "区域[" + ", ".join(f"{v:g}" for v in region["box"]) + "]"
+
+
+class RuleAnalyzer:
+    """
+    基于规则的本地分析器
+
+    规则按类别配置严重等级、置信度和数量/面积容限，并支持按板面区域忽略或加严。
+    """
+
+    def __init__(self, rules=None):
+        """
+        Args:
+            rules (dict): 规则配置，缺省项使用 DEFAULT_RULES
+        """
+        self.rules = copy.deepcopy(DEFAULT_RULES)
+        for key, value in (rules or {}).items():
+            if key == "classes":
+                self.rules["classes"].update(value)
+            else:
+                self.rules[key] = value
+        self.stats = {"analyzed": 0, "defect": 0, "pass": 0, "unknown": 0, "time": 0.0}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.rules, f, ensure_ascii=False, indent=2)
+
+    def class_rule(self, name):
+        """类别规则，未配置的容限按严重等级补齐"""
+        rule = dict(self.rules["default"], label=name)
+        rule.update(self.rules["classes"].get(name, {}))
+        limits = SEVERITY_LIMITS[rule["severity"]]
+        rule.setdefault("max_count", limits["max_count"])
+        rule.setdefault("max_area_ratio", limits["max_area_ratio"])
+        rule.setdefault("min_conf", self.rules["ignore_conf"])
+        return rule
+
+    def _region(self, name, cx, cy, board_type):
+        for region in self.rules["regions"]:
+            if region.get("board_type") not in (None, board_type):
+                continue
+            if region.get("classes") and name not in region["classes"]:
+                continue
+            x1, y1, x2, y2 = region["box"]
+            if x1 <= cx <= x2 and y1 <= cy <= y2:
+                return region
+        return None
+
+    def analyze(self, detections, image_size=None, board_type=None):
+        """
+        分析一块板的检测结果
+
+        Args:
+            detections (dict): 检测结果，见 PCBInference.detect
+            image_size (tuple): 图片尺寸 (宽, 高)，用于面积比例与区域规则；为 None 时不做这两项判断
+            board_type (str): 板型，用于筛选区域规则
+
+        Returns:
+            dict: success、source ("rules")、verdict（"defect" / "pass" / "unknown"）、
+                  findings（按类别汇总）、reasons、analysis_text、time_ms
+        """
+        start = time.perf_counter()
+        names = detections.get("names", {})
+        boxes = np.asarray(detections["boxes"], dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(detections["scores"], dtype=np.float32)
+        classes = np.asarray(detections["classes"]).astype(int)
+        if image_size is not None:
+            width, height = image_size
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) / float(width * height)
+            centers = np.stack([(boxes[:, 0] + boxes[:, 2]) / (2 * width),
+                                (boxes[:, 1] + boxes[:, 3]) / (2 * height)], axis=1)
+        else:
+            areas = np.zeros(len(boxes), dtype=np.float32)
+            centers = None
+
+        # 按类别归组：确信检测与存疑检测分开计数
+        groups = {}
+        ignored = 0
+        for i in range(len(boxes)):
+            name = names.get(classes[i], str(classes[i]))
+            rule = self.class_rule(name)
+            score = float(scores[i])
+            if score < rule["min_conf"]:
+                continue
+            region = self._region(name, *centers[i], board_type) if centers is not None and \
+                self.rules["regions"] else None
+            if region is not None and region["action"] == "ignore":
+                ignored += 1
+                continue
+            key = (name, region_name(region) if region is not None else None)
+            group = groups.get(key)
+            if group is None:
+                group = {"class_name": name, "label": rule["label"], "region": key[1],
+                         "severity": "critical" if region is not None else rule["severity"],
+                         "max_count": 0 if region is not None else rule["max_count"],
+                         "max_area_ratio": 0.0 if region is not None else rule["max_area_ratio"],
+                         "confirmed": 0, "uncertain": 0, "confirmed_area": 0.0, "area": 0.0, "max_conf": 0.0}
+                groups[key] = group
+            confirmed = score >= self.rules["confirm_conf"]
+            group["confirmed" if confirmed else "uncertain"] += 1
+            group["area"] += float(areas[i])
+            if confirmed:
+                group["confirmed_area"] += float(areas[i])
+            group["max_conf"] = max(group["max_conf"], score)
+
+        # 确信检测已超出容限 -> 缺陷；加上存疑检测才超出 -> 无法确定
+        reasons, ambiguous = [], []
+        for group in groups.values():
+            count = group["confirmed"] + group["uncertain"]
+            check_area = image_size is not None and group["severity"] != "critical"
+            if group["confirmed"] > group["max_count"]:
+                group["status"], group["exceeded"] = "reject", "count"
+            elif check_area and group["confirmed_area"] > group["max_area_ratio"]:
+                group["status"], group["exceeded"] = "reject", "area"
+            elif count > group["max_count"] or (check_area and group["area"] > group["max_area_ratio"]):
+                group["status"] = "uncertain"
+            else:
+                group["status"] = "within_limit"
+            if group["status"] == "reject":
+                reasons.append(group)
+            elif group["status"] == "uncertain":
+                ambiguous.append(group)
+        if reasons:
+            verdict = "defect"
+        elif ambiguous:
+            verdict = "unknown"
+        else:
+            verdict = "pass"
+
+        findings = sorted(groups.values(), key=lambda g: (list(SEVERITY_LABELS).index(g["severity"]),
+                                                          -g["confirmed"] - g["uncertain"]))
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stats["analyzed"] += 1
+        self.stats[verdict] += 1
+        self.stats["time"] += elapsed
+        return {"success": True, "source": "rules", "verdict": verdict, "findings": findings,
+                "reasons": [g["class_name"] for g in reasons], "ignored": ignored,
+                "analysis_text": render_report(verdict, findings, ignored), "time_ms": elapsed}
+
+
+def _describe(group):
+    text = f"{group['label']} {group['confirmed'] + group['uncertain']} 处"
+    details = [f"{SEVERITY_LABELS[group['severity']]}", f"最高置信度 {group['max_conf']:.2f}"]
+    if group["region"]:
+        details.insert(0, f"位于{group['region']}")
+    if group["uncertain"]:
+        details.append(f"其中 {group['uncertain']} 处置信度偏低")
+    if group["area"]:
+        details.append(f"面积占比 {group['area'] * 100:.2f}%")
+    return f"{text}（{'，'.join(details)}）"
+
+
+def render_report(verdict, findings, ignored=0):
+    """
+    模板化分析报告（HTML 片段，与 Dify 工作流输出的展示方式一致）
+
+    通过的报告不包含"缺陷"等关键词，classify_verdict 对其归类结果与 verdict 一致。
+    """
+    if verdict == "defect":
+        lines = ["<b>判定：发现缺陷，建议拒收。</b>"]
+        lines += [f"• {_describe(g)}，" + (f"超出容限（允许 {g['max_count']} 处）" if g["exceeded"] == "count" else
+                                          f"面积超出容限（上限 {g['max_area_ratio'] * 100:.2f}%）")
+                  for g in findings if g["status"] == "reject"]
+        others = [g for g in findings if g["status"] != "reject"]
+        if others:
+            lines.append("其他检出：" + "；".join(_describe(g) for g in others))
+        lines.append("处理建议：按严重等级安排返修或报废，返修后复检。")
+    elif verdict == "unknown":
+        lines = ["<b>判定：需要复核。</b>", "结论取决于置信度偏低的检出，建议人工或智能分析复核："]
+        lines += [f"• {_describe(g)}" for g in findings if g["status"] == "uncertain"]
+    else:
+        lines = ["<b>判定：检测通过，合格。</b>"]
+        if findings:
+            lines.append("以下检出均在容限内：" + "；".join(
+                f"{g['label']} {g['confirmed'] + g['uncertain']} 处（允许 {g['max_count']} 处）" for g in findings))
+        else:
+            lines.append("未见检出，板面完好。")
+    if ignored:
+        lines.append(f"另有 {ignored} 处检出位于忽略区域，未计入判定。")
+    return "<br>".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地规则分析")
+    parser.add_argument("--rules", default=None, help="规则配置 JSON，不指定时使用默认规则")
+    parser.add_argument("--export-defaults", default=None, help="导出默认规则到指定路径后退出")
+    parser.add_argument("--images", default=None, help="图片目录，不指定时使用模拟检测结果")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--boards", type=int, default=1000, help="模拟检测结果的板数")
+    args = parser.parse_args()
+
+    if args.export_defaults:
+        RuleAnalyzer().save(args.export_defaults)
+        print(f"默认规则已导出: {args.export_defaults}")
+        return
+
+    analyzer = RuleAnalyzer.load(args.rules) if args.rules else RuleAnalyzer()
+    if args.images:
+        from inference import PCBInference
+        from quantize import list_images
+
+        inference = PCBInference(args.model, device=args.device)
+        boards = [(detections, image.size) for _, image, detections in
+                  inference.detect_batch(list_images(args.images)) if image is not None]
+    else:
+        from batch_analysis import _synthetic_boards
+
+        boards = [(board["detections"], (640, 640)) for board in _synthetic_boards(args.boards)]
+
+    for detections, size in boards:
+        analyzer.analyze(detections, size)
+    stats = analyzer.stats
+    print(f"{stats['analyzed']} 块板: 缺陷 {stats['defect']}, 通过 {stats['pass']}, 需复核 {stats['unknown']}, "
+          f"平均 {stats['time'] / max(1, stats['analyzed']):.3f}ms/块")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import argparse
+import concurrent.futures
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from batch_writer import write_batch
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 优先级类别及权重：排队时按权重分配服务份额（加权公平排队）
+PRIORITIES = {"interactive": 8.0, "batch": 2.0, "background": 1.0}
+
+
+def default_limits(capacity):
+    """各类别最多同时占用的执行槽数：批量与后台任务给交互请求至少留一个槽"""
+    return {"interactive": capacity, "batch": max(1, capacity - 1), "background": max(1, capacity // 4)}
+
+
+class _Task:
+    __slots__ = ("priority", "fn", "args", "kwargs", "future", "tag", "submitted")
+
+    def __init__(self, priority, fn, args, kwargs, tag):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.tag = tag
+        self.submitted = time.perf_counter()
+
+
+class _Resource:
+    def __init__(self, name, capacity, limits):
+        self.name = name
+        self.capacity = capacity
+        self.limits = limits
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.last_tag = {priority: 0.0 for priority in PRIORITIES}
+        self.virtual_time = 0.0
+        self.threads = []
+
+
+class Scheduler:
+    """
+    按优先级类别调度模型调用
+
+    每个资源（如检测模型、分割模型）有固定数量的执行槽（通常等于模型副本数），
+    每个槽一个工作线程。排队任务按开始时间公平排队（SFQ）选择：任务标签 =
+    max(资源虚拟时间, 本类别上一个标签) + 代价 / 权重，取标签最小且所在类别未达并发上限的任务。
+    批量任务按批拆分为独立任务逐批提交，批与批之间重新排队，交互请求最多等待一个批次。
+    """
+
+    def __init__(self):
+        self._resources = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._stats = {priority: {"submitted": 0, "completed": 0, "failed": 0, "run_time": 0.0,
+                                  "waits": deque(maxlen=2000)} for priority in PRIORITIES}
+
+    def register(self, name, capacity=1, limits=None):
+        """
+        注册资源
+
+        Args:
+            name (str): 资源名，如 "detection"、"segmentation"
+            capacity (int): 执行槽数量
+            limits (dict): 各类别并发上限，未给出的类别使用 default_limits
+        """
+        if name in self._resources:
+            raise ValueError(f"资源已注册: {name}")
+        resource = _Resource(name, capacity, dict(default_limits(capacity), **(limits or {})))
+        self._resources[name] = resource
+        for n in range(capacity):
+            thread = threading.Thread(target=self._worker, args=(resource,), name=f"{name}-worker-{n}", daemon=True)
+            thread.start()
+            resource.threads.append(thread)
+        logger.info(f"调度资源 {name}: {capacity} 个执行槽, 并发上限 {resource.limits}")
+        return self
+
+    def submit(self, resource, priority, fn, *args, cost=1.0, **kwargs):
+        """
+        提交一个任务
+
+        Args:
+            resource (str): 资源名
+            priority (str): "interactive"、"batch" 或 "background"
+            fn (callable): 任务函数
+            cost (float): 任务代价（如批内图片数），用于公平份额计算
+
+        Returns:
+            concurrent.futures.Future
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知的优先级类别: {priority}")
+        res = self._resources[resource]
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("调度器已关闭")
+            tag = max(res.virtual_time, res.last_tag[priority]) + cost / PRIORITIES[priority]
+            res.last_tag[priority] = tag
+            task = _Task(priority, fn, args, kwargs, tag)
+            res.queues[priority].append(task)
+            self._stats[priority]["submitted"] += 1
+            self._cond.notify_all()
+        return task.future
+
+    def call(self, resource, priority, fn, *args, **kwargs):
+        """提交任务并等待结果"""
+        return self.submit(resource, priority, fn, *args, **kwargs).result()
+
+    def run_batches(self, resource, priority, items, chunk_size, fn, inflight=1):
+        """
+        分批执行批量任务，按输入顺序产出每批的结果
+
+        每批是一个独立任务，同一作业最多 inflight 批同时排队或执行；
+        作业在批与批之间让出执行槽，由调度器决定下一个运行的任务。
+
+        Args:
+            fn (callable): fn(批起始序号, 批内元素列表) -> 结果列表
+        """
+        starts = iter(range(0, len(items), chunk_size))
+        pending = deque()
+
+        def submit_next():
+            start = next(starts, None)
+            if start is not None:
+                chunk = items[start:start + chunk_size]
+                pending.append(self.submit(resource, priority, fn, start, chunk, cost=len(chunk)))
+
+        for _ in range(max(1, inflight)):
+            submit_next()
+        while pending:
+            future = pending.popleft()
+            submit_next()
+            yield from future.result()
+
+    def _pick(self, res):
+        best = None
+        for priority, queue in res.queues.items():
+            if queue and res.running[priority] < res.limits[priority]:
+                if best is None or queue[0].tag < best.tag:
+                    best = queue[0]
+        if best is not None:
+            res.queues[best.priority].popleft()
+            res.running[best.priority] += 1
+            res.virtual_time = best.tag
+        return best
+
+    def _worker(self, res):
+        while True:
+            with self._cond:
+                while True:
+                    task = None if self._stopped else self._pick(res)
+                    if task is not None or self._stopped:
+                        break
+                    self._cond.wait()
+                if task is None:
+                    return
+            start = time.perf_counter()
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.fn(*task.args, **task.kwargs))
+                    failed = False
+                except BaseException as e:
+                    task.future.set_exception(e)
+                    failed = True
+            else:
+                failed = False
+            with self._cond:
+                res.running[task.priority] -= 1
+                stats = self._stats[task.priority]
+                stats["waits"].append(start - task.submitted)
+                stats["run_time"] += time.perf_counter() - start
+                stats["failed" if failed else "completed"] += 1
+                self._cond.notify_all()
+
+    def metrics(self):
+        """各类别的任务数、排队等待（毫秒）与当前排队/运行数"""
+        with self._cond:
+            report = {}
+            for priority, stats in self._stats.items():
+                waits = np.asarray(stats["waits"]) * 1000
+                done = stats["completed"] + stats["failed"]
+                report[priority] = {
+                    "submitted": stats["submitted"],
+                    "completed": stats["completed"],
+                    "failed": stats["failed"],
+                    "queued": sum(len(res.queues[priority]) for res in self._resources.values()),
+                    "running": sum(res.running[priority] for res in self._resources.values()),
+                    "wait_p50_ms": float(np.percentile(waits, 50)) if waits.size else 0.0,
+                    "wait_p95_ms": float(np.percentile(waits, 95)) if waits.size else 0.0,
+                    "wait_max_ms": float(waits.max()) if waits.size else 0.0,
+                    "mean_run_ms": 1000 * stats["run_time"] / done if done else 0.0,
+                }
+            return report
+
+    def shutdown(self):
+        """停止接收任务；已排队的任务取消，正在执行的任务执行完"""
+        with self._cond:
+            self._stopped = True
+            for res in self._resources.values():
+                for queue in res.queues.values():
+                    while queue:
+                        queue.popleft().future.cancel()
+            self._cond.notify_all()
+
+
+class ScheduledModel:
+    """
+    经调度器访问的模型，接口与 PCBInference / ModelPool 相同
+
+    detect / predict_image 作为单个任务调度；detect_batch / predict_batch 按批调度，
+    批与批之间可被更高优先级的请求插队。
+    """
+
+    def __init__(self, scheduler, resource, model, priority="interactive"):
+        """
+        Args:
+            scheduler (Scheduler): 调度器
+            resource (str): 模型对应的资源名
+            model: PCBInference、ModelPool 或其他模型对象
+            priority (str): 本视图的优先级类别
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知的优先级类别: {priority}")
+        self.scheduler = scheduler
+        self.resource = resource
+        self.model = model
+        self.priority = priority
+
+    def with_priority(self, priority):
+        """同一模型的另一优先级视图"""
+        return ScheduledModel(self.scheduler, self.resource, self.model, priority)
+
+    def _bind_session(self, fn):
+        """ModelPool 的会话是线程局部的，任务在工作线程中执行时沿用提交方的会话"""
+        if not hasattr(self.model, "session"):
+            return fn
+        session_id = self.model._current_session()
+
+        def run(*args, **kwargs):
+            with self.model.session(session_id):
+                return fn(*args, **kwargs)
+        return run
+
+    def call(self, method, *args, **kwargs):
+        """以本视图的优先级调用模型的任意方法"""
+        return self.scheduler.call(self.resource, self.priority, self._bind_session(getattr(self.model, method)),
+                                   *args, **kwargs)
+
+    def detect(self, *args, **kwargs):
+        return self.call("detect", *args, **kwargs)
+
+    def predict_image(self, *args, **kwargs):
+        return self.call("predict_image", *args, **kwargs)
+
+    def detect_batch(self, image_inputs, batch_size=None, **kwargs):
+        batch_size = batch_size or getattr(self.model, "batch_size", 8)
+
+        def run(start, chunk):
+            return [(start + i, image, detections)
+                    for i, image, detections in self.model.detect_batch(chunk, len(chunk), **kwargs)]
+
+        yield from self.scheduler.run_batches(self.resource, self.priority, image_inputs, batch_size,
+                                              self._bind_session(run))
+
+    def predict_batch(self, image_list, output_dir="results", show_labels=True, show_conf=True, max_workers=None,
+                      batch_size=None, **kwargs):
+        return write_batch(self, image_list, output_dir, show_labels, show_conf,
+                           batch_size=batch_size or getattr(self.model, "batch_size", 8),
+                           encode_workers=max_workers or getattr(self.model, "encode_workers", 4), **kwargs)
+
+    def __getattr__(self, name):
+        # 版本号、预处理等不涉及模型调用的属性直接取原模型
+        if name.startswith("__") or name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def contention_test(model, images, interactive_requests=50, interval=0.05, batch_images=2000, batch_size=8,
+                    bulk_jobs=None):
+    """
+    批量任务占满模型时交互请求的延迟：分别在直接调用和经调度器调用两种方式下测量
+
+    Returns:
+        dict: direct / scheduled 两组交互请求 p50/p95（毫秒），以及调度器各类别指标
+    """
+    replicas = len(getattr(model, "replicas", [model]))
+    bulk_jobs = bulk_jobs or replicas + 2
+    bulk = [images[i % len(images)] for i in range(batch_images)]
+
+    def measure(interactive, batch):
+        stop = threading.Event()
+
+        def bulk_job():
+            while not stop.is_set():
+                for _ in batch.detect_batch(bulk, batch_size):
+                    if stop.is_set():
+                        return
+
+        # 批量作业数多于副本数，模型始终有积压
+        workers = [threading.Thread(target=bulk_job, daemon=True) for _ in range(bulk_jobs)]
+        for worker in workers:
+            worker.start()
+        time.sleep(0.5)
+        latencies = []
+        for n in range(interactive_requests):
+            start = time.perf_counter()
+            interactive.detect(images[n % len(images)])
+            latencies.append((time.perf_counter() - start) * 1000)
+            time.sleep(interval)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        return {"p50_ms": float(np.percentile(latencies, 50)), "p95_ms": float(np.percentile(latencies, 95))}
+
+    direct = measure(model, model)
+    scheduler = Scheduler().register("detection", replicas)
+    scheduled = ScheduledModel(scheduler, "detection", model)
+    result = measure(scheduled, scheduled.with_priority("batch"))
+    metrics = scheduler.metrics()
+    scheduler.shutdown()
+    return {"direct": direct, "scheduled": result, "metrics": metrics}
+
+
+def main():
+    from inference import PCBInference
+    from pool import ModelPool
+    from quantize import list_images
+
+    parser = argparse.ArgumentParser(description="批量任务占满模型时的交互请求延迟测试")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--images", required=True)
+    parser.add_argument("--replicas", type=int, default=None)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--batch-images", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    model = ModelPool(lambda: PCBInference(args.model, device=args.device), args.replicas)
+    images = [model.preprocess_image(path) for path in list_images(args.images, 32)]
+    result = contention_test(model, images, args.requests, batch_images=args.batch_images,
+                             batch_size=args.batch_size)
+    print(f"直接调用: 交互请求 p50 {result['direct']['p50_ms']:.0f}ms, p95 {result['direct']['p95_ms']:.0f}ms")
+    print(f"经调度器: 交互请求 p50 {result['scheduled']['p50_ms']:.0f}ms, p95 {result['scheduled']['p95_ms']:.0f}ms")
+    for priority, metrics in result["metrics"].items():
+        print(f"  {priority}: 完成 {metrics['completed']}, 排队等待 p95 {metrics['wait_p95_ms']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,34 @@
 import time
 import streamlit as st
-import requests
 import os
-from PIL import Image
 import io
-import tempfile
 import sys
 import re
+import uuid
+import tempfile
+import itertools
 from html import unescape
 from datetime import datetime
+from PIL import Image
 
 # --- 模块和路径设置 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 from inference import PCBInference
+from pool import ModelPool
+from render import OverlayRenderer
+from result_store import ResultStore
+from batch import expand_uploads, count_uploads, detection_rows, summarize, build_archive
+from golden import ReferenceLibrary, GoldenInspector
+from history import InspectionHistory, image_hash
+from pipeline import run_detection, run_analysis, classify_verdict
+from batch_analysis import analyze_lot
+from rules import RuleAnalyzer
+from similar import DefectIndex
+from slowlog import SlowRequestCapture
+from scheduler import Scheduler, ScheduledModel
+from preview import (PreviewCache, content_key, probe_image, thumbnail_array, crop_region,
+                     DISPLAY_SIZE, GALLERY_SIZE)
 
 # --- 页面配置 ---
 st.set_page_config(page_title="PCB缺陷检测与分析", page_icon="🔧", layout="wide")
@@ -72,106 +87,257 @@ div[data-testid="column"] {
 """, unsafe_allow_html=True)
 
 # --- 状态初始化 ---
-if 'detection_result' not in st.session_state:
-    st.session_state.detection_result = None
-if 'analysis_result' not in st.session_state:
-    st.session_state.analysis_result = None
+# 会话中只保存结果句柄，结果本体放在进程级的 ResultStore 中
+if 'detection_handle' not in st.session_state:
+    st.session_state.detection_handle = None
+if 'analysis_handle' not in st.session_state:
+    st.session_state.analysis_handle = None
+if 'similar_handle' not in st.session_state:
+    st.session_state.similar_handle = None
 if 'detection_time' not in st.session_state:
     st.session_state.detection_time = None
 if 'processing' not in st.session_state:
     st.session_state.processing = False
 if 'analyzing' not in st.session_state:
     st.session_state.analyzing = False
+if 'force_llm' not in st.session_state:
+    st.session_state.force_llm = False
+if 'batch_handle' not in st.session_state:
+    st.session_state.batch_handle = None
+if 'segmentation_handle' not in st.session_state:
+    st.session_state.segmentation_handle = None
+if 'batch_page' not in st.session_state:
+    st.session_state.batch_page = 1
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'render_options' not in st.session_state:
+    st.session_state.render_options = {"show_labels": True, "show_conf": True, "classes": None}
 
 # --- 缓存资源 ---
+# 推理器副本数：所有会话共享副本池，按会话轮转借用；未设置时使用主机画像（autotune.py）中的副本数
+MODEL_REPLICAS = int(os.environ["PCB_MODEL_REPLICAS"]) if os.environ.get("PCB_MODEL_REPLICAS") else None
+# 两级检测初筛标定文件（由 cascade.py 生成），存在时启用
+CASCADE_PATH = os.path.join(current_dir, "data", "cascade.json")
+# 慢请求阈值（毫秒），未设置时取最近请求的 P99；诊断包写入 data/slow_requests
+SLOW_REQUEST_MS = float(os.environ["PCB_SLOW_REQUEST_MS"]) if os.environ.get("PCB_SLOW_REQUEST_MS") else None
+# 本地规则分析配置（rules.py --export-defaults 导出后修改），不存在时使用默认规则
+RULES_PATH = os.path.join(current_dir, "data", "analysis_rules.json")
+ANALYSIS_ENGINES = {"rules": "本地规则分析", "similar": "相似缺陷历史结论"}
+# 单张与批量检测共用的阈值，随检测历史一起记录
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.45
+
+@st.cache_resource
+def get_rule_analyzer():
+    return RuleAnalyzer.load(RULES_PATH) if os.path.exists(RULES_PATH) else RuleAnalyzer()
+
+@st.cache_resource
+def get_slow_capture():
+    return SlowRequestCapture(os.path.join(current_dir, "data", "slow_requests"), threshold_ms=SLOW_REQUEST_MS)
+
 @st.cache_resource
 def load_inference_model():
     try:
-        return PCBInference("/root/workSpace/tb-hackathon/home/yolov12pcb-ui/page2/data/new-yolov12.engine") 
+        return ModelPool(
+            lambda: PCBInference("/root/workSpace/tb-hackathon/home/yolov12pcb-ui/page2/data/new-yolov12.engine",
+                                 imgsz="auto", warm_start=True, background_warmup=True,
+                                 cascade=CASCADE_PATH if os.path.exists(CASCADE_PATH) else None,
+                                 slow_capture=get_slow_capture()),
+            replicas=MODEL_REPLICAS)
     except Exception as e:
         st.error(f"❌ 模型加载失败: {str(e)}")
         return None
 
+@st.cache_resource
+def get_scheduler(_inference_model):
+    # 交互请求优先于批量检测，批量检测在批与批之间让出副本；
+    # 肝脏分割（seg.py，paddleseg）与检测共用调度器，单独一个执行槽
+    scheduler = Scheduler().register("segmentation", 1)
+    if _inference_model is not None:
+        scheduler.register("detection", len(_inference_model.replicas))
+    return scheduler
+
+def run_segmentation(scheduler, image_list, spacing=(1.0, 1.0, 1.0), priority="interactive", **kwargs):
+    """经调度器的 "segmentation" 资源执行 seg.segment，返回掩膜后处理结果"""
+    # seg.py 依赖 paddleseg，用到时才导入，检测页面不依赖它
+    if os.path.dirname(current_dir) not in sys.path:
+        sys.path.append(os.path.dirname(current_dir))
+    from seg import segment
+    return scheduler.call("segmentation", priority, segment, image_list, spacing, cost=len(image_list), **kwargs)
+
+@st.cache_resource
+def get_result_store():
+    return ResultStore(memory_budget=512 * 1024 * 1024)
+
+@st.cache_resource
+def get_reference_library():
+    return ReferenceLibrary(os.path.join(current_dir, "references"))
+
+@st.cache_resource
+def get_golden_inspector(_inference_model):
+    return GoldenInspector(_inference_model, get_reference_library())
+
+@st.cache_resource
+def get_inspection_history():
+    os.makedirs(os.path.join(current_dir, "data"), exist_ok=True)
+    return InspectionHistory(os.path.join(current_dir, "data", "inspection_history.db"))
+
+@st.cache_resource
+def get_defect_index():
+    os.makedirs(os.path.join(current_dir, "data"), exist_ok=True)
+    return DefectIndex(os.path.join(current_dir, "data", "defect_index.db"))
+
+@st.cache_resource
+def get_preview_cache():
+    return PreviewCache(max_bytes=64 * 1024 * 1024)
+
+result_store = get_result_store()
+result_store.collect()
+preview_cache = get_preview_cache()
+
+def set_session_result(key, value):
+    """替换会话中的结果句柄，旧结果引用计数减一"""
+    result_store.release(st.session_state.get(key))
+    st.session_state[key] = None if value is None else result_store.put(value)
+
+def render_options_key(options):
+    classes = options["classes"]
+    return (options["show_labels"], options["show_conf"], None if classes is None else tuple(sorted(classes)))
+
+def detection_jpeg(handle, options):
+    """按显示选项懒生成检测结果JPEG，作为派生产物缓存"""
+    return result_store.derive(handle, ("jpeg",) + render_options_key(options),
+                               lambda renderer: renderer.render_bytes(**options))
+
+def detection_preview(handle, options):
+    """按显示选项懒生成显示分辨率的检测结果预览"""
+    return result_store.derive(handle, ("preview",) + render_options_key(options),
+                               lambda renderer: thumbnail_array(renderer.render(**options), DISPLAY_SIZE))
+
 # --- 核心处理函数 ---
-def process_detection(uploaded_file, inference_model):
-    """处理推理检测，返回结果"""
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            temp_input_path = tmp_file.name
-        
-        temp_output_path = tempfile.mktemp(suffix=".jpg")
-        start_time = time.time()
-        
-        result_image = inference_model.predict_image(temp_input_path, save_path=temp_output_path)
-        inference_time = time.time() - start_time
-        
-        if result_image is not None and os.path.exists(temp_output_path):
-            with open(temp_output_path, 'rb') as f:
-                result_data = f.read()
-            
-            os.unlink(temp_input_path)
-            os.unlink(temp_output_path)
-            return {"success": True, "data": result_data, "time": inference_time}
-        else:
-            raise Exception("推理失败")
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+def process_detection(uploaded_file, inference_model, board_type=None):
+    """处理推理检测，返回底图和结构化结果，显示时再按选项渲染"""
+    result = run_detection(uploaded_file.getvalue(), inference_model, image_name=uploaded_file.name,
+                           board_type=board_type,
+                           golden_inspector=get_golden_inspector(inference_model) if board_type else None,
+                           history=get_inspection_history(), conf_threshold=CONF_THRESHOLD,
+                           iou_threshold=IOU_THRESHOLD)
+    if result["success"]:
+        # 先检索历史相似缺陷，再把本次缺陷加入索引
+        renderer = result["renderer"]
+        index = get_defect_index()
+        result["similar"] = {
+            "items": index.similar(renderer.base, renderer.detections),
+            "ids": index.add(renderer.base, renderer.detections, image_hash(uploaded_file.getvalue()),
+                             image_name=uploaded_file.name, board_type=board_type),
+        }
+    return result
 
 def process_analysis(detection_result, dify_api_url, dify_api_key):
     """处理AI分析，返回结果"""
-    try:
-        image = Image.open(io.BytesIO(detection_result))
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P': image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-            image = background
-        
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-            tmp_file.write(img_bytes)
-            temp_image_path = tmp_file.name
-        
-        with open(temp_image_path, 'rb') as f:
-            upload_response = requests.post(
-                f"{dify_api_url}/files/upload",
-                files={'file': ('pcb_analysis.jpg', f, 'image/jpeg')},
-                data={'type': 'image'},
-                headers={"Authorization": f"Bearer {dify_api_key}"},
-                timeout=60
-            )
-        os.unlink(temp_image_path)
-        
-        if upload_response.status_code != 201:
-            raise Exception(f"文件上传失败: {upload_response.text}")
+    return run_analysis(detection_result, dify_api_url, dify_api_key)
 
-        file_id = upload_response.json().get('id')
-        workflow_payload = {
-            "inputs": {"imUrl": {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}},
-            "response_mode": "blocking", "user": "streamlit_user"
-        }
-        workflow_response = requests.post(
-            f"{dify_api_url}/workflows/run",
-            json=workflow_payload,
-            headers={"Authorization": f"Bearer {dify_api_key}", "Content-Type": "application/json"},
-            timeout=120
-        )
-        
-        if workflow_response.status_code == 200:
-            result = workflow_response.json()
-            analysis_text = result.get("data", {}).get("outputs", {}).get("text", "")
-            if analysis_text:
-                return {"success": True, "analysis_text": analysis_text, "raw_response": result}
+def process_batch_detection(items, total, inference_model, batch_size, progress, board_type=None):
+    """批量推理，图片按批从 items 中取出，每张结果单独存入 ResultStore，返回汇总句柄"""
+    entries = []
+    rows = []
+    done = 0
+    start_time = time.time()
+    history = get_inspection_history()
+    items = iter(items)
+    # 每次只解压一个批次的图片，压缩包中的其余图片留到下一批再读取
+    while True:
+        chunk = list(itertools.islice(items, batch_size))
+        if not chunk:
+            break
+        offset = len(entries)
+        entries.extend({"name": name, "handle": None, "count": 0, "error": None} for name, _ in chunk)
+        inputs = [io.BytesIO(data) for _, data in chunk]
+        for i, image, detections in inference_model.detect_batch(inputs, batch_size=batch_size,
+                                                                 conf_threshold=CONF_THRESHOLD,
+                                                                 iou_threshold=IOU_THRESHOLD):
+            entry = entries[offset + i]
+            if image is None:
+                entry["error"] = "图片读取失败"
             else:
-                raise Exception("工作流执行成功，但没有返回分析文本")
-        else:
-            raise Exception(f"工作流执行失败: HTTP {workflow_response.status_code}")
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+                entry["handle"] = result_store.put(OverlayRenderer(image, detections=detections))
+                entry["count"] = len(detections["boxes"])
+                rows.extend(detection_rows(entry["name"], detections))
+                history.record(None, detections, image_name=entry["name"], board_type=board_type,
+                               model=inference_model.model_version, conf_threshold=CONF_THRESHOLD,
+                               iou_threshold=IOU_THRESHOLD, image_size=image.size, digest=image_hash(chunk[i][1]))
+            done += 1
+            progress.progress(min(1.0, done / total), text=f"🔄 {done}/{total} · {entry['name']}")
+    summary = {"items": entries, "rows": rows, "summary": summarize(entries, rows),
+               "time": time.time() - start_time}
+    return result_store.put(summary)
+
+def process_batch_analysis(handle, dify_api_url, dify_api_key, progress):
+    """
+    多板合并成少量工作流请求做批量AI分析
+
+    板 id 使用批量结果中的序号（压缩包内不同目录的图片可能同名），结果中另附图片名。
+    """
+    summary = result_store.get(handle)
+    boards, names = [], {}
+    for n, entry in enumerate(summary["items"]):
+        renderer = result_store.get(entry["handle"]) if entry["handle"] else None
+        if renderer is not None:
+            boards.append({"id": str(n), "size": renderer.size, "detections": renderer.detections})
+            names[str(n)] = entry["name"]
+    report = analyze_lot(boards, dify_api_url, dify_api_key,
+                         progress=lambda done, total: progress.progress(done / total, text=f"🤖 {done}/{total}"))
+    for result in report["results"]:
+        result["name"] = names[result["id"]]
+    return report
+
+def process_segmentation(slice_files, spacing, scheduler):
+    """
+    肝脏肿瘤分割：切片按上传顺序组成体数据，经调度器执行 seg.segment
+
+    Returns:
+        str: 结果句柄，结果包含每层的叠加渲染器和肝脏/肿瘤统计
+    """
+    start_time = time.time()
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = []
+        for index, file in enumerate(slice_files):
+            # 序号前缀保证层序，也避免同名切片互相覆盖
+            path = os.path.join(work_dir, f"{index:04d}_{os.path.basename(file.name)}")
+            with open(path, "wb") as f:
+                f.write(file.getvalue())
+            paths.append(path)
+        summary = run_segmentation(scheduler, paths, spacing, save_dir=os.path.join(work_dir, "output"))
+
+    # 掩膜只随渲染器保存，显示选项变化时从底图重新叠加，不再调用模型
+    renderers = [OverlayRenderer(Image.open(io.BytesIO(file.getvalue())).convert("RGB"), mask=mask)
+                 for file, mask in zip(slice_files, summary.pop("mask"))]
+    return result_store.put({
+        "names": [file.name for file in slice_files],
+        "renderers": renderers,
+        "summary": summary,
+        "time": time.time() - start_time,
+    }, nbytes=sum(r.nbytes for r in renderers))
+
+def release_batch(handle):
+    """释放批量结果及其中每张图片的结果"""
+    summary = result_store.get(handle)
+    if summary is not None:
+        for entry in summary["items"]:
+            result_store.release(entry["handle"])
+    result_store.release(handle)
+
+def batch_thumbnail(handle):
+    return result_store.derive(handle, "thumbnail",
+                               lambda renderer: thumbnail_array(renderer.render(), GALLERY_SIZE))
+
+def batch_archive(handle):
+    """懒生成批量结果下载包"""
+    def build(summary):
+        return build_archive(summary["items"], summary["rows"],
+                             lambda h: result_store.derive(h, ("jpeg", True, True, None),
+                                                           lambda renderer: renderer.render_bytes()))
+    return result_store.derive(handle, "archive", build)
 
 # --- 页面布局 ---
 st.markdown("<div style='text-align: center; padding: 20px;'><h1 style='color: #1f77b4; font-size: 3rem;'>🔧 PCB缺陷检测系统</h1></div>", unsafe_allow_html=True)
@@ -180,10 +346,52 @@ st.markdown("<div style='text-align: center; padding: 20px;'><h1 style='color: #
 with st.sidebar:
     st.header("⚙️ 服务配置")
     inference_model = load_inference_model()
+    scheduler = get_scheduler(inference_model)
+    batch_model = None
     if inference_model: 
-        st.success("✅ TensorRT模型已加载")
+        batch_model = ScheduledModel(scheduler, "detection", inference_model, priority="batch")
+        inference_model = ScheduledModel(scheduler, "detection", inference_model, priority="interactive")
+        readiness = inference_model.readiness()
+        if readiness["ready"]:
+            st.success("✅ TensorRT模型已加载")
+        else:
+            st.info("⏳ 模型已可用，其余推理尺寸预热中")
+        waits = scheduler.metrics()
+        if waits["batch"]["submitted"]:
+            st.caption(f"⏱️ 排队等待 P95: 交互 {waits['interactive']['wait_p95_ms']:.0f}ms · "
+                       f"批量 {waits['batch']['wait_p95_ms']:.0f}ms")
+        slow_capture = get_slow_capture()
+        if slow_capture.stats["captured"]:
+            st.caption(f"🐢 慢请求诊断包: {slow_capture.stats['captured']} 个 (阈值 {slow_capture.threshold():.0f}ms)")
     dify_api_url = st.text_input("Dify工作流地址", value="https://api.dify.ai/v1")
     dify_api_key = st.text_input("Dify-Api", value="app-YznhSUgv8n9N29bhltjcuXEE", type="password")
+    with st.expander("批量分析工作流"):
+        # 批量分析使用单独的工作流：输入 boards（多板结构化检测结果），与单图分析的 imUrl 输入不同
+        batch_dify_api_url = st.text_input("批量工作流地址", value=dify_api_url, key="batch_dify_api_url")
+        batch_dify_api_key = st.text_input("批量工作流Api", value="", type="password", key="batch_dify_api_key")
+    batch_size = st.slider("批量检测批大小", min_value=1, max_value=32,
+                           value=min(32, inference_model.batch_size) if inference_model else 8)
+    reuse_verdict = st.checkbox("相似缺陷命中时复用历史结论", value=True, key="reuse_verdict",
+                                help="所有缺陷都有高相似度且结论一致的历史记录时，跳过Dify分析")
+    fast_analysis = st.checkbox("本地规则快速分析", value=True, key="fast_analysis",
+                                help="按类别严重等级、数量/面积容限和区域规则直接出结论，仅在无法确定时调用Dify")
+    
+    board_type = None
+    if st.checkbox("金板比对模式", key="golden_enabled"):
+        reference_library = get_reference_library()
+        with st.expander("➕ 添加参考板"):
+            new_board_type = st.text_input("板型名称", key="new_board_type")
+            reference_file = st.file_uploader("无缺陷参考图", type=['png', 'jpg', 'jpeg', 'bmp'], key="reference_uploader")
+            if st.button("保存参考板", disabled=not (new_board_type and reference_file), key="save_reference"):
+                # 参考图与待检图使用同样的预处理（最长边限制），两者在同一尺寸空间比对
+                reference_library.add(new_board_type, io.BytesIO(reference_file.getvalue()),
+                                      preprocess=inference_model.preprocess_image if inference_model else None)
+                st.success(f"✅ 参考板 {new_board_type} 已保存")
+        board_types = reference_library.board_types()
+        if board_types:
+            board_type = st.selectbox("板型", board_types, key="board_type")
+        else:
+            st.info("请先添加参考板")
 
 # 创建三列布局
 col1, col2, col3 = st.columns([1, 1, 1], gap="large")
@@ -199,17 +407,18 @@ with col1:
         current_file_id = f"{uploaded_file.name}_{uploaded_file.size}"
         if 'current_file_id' not in st.session_state or st.session_state.current_file_id != current_file_id:
             st.session_state.current_file_id = current_file_id
-            st.session_state.detection_result = None
-            st.session_state.analysis_result = None
+            set_session_result("detection_handle", None)
+            set_session_result("analysis_handle", None)
+            set_session_result("similar_handle", None)
             st.session_state.detection_time = None
         
-        # 显示上传的图片
-        st.image(uploaded_file, caption=f"✅ 已上传: {uploaded_file.name}", use_column_width=True)
-        
-        # 显示图片信息
+        # 显示上传的图片：只发送显示分辨率的缩略图，图片信息只读文件头
         try:
-            image = Image.open(uploaded_file)
-            st.info(f"📊 尺寸: {image.size[0]}×{image.size[1]} | 格式: {image.format}")
+            upload_bytes = uploaded_file.getvalue()
+            image_info = probe_image(upload_bytes)
+            st.image(preview_cache.thumbnail(upload_bytes, DISPLAY_SIZE, key=content_key(upload_bytes)),
+                     caption=f"✅ 已上传: {uploaded_file.name}", use_column_width=True)
+            st.info(f"📊 尺寸: {image_info['width']}×{image_info['height']} | 格式: {image_info['format']}")
         except Exception as e:
             st.warning(f"无法读取图片信息: {e}")
         
@@ -233,13 +442,16 @@ with col2:
         st.session_state.processing = True
         
         with st.spinner("🔄 正在进行AI推理检测..."):
-            result = process_detection(uploaded_file, inference_model)
+            with inference_model.session(st.session_state.session_id):
+                result = process_detection(uploaded_file, inference_model, board_type)
         
         if result['success']:
-            # 保存检测结果
-            st.session_state.detection_result = result['data']
+            # 保存检测结果（底图 + 结构化结果）
+            set_session_result("detection_handle", result['renderer'])
+            st.session_state.pop("opt_classes", None)  # 新结果的类别集合可能不同
             st.session_state.detection_time = result['time']
-            st.session_state.analysis_result = None  # 重置分析结果
+            set_session_result("analysis_handle", None)  # 重置分析结果
+            set_session_result("similar_handle", result['similar'])
             
             st.success(f"✅ 推理检测完成！耗时: {result['time']:.2f}秒")
             st.balloons()
@@ -250,9 +462,49 @@ with col2:
         st.rerun()  # 刷新页面以显示结果
     
     # 显示检测结果（只有在不处理时才显示）
-    if st.session_state.detection_result is not None and not st.session_state.processing:
+    renderer = result_store.get(st.session_state.detection_handle)
+    if renderer is None and st.session_state.detection_handle is not None:
+        st.session_state.detection_handle = None  # 结果已过期清除
+    if renderer is not None and not st.session_state.processing:
         st.subheader("🎯 检测结果")
-        st.image(st.session_state.detection_result, caption="缺陷检测结果", use_column_width=True)
+        
+        # 显示选项：切换时只从缓存底图重新绘制，不重新推理
+        options = st.session_state.render_options
+        options["show_labels"] = st.checkbox("显示标签", value=options["show_labels"], key="opt_show_labels")
+        options["show_conf"] = st.checkbox("显示置信度", value=options["show_conf"], key="opt_show_conf")
+        class_names = renderer.class_names()
+        if class_names:
+            selected = st.multiselect("显示类别", options=list(class_names),
+                                      default=list(class_names), format_func=class_names.get,
+                                      key="opt_classes")
+            options["classes"] = None if len(selected) == len(class_names) else selected
+        
+        st.image(detection_preview(st.session_state.detection_handle, options),
+                 caption="缺陷检测结果", use_column_width=True)
+        
+        # 原图局部放大：只在打开时按需裁剪全分辨率结果
+        if st.checkbox("🔍 局部放大查看", key="zoom_enabled"):
+            zoom = st.slider("放大倍数", min_value=1.0, max_value=8.0, value=2.0, step=0.5, key="zoom_level")
+            zoom_x = st.slider("水平位置", min_value=0.0, max_value=1.0, value=0.5, step=0.01, key="zoom_x")
+            zoom_y = st.slider("垂直位置", min_value=0.0, max_value=1.0, value=0.5, step=0.01, key="zoom_y")
+            crop, box = crop_region(renderer.render(**options), (zoom_x, zoom_y), zoom)
+            st.image(crop, caption=f"区域: ({box[0]}, {box[1]}) - ({box[2]}, {box[3]})", use_column_width=True)
+        
+        # 历史相似缺陷：本地索引检索，毫秒级
+        similar = result_store.get(st.session_state.similar_handle)
+        if similar and similar["items"]:
+            with st.expander("🔎 相似历史缺陷"):
+                items = similar["items"]
+                choice = st.selectbox("缺陷", options=range(len(items)), key="similar_choice",
+                                      format_func=lambda n: f"#{items[n]['index'] + 1} {items[n]['class_name']} "
+                                                            f"({items[n]['confidence']:.2f})")
+                matches = items[choice]["matches"] if choice is not None and choice < len(items) else []
+                if matches:
+                    st.image([m["thumbnail"] for m in matches], width=96,
+                             caption=[f"{m['similarity']:.2f} · {m['class_name']}"
+                                      f"{' · ' + m['verdict'] if m['verdict'] else ''}" for m in matches])
+                else:
+                    st.caption("暂无相似历史缺陷")
         
         # 显示检测时间
         if st.session_state.detection_time:
@@ -261,7 +513,7 @@ with col2:
         # 下载按钮
         st.download_button(
             "💾 下载检测结果", 
-            st.session_state.detection_result, 
+            detection_jpeg(st.session_state.detection_handle, options), 
             file_name=f"detected_{uploaded_file.name if uploaded_file else 'result'}.jpg",
             use_container_width=True,
             key="download_detection_result"
@@ -272,8 +524,8 @@ with col2:
 with col3:
     st.markdown('<div class="step-title">🧠 第三步：智能分析</div>', unsafe_allow_html=True)
     
-    can_analyze = (st.session_state.detection_result is not None and 
-                   dify_api_key and 
+    can_analyze = (st.session_state.detection_handle is not None and 
+                   (dify_api_key or fast_analysis) and 
                    not st.session_state.processing and 
                    not st.session_state.analyzing)
     
@@ -300,15 +552,37 @@ with col3:
         </div>
         ''', unsafe_allow_html=True)
         
-        # 执行分析
-        result = process_analysis(
-            st.session_state.detection_result,
-            dify_api_url,
-            dify_api_key
-        )
+        # 执行分析：本地规则能确定结论时直接采用；否则相似缺陷有可靠的历史结论时直接复用，
+        # 再否则调用 Dify。手动要求AI深度分析时跳过规则和历史结论，直接调用 Dify
+        result = None
+        force_llm = st.session_state.force_llm
+        st.session_state.force_llm = False
+        if fast_analysis and not force_llm:
+            renderer = result_store.get(st.session_state.detection_handle)
+            result = get_rule_analyzer().analyze(renderer.detections, renderer.size, board_type)
+            if result["verdict"] == "unknown" and dify_api_key:
+                result = None
+        if result is None:
+            similar = result_store.get(st.session_state.similar_handle)
+            verdict, matches = (None, [])
+            if reuse_verdict and similar and not force_llm:
+                verdict, matches = get_defect_index().known_verdict(similar["items"])
+            if verdict in ("defect", "pass"):
+                names = "、".join(sorted({m["class_name"] for m in matches}))
+                summary = "发现缺陷" if verdict == "defect" else "检测通过（合格）"
+                result = {"success": True, "source": "similar",
+                          "analysis_text": f"与 {len(matches)} 个历史缺陷（{names}）高度相似，沿用历史结论：{summary}"}
+            else:
+                result = process_analysis(
+                    detection_jpeg(st.session_state.detection_handle, st.session_state.render_options),
+                    dify_api_url,
+                    dify_api_key
+                )
+                if result['success'] and similar:
+                    get_defect_index().set_verdict(similar["ids"], classify_verdict(result['analysis_text']))
         
         # 保存分析结果并结束分析状态
-        st.session_state.analysis_result = result
+        set_session_result("analysis_handle", result)
         st.session_state.analyzing = False
         
         if result['success']:
@@ -318,17 +592,18 @@ with col3:
         
         st.rerun()  # 刷新以显示最终结果
     
-    elif st.session_state.analysis_result:
+    elif result_store.get(st.session_state.analysis_handle):
         # 显示分析结果
-        result = st.session_state.analysis_result
+        result = result_store.get(st.session_state.analysis_handle)
         
         if result['success']:
             analysis_text = result['analysis_text']
             
-            # 判断结果类型
-            if any(keyword in analysis_text for keyword in ["缺陷", "缺失", "问题", "错误", "故障", "异常"]):
+            # 判断结果类型：本地规则直接给出结论，其他来源按关键词归类
+            verdict = result.get("verdict") or classify_verdict(analysis_text)
+            if verdict == "defect":
                 result_class, icon, title = "analysis-result error", "⚠️", "发现缺陷"
-            elif any(keyword in analysis_text for keyword in ["正常", "良好", "无问题", "合格", "完好"]):
+            elif verdict == "pass":
                 result_class, icon, title = "analysis-result success", "✅", "检测通过"
             else:
                 result_class, icon, title = "analysis-result info", "📋", "检测结果"
@@ -353,7 +628,7 @@ with col3:
 
 详细信息：
 - 图片格式：JPEG
-- 分析引擎：Dify AI工作流
+- 分析引擎：{ANALYSIS_ENGINES.get(result.get("source"), "Dify AI工作流")}
 - 检测类型：PCB缺陷检测
 """
             
@@ -365,6 +640,13 @@ with col3:
                 use_container_width=True,
                 key="export_report"
             )
+            if result.get("source") == "rules":
+                st.caption(f"⚡ 本地规则分析，耗时 {result['time_ms']:.2f}ms")
+                if st.button("🤖 AI深度分析", disabled=not dify_api_key, use_container_width=True,
+                             key="force_llm_button"):
+                    st.session_state.force_llm = True
+                    st.session_state.analyzing = True
+                    st.rerun()
         else:
             st.markdown(f'''
             <div class="analysis-output-box">
@@ -394,3 +676,136 @@ with col3:
             </div>
         </div>
         ''', unsafe_allow_html=True)
+
+# --- 批量检测 ---
+st.markdown("---")
+st.markdown('<div class="step-title">📦 批量检测</div>', unsafe_allow_html=True)
+
+batch_files = st.file_uploader("选择多张PCB图片或zip压缩包", type=['png', 'jpg', 'jpeg', 'bmp', 'zip'],
+                               accept_multiple_files=True, key="batch_uploader")
+
+can_batch = bool(batch_files) and inference_model is not None and not st.session_state.processing
+if st.button("🚀 开始批量检测", disabled=not can_batch, type="primary", key="batch_button"):
+    total = count_uploads(batch_files)
+    if not total:
+        st.warning("没有找到可检测的图片")
+    else:
+        st.session_state.processing = True
+        release_batch(st.session_state.batch_handle)
+        progress = st.progress(0.0, text=f"🔄 0/{total}")
+        try:
+            with inference_model.session(st.session_state.session_id):
+                st.session_state.batch_handle = process_batch_detection(expand_uploads(batch_files), total,
+                                                                       batch_model, batch_size, progress,
+                                                                       board_type)
+            st.session_state.batch_page = 1
+            st.session_state.batch_archive_ready = False
+        except Exception as e:
+            st.session_state.batch_handle = None
+            st.error(f"❌ 批量检测失败: {str(e)}")
+        st.session_state.processing = False
+
+batch = result_store.get(st.session_state.batch_handle)
+if batch is not None:
+    summary = batch["summary"]
+    st.success(f"✅ 共 {summary['images']} 张，缺陷板 {summary['defective']} 张，"
+               f"缺陷 {summary['defects']} 个，失败 {summary['failed']} 张，耗时 {batch['time']:.2f}秒")
+    if summary["classes"]:
+        st.dataframe(summary["classes"], use_container_width=True, hide_index=True)
+
+    # 分页缩略图
+    page_size = 12
+    page_count = max(1, (len(batch["items"]) + page_size - 1) // page_size)
+    page = st.number_input("页码", min_value=1, max_value=page_count, step=1, key="batch_page")
+    page_items = batch["items"][(page - 1) * page_size:page * page_size]
+    thumbnails, captions = [], []
+    for entry in page_items:
+        thumbnail = batch_thumbnail(entry["handle"]) if entry["handle"] else None
+        if thumbnail is not None:
+            thumbnails.append(thumbnail)
+            captions.append(f"{entry['name']} · {entry['count']}个缺陷")
+    if thumbnails:
+        st.image(thumbnails, caption=captions, width=240)
+
+    with st.expander("📋 检测明细"):
+        st.dataframe(batch["rows"], use_container_width=True, hide_index=True)
+
+    if st.button("🤖 批量AI分析", disabled=not batch_dify_api_key, key="batch_analysis_button",
+                 help="需要在侧边栏配置批量分析工作流（输入为 boards，输出每块板的结论 JSON）"):
+        progress = st.progress(0.0, text="🤖 正在合并请求...")
+        st.session_state.batch_analysis = {
+            "handle": st.session_state.batch_handle,
+            "report": process_batch_analysis(st.session_state.batch_handle, batch_dify_api_url,
+                                             batch_dify_api_key, progress)
+        }
+        progress.empty()
+    lot = st.session_state.get("batch_analysis")
+    if lot is not None and lot["handle"] == st.session_state.batch_handle:
+        report = lot["report"]
+        defects = sum(1 for r in report["results"] if r["verdict"] == "defect")
+        st.info(f"🤖 {len(report['results'])} 块板共 {report['requests']} 个请求，耗时 {report['time']:.1f}秒，"
+                f"判定缺陷 {defects} 块，未得到结论 {report['failed']} 块")
+        with st.expander("🧠 批量分析结论"):
+            st.dataframe([{"图片": r["name"], "结论": r["verdict"], "分析": r["analysis"] or r["error"]}
+                          for r in report["results"]], use_container_width=True, hide_index=True)
+
+    if st.button("📦 生成下载包", key="batch_archive_button"):
+        st.session_state.batch_archive_ready = True
+    if st.session_state.get("batch_archive_ready"):
+        st.download_button(
+            "💾 下载批量结果 (图片 + JSON/CSV)",
+            batch_archive(st.session_state.batch_handle),
+            file_name=f"pcb_batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+            mime="application/zip",
+            key="download_batch_result"
+        )
+
+# --- 肝脏肿瘤分割 ---
+st.markdown("---")
+st.markdown('<div class="step-title">🫀 肝脏肿瘤分割</div>', unsafe_allow_html=True)
+
+slice_files = st.file_uploader("按层序选择CT切片图片", type=['png', 'jpg', 'jpeg'],
+                               accept_multiple_files=True, key="segmentation_uploader")
+spacing_cols = st.columns(3)
+spacing = tuple(col.number_input(f"体素间距 {axis} (mm)", min_value=0.01, value=1.0, step=0.1,
+                                 key=f"segmentation_spacing_{axis}")
+                for col, axis in zip(spacing_cols, "zyx"))
+
+can_segment = bool(slice_files) and not st.session_state.processing
+if st.button("🚀 开始分割", disabled=not can_segment, type="primary", key="segmentation_button"):
+    st.session_state.processing = True
+    result_store.release(st.session_state.segmentation_handle)
+    try:
+        with st.spinner("🔄 正在分割..."):
+            st.session_state.segmentation_handle = process_segmentation(slice_files, spacing, scheduler)
+    except Exception as e:
+        st.session_state.segmentation_handle = None
+        st.error(f"❌ 分割失败: {str(e)}")
+    st.session_state.processing = False
+
+segmentation = result_store.get(st.session_state.segmentation_handle)
+if segmentation is not None:
+    summary = segmentation["summary"]
+    metric_cols = st.columns(4)
+    metric_cols[0].metric("肝脏体积", f"{summary['liver_volume_ml']:.1f} ml")
+    metric_cols[1].metric("肿瘤体积", f"{summary['tumor_volume_ml']:.1f} ml")
+    metric_cols[2].metric("肿瘤负荷", f"{summary['tumor_burden']:.1%}")
+    metric_cols[3].metric("肿瘤数量", summary["tumor_count"])
+    st.caption(f"⏱️ 共 {len(segmentation['names'])} 层，耗时 {segmentation['time']:.2f}秒")
+
+    # 切换层、类别和透明度只从缓存的底图和掩膜重新叠加
+    layers = {"肝脏": 1, "肿瘤": 2}
+    option_cols = st.columns(3)
+    index = option_cols[0].slider("层", 1, len(segmentation["names"]), 1, key="segmentation_slice") - 1
+    shown = option_cols[1].multiselect("显示", list(layers), default=list(layers), key="segmentation_classes")
+    alpha = option_cols[2].slider("掩膜透明度", 0.1, 1.0, 0.5, 0.1, key="segmentation_alpha")
+    overlay = segmentation["renderers"][index].render(classes=[layers[name] for name in shown], alpha=alpha)
+    st.image(thumbnail_array(overlay, DISPLAY_SIZE), caption=segmentation["names"][index])
+
+    if summary["tumors"]:
+        with st.expander("📋 肿瘤明细"):
+            st.dataframe([{"编号": t["id"], "体积 (ml)": round(t["volume_ml"], 2),
+                           "最大轴向径 (mm)": round(t["max_axial_diameter_mm"], 1),
+                           "等效直径 (mm)": round(t["equivalent_diameter_mm"], 1),
+                           "层范围": f"{t['bbox'][0][0] + 1}-{t['bbox'][0][1]}"}
+                          for t in summary["tumors"]], use_container_width=True, hide_index=True)
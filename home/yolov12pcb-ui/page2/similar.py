@@ -0,0 +1,418 @@
+import io
+import logging
+import sqlite3
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from render import to_rgb_array
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS defects (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    image_hash TEXT NOT NULL,
+    image_name TEXT,
+    board_type TEXT,
+    class_name TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL,
+    verdict TEXT,
+    thumbnail BLOB,
+    vector BLOB NOT NULL,
+    scale REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_defects_hash ON defects(image_hash);
+"""
+
+
+def crop_defects(image, boxes, context=0.25, min_size=16):
+    """按检测框裁剪缺陷区域，四周保留一定比例的上下文"""
+    canvas = to_rgb_array(image)
+    height, width = canvas.shape[:2]
+    crops = []
+    for x1, y1, x2, y2 in np.asarray(boxes, dtype=np.float32):
+        pad_x = max((x2 - x1) * context, (min_size - (x2 - x1)) / 2, 0)
+        pad_y = max((y2 - y1) * context, (min_size - (y2 - y1)) / 2, 0)
+        x0, y0 = int(max(0, x1 - pad_x)), int(max(0, y1 - pad_y))
+        x3, y3 = int(min(width, np.ceil(x2 + pad_x))), int(min(height, np.ceil(y2 + pad_y)))
+        crops.append(canvas[y0:max(y3, y0 + 1), x0:max(x3, x0 + 1)])
+    return crops
+
+
+def _nearest(vectors, centroids, count):
+    """每个向量最相似的 count 个聚类中心"""
+    similarity = vectors @ centroids.T
+    count = min(count, similarity.shape[1])
+    return np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+
+class HandcraftedEmbedder:
+    """
+    轻量级 CPU 特征：32x32 灰度 HOG + HSV 颜色直方图
+
+    不依赖模型格式（TensorRT 引擎无法导出中间特征时也可用），每个缺陷约 0.1ms。
+    """
+
+    size = 32
+
+    def __init__(self):
+        self._hog = cv2.HOGDescriptor((self.size, self.size), (16, 16), (8, 8), (8, 8), 9)
+        self.dim = int(self._hog.getDescriptorSize()) + 32
+
+    def __call__(self, crops):
+        vectors = np.zeros((len(crops), self.dim), dtype=np.float32)
+        for i, crop in enumerate(crops):
+            resized = cv2.resize(crop, (self.size, self.size), interpolation=cv2.INTER_AREA)
+            hog = self._hog.compute(cv2.cvtColor(resized, cv2.COLOR_RGB2GRAY)).reshape(-1)
+            hsv = cv2.cvtColor(resized, cv2.COLOR_RGB2HSV)
+            hist = cv2.calcHist([hsv], [0, 1], None, [8, 4], [0, 180, 0, 256]).reshape(-1)
+            vectors[i] = np.concatenate([hog / (np.linalg.norm(hog) + 1e-6), hist / (hist.sum() + 1e-6)])
+        return _normalize(vectors)
+
+
+class BackboneEmbedder:
+    """检测模型骨干网络的池化特征（需要 PyTorch 格式的模型）"""
+
+    def __init__(self, inference, imgsz=160):
+        self.inference = inference
+        self.imgsz = imgsz
+        self.dim = None
+
+    def __call__(self, crops):
+        with self.inference._lock:
+            embeddings = self.inference.model.embed([np.ascontiguousarray(c[:, :, ::-1]) for c in crops],
+                                                    imgsz=self.imgsz, verbose=False)
+        vectors = _normalize(np.stack([e.cpu().numpy().reshape(-1) for e in embeddings]))
+        self.dim = vectors.shape[1]
+        return vectors
+
+
+class DefectIndex:
+    """
+    缺陷相似检索索引
+
+    向量以 int8（逐行缩放）或 float16 紧凑存储，持久化在 SQLite 中，启动时载入内存。
+    数量较少时精确检索；超过 min_train 条后训练 IVF 粗聚类中心，只在最近的 nprobe 个
+    倒排列表中检索。新向量增量写入对应的倒排列表，数量翻倍后重新训练聚类中心；
+    训练在后台线程进行，不阻塞写入和检索。
+    """
+
+    def __init__(self, db_path, embedder=None, dtype="int8", nprobe=8, min_train=4096, retrain_factor=2.0):
+        """
+        Args:
+            db_path (str): SQLite 数据库路径
+            embedder: 特征提取器，默认 HandcraftedEmbedder
+            dtype (str): 向量存储精度 int8 / float16
+            nprobe (int): IVF 检索的倒排列表数
+            min_train (int): 开始使用 IVF 的最少向量数
+            retrain_factor (float): 向量数增长到上次训练时的多少倍后重新训练
+        """
+        if dtype not in ("int8", "float16"):
+            raise ValueError(f"不支持的向量精度: {dtype}")
+        self.db_path = db_path
+        self.embedder = embedder or HandcraftedEmbedder()
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.retrain_factor = retrain_factor
+        self._lock = threading.RLock()
+        self._ids = np.zeros((0,), dtype=np.int64)
+        self._vectors = None
+        self._scales = np.zeros((0,), dtype=np.float32)
+        self._size = 0
+        self._hashes = set()
+        self._centroids = None
+        self._lists = []
+        self._trained_size = 0
+        self._training = None
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self._load()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # --- 向量存储 ---
+    def _encode(self, vectors):
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0 + 1e-12
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _append(self, ids, codes, scales):
+        needed = self._size + len(ids)
+        if self._vectors is None or needed > len(self._ids):
+            capacity = max(1024, needed, 2 * len(self._ids))
+            vectors = np.zeros((capacity, codes.shape[1]), dtype=codes.dtype)
+            new_ids = np.zeros((capacity,), dtype=np.int64)
+            new_scales = np.zeros((capacity,), dtype=np.float32)
+            if self._vectors is not None:
+                vectors[:self._size] = self._vectors[:self._size]
+                new_ids[:self._size] = self._ids[:self._size]
+                new_scales[:self._size] = self._scales[:self._size]
+            self._vectors, self._ids, self._scales = vectors, new_ids, new_scales
+        self._vectors[self._size:needed] = codes
+        self._ids[self._size:needed] = ids
+        self._scales[self._size:needed] = scales
+        start, self._size = self._size, needed
+        if self._centroids is not None:
+            assign = self._nearest_lists(self._decode(np.arange(start, needed)), 1)[:, 0]
+            for position, cluster in zip(range(start, needed), assign):
+                self._lists[cluster].append(position)
+        self._maybe_train()
+
+    def _decode(self, positions):
+        return self._vectors[positions].astype(np.float32) * self._scales[positions, None]
+
+    def _load(self):
+        start = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, image_hash, vector, scale FROM defects ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        code_type = np.int8 if self.dtype == "int8" else np.float16
+        codes = np.stack([np.frombuffer(row[2], dtype=code_type) for row in rows])
+        self._hashes = {row[1] for row in rows}
+        self._append(np.array([row[0] for row in rows]), codes, np.array([row[3] for row in rows], np.float32))
+        logger.info(f"缺陷索引已载入: {self._size} 条, 耗时: {time.time() - start:.2f}s")
+
+    # --- IVF ---
+    def _maybe_train(self):
+        """达到训练条件时启动后台训练，调用方持有 self._lock；训练期间沿用旧的倒排列表（或精确检索）"""
+        if self._training is not None or self._size < self.min_train or \
+                self._size < self.retrain_factor * self._trained_size:
+            return
+        self._training = threading.Thread(target=self._train, name="defect-index-train", daemon=True)
+        self._training.start()
+
+    def _train(self):
+        start = time.time()
+        try:
+            # 只在取快照时持锁：追加写入不会修改已有位置，扩容时旧数组保持不变
+            with self._lock:
+                size, vectors, scales = self._size, self._vectors, self._scales
+            nlist = int(np.clip(np.sqrt(size), 16, 1024))
+            rng = np.random.RandomState(0)
+            sample = np.sort(rng.choice(size, min(size, nlist * 64), replace=False))
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-4)
+            _, _, centroids = cv2.kmeans(vectors[sample].astype(np.float32) * scales[sample, None], nlist, None,
+                                         criteria, 1, cv2.KMEANS_PP_CENTERS)
+            centroids = _normalize(centroids)
+            lists = [[] for _ in range(nlist)]
+            for start_pos in range(0, size, 65536):
+                positions = np.arange(start_pos, min(size, start_pos + 65536))
+                decoded = vectors[positions].astype(np.float32) * scales[positions, None]
+                for position, cluster in zip(positions, _nearest(decoded, centroids, 1)[:, 0]):
+                    lists[cluster].append(int(position))
+            with self._lock:
+                # 训练期间新增的向量按新的聚类中心补入倒排列表
+                if self._size > size:
+                    positions = np.arange(size, self._size)
+                    for position, cluster in zip(positions, _nearest(self._decode(positions), centroids, 1)[:, 0]):
+                        lists[cluster].append(int(position))
+                self._centroids, self._lists, self._trained_size = centroids, lists, size
+                self._training = None
+                self._maybe_train()
+            logger.info(f"缺陷索引 IVF 训练完成: {size} 条, {nlist} 个倒排列表, 耗时: {time.time() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"缺陷索引 IVF 训练失败: {str(e)}")
+            with self._lock:
+                self._training = None
+
+    def wait_trained(self, timeout=None):
+        """等待后台训练结束（测试与离线工具使用）"""
+        training = self._training
+        if training is not None:
+            training.join(timeout)
+
+    def _nearest_lists(self, vectors, count):
+        return _nearest(vectors, self._centroids, count)
+
+    # --- 写入 ---
+    def add(self, image, detections, image_hash, image_name=None, board_type=None, timestamp=None):
+        """
+        把一张图的所有检测框加入索引（同一图片只加入一次）
+
+        Returns:
+            list: 每个检测框的记录 id
+        """
+        boxes = np.asarray(detections["boxes"])
+        if len(boxes) == 0:
+            return []
+        # 已收录的图片直接返回，不必计算特征；并发加入同一图片时以锁内的再次检查为准
+        if image_hash in self._hashes:
+            return self.ids_for(image_hash)
+        crops = crop_defects(image, boxes)
+        vectors = self.embedder(crops)
+        codes, scales = self._encode(vectors)
+        names = detections.get("names", {})
+        ts = timestamp or time.time()
+        with self._lock:
+            if image_hash in self._hashes:
+                return self.ids_for(image_hash)
+            conn = self._connect()
+            try:
+                with conn:
+                    ids = []
+                    for crop, box, score, cls, code, scale in zip(crops, boxes, detections["scores"],
+                                                                  detections["classes"], codes, scales):
+                        cursor = conn.execute(
+                            "INSERT INTO defects (ts, image_hash, image_name, board_type, class_name, confidence, "
+                            "x1, y1, x2, y2, thumbnail, vector, scale) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                            (ts, image_hash, image_name, board_type, names.get(int(cls), str(int(cls))),
+                             float(score), *map(float, box), _thumbnail(crop), code.tobytes(), float(scale)))
+                        ids.append(cursor.lastrowid)
+            finally:
+                conn.close()
+            self._hashes.add(image_hash)
+            self._append(np.array(ids), codes, scales)
+        return ids
+
+    def set_verdict(self, ids, verdict):
+        """记录缺陷的结论（来自 LLM 分析或人工复核）"""
+        if not ids:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("UPDATE defects SET verdict = ? WHERE id = ?", [(verdict, int(i)) for i in ids])
+        finally:
+            conn.close()
+
+    def ids_for(self, image_hash):
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute("SELECT id FROM defects WHERE image_hash = ? ORDER BY id",
+                                                   (image_hash,))]
+        finally:
+            conn.close()
+
+    # --- 检索 ---
+    def search(self, vectors, k=5):
+        """
+        Args:
+            vectors (np.ndarray): (M, D) 查询向量（已归一化）
+            k (int): 每个查询返回的数量
+
+        Returns:
+            list: 每个查询一个 [(记录id, 相似度), ...]，按相似度降序
+        """
+        with self._lock:
+            if self._size == 0:
+                return [[] for _ in range(len(vectors))]
+            results = []
+            probes = self._nearest_lists(vectors, self.nprobe) if self._centroids is not None else None
+            for n, query in enumerate(vectors):
+                if probes is None:
+                    positions = np.arange(self._size)
+                else:
+                    positions = np.fromiter((p for c in probes[n] for p in self._lists[c]), dtype=np.int64)
+                if positions.size == 0:
+                    results.append([])
+                    continue
+                similarity = (self._vectors[positions].astype(np.float32) @ query) * self._scales[positions]
+                top = np.argsort(-similarity)[:k] if positions.size <= k else \
+                    np.argpartition(-similarity, k - 1)[:k]
+                top = top[np.argsort(-similarity[top])]
+                results.append([(int(self._ids[positions[t]]), float(similarity[t])) for t in top])
+            return results
+
+    def similar(self, image, detections, k=5, max_queries=20):
+        """
+        为一张图的检测框检索历史相似缺陷
+
+        Returns:
+            list: 每个检测框（按置信度取前 max_queries 个）一个字典：
+                index、class_name、confidence、matches [{id, similarity, class_name, confidence,
+                image_name, verdict, thumbnail}]
+        """
+        boxes = np.asarray(detections["boxes"])
+        if len(boxes) == 0 or self._size == 0:
+            return []
+        start = time.time()
+        order = np.argsort(-np.asarray(detections["scores"]))[:max_queries]
+        vectors = self.embedder(crop_defects(image, boxes[order]))
+        hits = self.search(vectors, k)
+        metadata = self._metadata({i for row in hits for i, _ in row})
+        names = detections.get("names", {})
+        results = []
+        for n, row in zip(order, hits):
+            cls = int(detections["classes"][n])
+            results.append({
+                "index": int(n),
+                "class_name": names.get(cls, str(cls)),
+                "confidence": float(detections["scores"][n]),
+                "matches": [dict(metadata[i], id=i, similarity=s) for i, s in row if i in metadata],
+            })
+        logger.info(f"相似缺陷检索: {len(order)} 个查询, 耗时: {(time.time() - start) * 1000:.1f}ms")
+        return results
+
+    def known_verdict(self, similar, min_similarity=0.95):
+        """
+        所有检测框都有已知结论的高相似历史缺陷且结论一致时，返回该结论
+
+        Args:
+            similar (list): similar() 的返回值
+            min_similarity (float): 视为同类缺陷的最低相似度
+
+        Returns:
+            tuple: (结论, 每个检测框的匹配记录)，没有可靠匹配时返回 (None, [])
+        """
+        if not similar:
+            return None, []
+        matches = []
+        for item in similar:
+            known = [m for m in item["matches"] if m["verdict"] and m["similarity"] >= min_similarity
+                     and m["class_name"] == item["class_name"]]
+            if not known:
+                return None, []
+            matches.append(known[0])
+        verdicts = {m["verdict"] for m in matches}
+        return (verdicts.pop(), matches) if len(verdicts) == 1 else (None, [])
+
+    def _metadata(self, ids):
+        if not ids:
+            return {}
+        conn = self._connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            placeholders = ",".join("?" * len(ids))
+            rows = conn.execute(f"SELECT id, ts, image_name, board_type, class_name, confidence, verdict, thumbnail "
+                                f"FROM defects WHERE id IN ({placeholders})", list(ids)).fetchall()
+            return {row["id"]: {k: row[k] for k in row.keys() if k != "id"} for row in rows}
+        finally:
+            conn.close()
+
+    def info(self):
+        with self._lock:
+            return {"size": self._size, "dtype": self.dtype, "ivf": self._centroids is not None,
+                    "lists": len(self._lists), "training": self._training is not None,
+                    "memory_mb": (self._vectors.nbytes if self._vectors is not None else 0) / 1024 / 1024}
+
+
+def _thumbnail(crop, size=64):
+    image = Image.fromarray(crop)
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
@@ -0,0 +1,385 @@
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from history import image_hash
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """
+    采样式调用栈分析
+
+    只在有请求被跟踪时按固定间隔采样目标线程的调用栈，开销与请求数无关、
+    远低于 cProfile；结果为折叠栈计数（可直接生成火焰图）。
+    """
+
+    def __init__(self, interval=0.005, max_depth=48):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def start(self, thread_id):
+        with self._lock:
+            self._targets[thread_id] = Counter()
+            self._active.set()
+
+    def stop(self, thread_id):
+        with self._lock:
+            counts = self._targets.pop(thread_id, Counter())
+            if not self._targets:
+                self._active.clear()
+        return counts
+
+    def _fold(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, counts in self._targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counts[self._fold(frame)] += 1
+            time.sleep(self.interval)
+
+
+def backend_state(inference):
+    """推理器当前状态：模型、设备、推理尺寸策略、预热与初筛情况"""
+    state = {}
+    for key in ("model_path", "model_version", "device", "precision", "postprocess", "imgsz", "refine"):
+        value = getattr(inference, key, None)
+        state[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+    resolution = getattr(inference, "resolution", None)
+    if resolution is not None:
+        state["imgsz_options"] = list(resolution.sizes)
+        state["estimated_defect_px"] = resolution.estimated_defect_px()
+    if hasattr(inference, "readiness"):
+        state["readiness"] = inference.readiness()
+    cascade = getattr(inference, "cascade", None)
+    if cascade is not None:
+        # 带上初筛器配置，重放时可以按同样的初筛级复现
+        state["cascade"] = dict(cascade.metrics(), screener=cascade.screener.config())
+    state["threads"] = threading.active_count()
+    try:
+        import psutil
+        state["rss_mb"] = psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    return state
+
+
+def _input_bytes(image_input):
+    """原始输入转为可落盘的字节：文件和字节原样保存，图片对象无损保存为 PNG"""
+    if isinstance(image_input, str):
+        with open(image_input, "rb") as f:
+            return f.read(), os.path.splitext(image_input)[1] or ".img"
+    if isinstance(image_input, (bytes, bytearray, memoryview)):
+        return bytes(image_input), ".img"
+    if hasattr(image_input, "getvalue"):
+        return image_input.getvalue(), ".img"
+    image = image_input if isinstance(image_input, Image.Image) else Image.fromarray(np.asarray(image_input))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue(), ".png"
+
+
+class SlowRequestCapture:
+    """
+    慢请求捕获
+
+    每个请求都以采样方式记录调用栈（mode="cprofile" 时改为完整 cProfile），
+    耗时超过阈值（固定毫秒数，或最近 window 个请求的 percentile 分位）时，
+    把调用栈、输入图片、参数和推理器状态写成一个诊断包；诊断包目录只保留最近 max_bundles 个。
+    """
+
+    def __init__(self, bundle_dir, threshold_ms=None, percentile=99.0, window=500, min_samples=50,
+                 max_bundles=50, mode="sampling", interval=0.005):
+        """
+        Args:
+            bundle_dir (str): 诊断包目录
+            threshold_ms (float): 固定的慢请求阈值（毫秒），None 表示使用分位数阈值
+            percentile (float): 分位数阈值
+            window (int): 计算分位数的最近请求数
+            min_samples (int): 样本数不足时不使用分位数阈值
+            max_bundles (int): 最多保留的诊断包数
+            mode (str): "sampling"（低开销，默认）或 "cprofile"
+            interval (float): 采样间隔（秒）
+        """
+        if mode not in ("sampling", "cprofile"):
+            raise ValueError(f"不支持的分析模式: {mode}")
+        self.bundle_dir = bundle_dir
+        self.threshold_ms = threshold_ms
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_bundles = max_bundles
+        self.mode = mode
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sampler = StackSampler(interval) if mode == "sampling" else None
+        self.stats = {"requests": 0, "captured": 0}
+        os.makedirs(bundle_dir, exist_ok=True)
+
+    def threshold(self):
+        """当前生效的慢请求阈值（毫秒），样本不足时为 None"""
+        if self.threshold_ms is not None:
+            return self.threshold_ms
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self._latencies, self.percentile))
+
+    @contextmanager
+    def track(self, name, image_input, params=None, inference=None):
+        """
+        跟踪一次请求；嵌套调用只由最外层记录
+
+        Yields:
+            dict: 调用方可写入 timings、image_size、detections 等附加信息
+        """
+        record = {}
+        if getattr(self._local, "active", False):
+            yield record
+            return
+        self._local.active = True
+        thread_id = threading.get_ident()
+        profiler = None
+        if self._sampler is not None:
+            self._sampler.start(thread_id)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        threshold = self.threshold()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if profiler is not None:
+                profiler.disable()
+            samples = self._sampler.stop(thread_id) if self._sampler is not None else None
+            self._local.active = False
+            with self._lock:
+                self._latencies.append(elapsed_ms)
+                self.stats["requests"] += 1
+            if threshold is not None and elapsed_ms > threshold:
+                try:
+                    self._write_bundle(name, image_input, params or {}, inference, record, elapsed_ms, threshold,
+                                       samples, profiler)
+                except Exception as e:
+                    logger.error(f"写入诊断包失败: {str(e)}")
+
+    def _write_bundle(self, name, image_input, params, inference, record, elapsed_ms, threshold, samples,
+                      profiler):
+        data, ext = _input_bytes(image_input)
+        digest = image_hash(data)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        bundle = os.path.join(self.bundle_dir, f"{stamp}_{digest[:8]}")
+        os.makedirs(bundle)
+        with open(os.path.join(bundle, f"input{ext}"), "wb") as f:
+            f.write(data)
+
+        detections = record.get("detections")
+        meta = {
+            "name": name,
+            "created": datetime.now().isoformat(timespec="milliseconds"),
+            "elapsed_ms": elapsed_ms,
+            "threshold_ms": threshold,
+            "threshold_source": "fixed" if self.threshold_ms is not None else f"p{self.percentile:g}",
+            "input": f"input{ext}",
+            "image_hash": digest,
+            "input_bytes": len(data),
+            "image_size": list(record["image_size"]) if record.get("image_size") else None,
+            "params": params,
+            "timings": record.get("timings"),
+            "imgsz": record.get("imgsz"),
+            "screen": params.get("screen", True),
+            "cascade": record.get("cascade"),
+            "refined_from": detections.get("refined_from") if detections is not None else None,
+            "num_detections": len(detections["boxes"]) if detections is not None else None,
+            "backend": backend_state(inference) if inference is not None else None,
+            "profile_mode": self.mode,
+        }
+        with open(os.path.join(bundle, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2, default=str)
+
+        if samples is not None:
+            # 折叠栈格式，每行 "栈;帧 计数"
+            with open(os.path.join(bundle, "stacks.folded"), "w", encoding="utf-8") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(bundle, "profile.prof"))
+            with open(os.path.join(bundle, "profile.txt"), "w", encoding="utf-8") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+
+        with self._lock:
+            self.stats["captured"] += 1
+        logger.warning(f"慢请求 {name}: {elapsed_ms:.0f}ms (阈值 {threshold:.0f}ms), 诊断包: {bundle}")
+        self._prune()
+
+    def _prune(self):
+        bundles = list_bundles(self.bundle_dir)
+        for path in bundles[:max(0, len(bundles) - self.max_bundles)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def list_bundles(bundle_dir):
+    """按时间顺序列出诊断包目录"""
+    if not os.path.isdir(bundle_dir):
+        return []
+    return sorted(os.path.join(bundle_dir, name) for name in os.listdir(bundle_dir)
+                  if os.path.exists(os.path.join(bundle_dir, name, "meta.json")))
+
+
+def load_bundle(bundle):
+    with open(os.path.join(bundle, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return meta, os.path.join(bundle, meta["input"])
+
+
+def _path(result):
+    """一次请求经过的路径：是否被初筛跳过、粗推理尺寸、最终推理尺寸"""
+    cascade = result.get("cascade")
+    return {"skipped": bool(cascade and cascade.get("skipped")),
+            "coarse_imgsz": result.get("refined_from") or result.get("imgsz"),
+            "imgsz": result.get("imgsz")}
+
+
+def replay(bundle, model_path=None, device=None, repeats=5, profile=True):
+    """
+    用诊断包中的输入和参数重放请求
+
+    按捕获时的路径重放：捕获时经过初筛则按记录的初筛配置重建初筛级，
+    粗推理尺寸固定为捕获时的尺寸，捕获时触发了两阶段复查则同样开启复查，
+    自适应尺寸的历史状态不影响重放走哪条路径。
+
+    Returns:
+        dict: 每次耗时、检测数与路径和捕获时是否一致、cProfile 摘要
+    """
+    from inference import PCBInference
+    from cascade import Cascade
+
+    meta, input_path = load_bundle(bundle)
+    backend = meta.get("backend") or {}
+    params = meta.get("params", {})
+    screen = meta.get("screen", params.get("screen", True))
+    cascade_config = backend.get("cascade") if screen and meta.get("cascade") else None
+    refined_from = meta.get("refined_from")
+    coarse = refined_from or meta.get("imgsz")
+
+    # 预热捕获时用到的推理尺寸和低分辨率初筛尺寸
+    sizes = {size for size in (coarse, meta.get("imgsz")) if size}
+    if cascade_config and cascade_config.get("screener", {}).get("kind") == "lowres":
+        sizes.add(cascade_config["screener"]["imgsz"])
+    inference = PCBInference(model_path or backend.get("model_path") or "best.engine",
+                             device=device or backend.get("device") or "0",
+                             postprocess=backend.get("postprocess") or "ultralytics",
+                             imgsz="auto", imgsz_options=tuple(sorted(sizes)) or None,
+                             refine=refined_from is not None)
+    if coarse:
+        # 粗推理尺寸固定为捕获时的尺寸，复查尺寸仍由 next_size 决定
+        inference.select_imgsz = lambda image_size: coarse
+    if cascade_config and cascade_config.get("screener"):
+        inference.cascade = Cascade.from_config(cascade_config, inference)
+
+    kwargs = {key: params[key] for key in ("conf_threshold", "iou_threshold", "max_size") if key in params}
+    for key in ("conf_threshold", "iou_threshold"):
+        # 按类别的阈值经 JSON 序列化后类别键变成了字符串
+        if isinstance(kwargs.get(key), dict):
+            kwargs[key] = {int(cls): value for cls, value in kwargs[key].items()}
+    kwargs["screen"] = screen
+    if params.get("imgsz"):
+        # 捕获时调用方指定了尺寸（此时不初筛、不复查）
+        kwargs["imgsz"] = params["imgsz"]
+
+    times, counts, paths = [], [], []
+    profiler = cProfile.Profile() if profile else None
+    for n in range(repeats):
+        start = time.perf_counter()
+        if profiler is not None and n == repeats - 1:
+            profiler.enable()
+        _, detections = inference.detect(input_path, **kwargs)
+        if profiler is not None and n == repeats - 1:
+            profiler.disable()
+        times.append((time.perf_counter() - start) * 1000)
+        counts.append(len(detections["boxes"]))
+        paths.append(_path(detections))
+
+    summary = None
+    if profiler is not None:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(25)
+        summary = stream.getvalue()
+    return {
+        "bundle": bundle,
+        "captured_ms": meta["elapsed_ms"],
+        "replay_ms": times,
+        "num_detections": counts,
+        "paths": paths,
+        "path_consistent": all(path == _path(meta) for path in paths),
+        "consistent": meta.get("num_detections") is None or all(c == meta["num_detections"] for c in counts),
+        "profile": summary,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="慢请求诊断包查看与重放")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="列出诊断包")
+    list_parser.add_argument("bundle_dir")
+    replay_parser = subparsers.add_parser("replay", help="重放诊断包")
+    replay_parser.add_argument("bundle")
+    replay_parser.add_argument("--model", default=None, help="默认使用捕获时的模型路径")
+    replay_parser.add_argument("--device", default=None)
+    replay_parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for bundle in list_bundles(args.bundle_dir):
+            meta, _ = load_bundle(bundle)
+            print(f"{os.path.basename(bundle)}  {meta['name']}  {meta['elapsed_ms']:.0f}ms "
+                  f"(阈值 {meta['threshold_ms']:.0f}ms)  尺寸 {meta['image_size']}  检测数 {meta['num_detections']}")
+        return
+
+    report = replay(args.bundle, args.model, args.device, args.repeats)
+    print(f"捕获耗时: {report['captured_ms']:.0f}ms, 重放耗时: "
+          f"{', '.join(f'{t:.0f}ms' for t in report['replay_ms'])}, 结果一致: {report['consistent']}, "
+          f"路径一致: {report['path_consistent']}")
+    if report["profile"]:
+        print(report["profile"])
+    if not (report["consistent"] and report["path_consistent"]):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+import argparse
+import json
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from detpost import box_iou
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FrameSource:
+    """
+    视频帧源
+
+    支持视频文件和摄像头编号，逐帧产出 RGB 图像。
+    """
+
+    def __init__(self, source, max_frames=None):
+        """
+        Args:
+            source: 视频文件路径或摄像头编号
+            max_frames (int): 最多读取的帧数
+        """
+        self.source = int(source) if isinstance(source, str) and source.isdigit() else source
+        self.max_frames = max_frames
+        self.fps = None
+
+    def __iter__(self):
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            raise FileNotFoundError(f"无法打开视频源: {self.source}")
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        index = 0
+        try:
+            while self.max_frames is None or index < self.max_frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield index, index / self.fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                index += 1
+        finally:
+            capture.release()
+
+
+class MotionGate:
+    """
+    基于画面变化的跳帧控制
+
+    在低分辨率灰度图上比较相邻帧：连续 settle_frames 帧变化都小于 motion_threshold
+    视为板已停稳，每块板停稳后只推理一次；画面仍在运动时（传送带送板中）按 min_skip
+    限制推理频率，由跟踪器在帧间延续检测结果。与当前板的参考帧差异超过 board_threshold
+    视为换板（场景切换）。
+    """
+
+    def __init__(self, motion_threshold=0.02, board_threshold=0.2, min_skip=10, max_skip=None, settle_frames=3,
+                 size=(96, 64)):
+        """
+        Args:
+            motion_threshold (float): 相邻帧平均灰度差（0~1）低于该值视为静止
+            board_threshold (float): 判定为新板的平均灰度差（0~1）
+            min_skip (int): 画面运动时两次推理之间至少跳过的帧数
+            max_skip (int): 两次推理之间最多跳过的帧数，超过后强制推理一次；None 表示静止的板不再重复推理
+            settle_frames (int): 连续静止多少帧视为停稳
+            size (tuple): 比较用的缩略图尺寸
+        """
+        self.motion_threshold = motion_threshold
+        self.board_threshold = board_threshold
+        self.min_skip = min_skip
+        self.max_skip = max_skip
+        self.settle_frames = settle_frames
+        self.size = size
+        self._previous = None
+        self._last_inferred = None
+        self._board_key = None
+        self._skipped = 0
+        self._still = 0
+        self._settled_inferred = False
+
+    def _signature(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        return cv2.GaussianBlur(gray, (3, 3), 0).astype(np.int16)
+
+    @staticmethod
+    def _difference(a, b):
+        return float(np.abs(a - b).mean()) / 255.0
+
+    def check(self, frame):
+        """
+        Returns:
+            tuple: (是否推理, 是否新板)
+        """
+        signature = self._signature(frame)
+        if self._previous is None:
+            self._previous = self._last_inferred = self._board_key = signature
+            self._skipped = 0
+            return True, True
+
+        moving = self._difference(signature, self._previous) > self.motion_threshold
+        self._previous = signature
+        self._still = 0 if moving else self._still + 1
+
+        new_board = self._difference(signature, self._board_key) > self.board_threshold
+        if new_board:
+            self._board_key = signature
+            self._settled_inferred = False
+
+        self._skipped += 1
+        if self._still >= self.settle_frames:
+            # 停稳：每块板只推理一次，之后画面相对上次推理帧有变化（如被移动）才按 min_skip 限频重新推理
+            infer = not self._settled_inferred or (
+                self._skipped > self.min_skip and
+                self._difference(signature, self._last_inferred) > self.motion_threshold)
+            self._settled_inferred = True
+        else:
+            infer = self._skipped > self.min_skip
+        if self.max_skip is not None and self._skipped > self.max_skip:
+            infer = True
+        if infer:
+            self._last_inferred = signature
+            self._skipped = 0
+        return infer, new_board
+
+
+class Track:
+    __slots__ = ("track_id", "box", "velocity", "cls", "name", "best_conf", "best_box", "hits", "age",
+                 "first_frame", "last_frame")
+
+    def __init__(self, track_id, box, conf, cls, name, frame):
+        self.track_id = track_id
+        self.box = box
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.cls = cls
+        self.name = name
+        self.best_conf = conf
+        self.best_box = box
+        self.hits = 1
+        self.age = 0
+        self.first_frame = frame
+        self.last_frame = frame
+
+    def predict(self, frames):
+        return self.box + self.velocity * frames
+
+    def update(self, box, conf, frame):
+        frames = max(1, frame - self.last_frame)
+        self.velocity = 0.5 * self.velocity + 0.5 * (box - self.box) / frames
+        self.box = box
+        self.hits += 1
+        self.age = 0
+        self.last_frame = frame
+        if conf > self.best_conf:
+            self.best_conf = conf
+            self.best_box = box
+
+    def summary(self):
+        return {
+            "track_id": self.track_id,
+            "class_id": int(self.cls),
+            "class_name": self.name,
+            "confidence": round(float(self.best_conf), 4),
+            "box": [round(float(v), 1) for v in self.best_box],
+            "hits": self.hits,
+            "first_frame": self.first_frame,
+            "last_frame": self.last_frame,
+        }
+
+
+class IoUTracker:
+    """
+    轻量级 IoU 跟踪器（ByteTrack 式两阶段匹配）
+
+    先用高置信度检测匹配已有轨迹，再用低置信度检测补充匹配，
+    只有高置信度检测能新建轨迹。匹配按类别进行。
+    """
+
+    def __init__(self, iou_threshold=0.3, high_conf=0.5, max_age=5, min_hits=1):
+        """
+        Args:
+            iou_threshold (float): 匹配所需的最小 IoU
+            high_conf (float): 高/低置信度分界
+            max_age (int): 连续多少次推理未匹配后结束轨迹
+            min_hits (int): 报告轨迹所需的最少命中次数
+        """
+        self.iou_threshold = iou_threshold
+        self.high_conf = high_conf
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.tracks = []
+        self.finished = []
+        self._next_id = 1
+
+    def reset(self):
+        """结束所有轨迹，返回本轮的轨迹摘要"""
+        tracks = self.finished + self.tracks
+        self.tracks, self.finished = [], []
+        return [t.summary() for t in sorted(tracks, key=lambda t: t.track_id) if t.hits >= self.min_hits]
+
+    def _match(self, tracks, boxes, classes, frame):
+        if not tracks or len(boxes) == 0:
+            return [], list(range(len(tracks))), list(range(len(boxes)))
+        predicted = np.stack([t.predict(frame - t.last_frame) for t in tracks])
+        iou = box_iou(predicted, boxes)
+        same_class = np.array([t.cls for t in tracks])[:, None] == classes[None, :]
+        iou = np.where(same_class, iou, 0.0)
+
+        matches = []
+        # 贪心匹配：按 IoU 从高到低
+        order = np.dstack(np.unravel_index(np.argsort(-iou, axis=None), iou.shape))[0]
+        used_t, used_d = set(), set()
+        for t, d in order:
+            if iou[t, d] < self.iou_threshold:
+                break
+            if t in used_t or d in used_d:
+                continue
+            used_t.add(t)
+            used_d.add(d)
+            matches.append((t, d))
+        return (matches, [i for i in range(len(tracks)) if i not in used_t],
+                [i for i in range(len(boxes)) if i not in used_d])
+
+    def update(self, detections, frame):
+        """用一次推理的结果更新轨迹"""
+        boxes = detections["boxes"]
+        scores = detections["scores"]
+        classes = detections["classes"]
+        names = detections.get("names", {})
+
+        high = scores >= self.high_conf
+        high_idx, low_idx = np.flatnonzero(high), np.flatnonzero(~high)
+
+        matches, unmatched_t, unmatched_high = self._match(self.tracks, boxes[high_idx], classes[high_idx], frame)
+        for t, d in matches:
+            i = high_idx[d]
+            self.tracks[t].update(boxes[i], float(scores[i]), frame)
+
+        remaining = [self.tracks[t] for t in unmatched_t]
+        matches, still_unmatched, _ = self._match(remaining, boxes[low_idx], classes[low_idx], frame)
+        for t, d in matches:
+            i = low_idx[d]
+            remaining[t].update(boxes[i], float(scores[i]), frame)
+
+        for t in still_unmatched:
+            remaining[t].age += 1
+
+        for d in unmatched_high:
+            i = high_idx[d]
+            cls = int(classes[i])
+            self.tracks.append(Track(self._next_id, boxes[i], float(scores[i]), cls,
+                                     names.get(cls, str(cls)), frame))
+            self._next_id += 1
+
+        alive = []
+        for track in self.tracks:
+            (alive if track.age <= self.max_age else self.finished).append(track)
+        self.tracks = alive
+
+
+class StreamInspector:
+    """
+    传送带视频检测
+
+    画面变化不足的帧跳过推理，检测结果由跟踪器在帧间延续，
+    按板号汇总缺陷，每块板的每个缺陷只报告一次。
+    """
+
+    def __init__(self, inference, gate=None, tracker=None, conf_threshold=0.25, iou_threshold=0.45):
+        self.inference = inference
+        self.gate = gate or MotionGate()
+        self.tracker = tracker or IoUTracker()
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.stats = {"frames": 0, "inferred": 0, "boards": 0, "inference_time": 0.0}
+
+    def _board_report(self, board_id, first_frame, last_frame):
+        defects = self.tracker.reset()
+        self.stats["boards"] += 1
+        return {
+            "board_id": board_id,
+            "first_frame": first_frame,
+            "last_frame": last_frame,
+            "defect_count": len(defects),
+            "defects": defects,
+        }
+
+    def run(self, source):
+        """
+        处理帧源，每块板结束时产出一份报告
+
+        Args:
+            source: FrameSource 或任意产出 (序号, 时间戳, RGB帧) 的可迭代对象
+
+        Yields:
+            dict: 板级报告
+        """
+        board_id, first_frame, last_frame = 0, 0, 0
+        start = time.time()
+        for index, _, frame in source:
+            self.stats["frames"] += 1
+            infer, new_board = self.gate.check(frame)
+            if new_board and index > 0:
+                yield self._board_report(board_id, first_frame, last_frame)
+                board_id += 1
+                first_frame = index
+            last_frame = index
+            if not infer:
+                continue
+
+            _, detections = self.inference.detect(frame, self.conf_threshold, self.iou_threshold)
+            self.stats["inferred"] += 1
+            self.stats["inference_time"] += detections["timings"]["inference"]
+            self.tracker.update(detections, index)
+
+        if self.stats["frames"] > 0:
+            yield self._board_report(board_id, first_frame, last_frame)
+
+        elapsed = time.time() - start
+        frames = max(1, self.stats["frames"])
+        logger.info(f"视频检测完成: {self.stats['frames']} 帧, 推理 {self.stats['inferred']} 帧 "
+                    f"(跳过 {1 - self.stats['inferred'] / frames:.1%}), {self.stats['boards']} 块板, "
+                    f"处理速度: {frames / max(elapsed, 1e-9):.1f} fps")
+
+
+def main():
+    from inference import PCBInference
+
+    parser = argparse.ArgumentParser(description="传送带视频检测")
+    parser.add_argument("--model", default="best.engine")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--source", required=True, help="视频文件路径或摄像头编号")
+    parser.add_argument("--motion-threshold", type=float, default=0.02)
+    parser.add_argument("--board-threshold", type=float, default=0.2)
+    parser.add_argument("--min-skip", type=int, default=10, help="画面运动时两次推理之间至少跳过的帧数")
+    parser.add_argument("--max-skip", type=int, default=None)
+    parser.add_argument("--settle-frames", type=int, default=3)
+    parser.add_argument("--output", default=None, help="板级报告输出(JSON Lines)")
+    args = parser.parse_args()
+
+    inspector = StreamInspector(
+        PCBInference(args.model, device=args.device),
+        gate=MotionGate(args.motion_threshold, args.board_threshold, args.min_skip, args.max_skip,
+                        args.settle_frames),
+    )
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        for report in inspector.run(FrameSource(args.source)):
+            line = json.dumps(report, ensure_ascii=False)
+            print(line)
+            if output:
+                output.write(line + "\n")
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
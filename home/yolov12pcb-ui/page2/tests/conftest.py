@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+PAGE2_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PAGE2_DIR not in sys.path:
+    sys.path.insert(0, PAGE2_DIR)
+
+NAMES = {0: "missing_hole", 1: "spur"}
+
+
+class StubBoxes:
+    """ultralytics Boxes 的最小替身：xyxy/conf/cls 支持 .cpu().numpy()"""
+
+    class _Tensor(np.ndarray):
+        def cpu(self):
+            return self
+
+        def numpy(self):
+            return np.asarray(self)
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4).view(self._Tensor)
+        self.conf = np.asarray(conf, dtype=np.float32).view(self._Tensor)
+        self.cls = np.asarray(cls, dtype=np.float32).view(self._Tensor)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.names = dict(NAMES)
+
+
+class StubYOLO:
+    """
+    确定性的检测模型替身
+
+    每张图返回两个框（missing_hole 0.9、spur 0.3），按 conf 过滤；
+    每次调用耗时 latency + per_image * 图片数 * (imgsz/640)^2，模拟 GPU 推理的批量开销。
+    """
+
+    latency = 0.0
+    per_image = 0.0
+
+    def __init__(self, model_path=None, task=None):
+        self.names = dict(NAMES)
+        self.calls = []
+
+    def __call__(self, images, imgsz=640, conf=0.25, iou=0.45, **kwargs):
+        if isinstance(conf, dict) or isinstance(iou, dict):
+            raise TypeError("ultralytics 不接受按类别的阈值")
+        batch = images if isinstance(images, list) else [images]
+        self.calls.append({"batch": len(batch), "imgsz": imgsz})
+        time.sleep(self.latency + self.per_image * len(batch) * (imgsz / 640) ** 2)
+        results = []
+        for _ in batch:
+            keep = [i for i, score in enumerate((0.9, 0.3)) if score >= conf]
+            boxes = np.array([[10, 10, 40, 40], [100, 100, 110, 110]], dtype=np.float32)[keep]
+            results.append(StubResult(StubBoxes(boxes, np.array([0.9, 0.3])[keep], np.array([0, 1])[keep])))
+        return results
+
+
+if "ultralytics" not in sys.modules:
+    try:
+        import ultralytics  # noqa: F401
+    except ImportError:
+        sys.modules["ultralytics"] = types.SimpleNamespace(YOLO=StubYOLO)
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    path = tmp_path / "stub.engine"
+    path.write_bytes(b"stub-engine")
+    return str(path)
+
+
+@pytest.fixture
+def make_inference(model_file, monkeypatch):
+    """用替身模型构造 PCBInference（不读取主机画像）"""
+    import inference
+
+    monkeypatch.setattr(inference, "YOLO", StubYOLO)
+
+    def build(**kwargs):
+        kwargs.setdefault("device", "cpu")
+        kwargs.setdefault("host_profile", None)
+        return inference.PCBInference(model_file, **kwargs)
+    return build
+
+
+@pytest.fixture
+def board_image():
+    from PIL import Image
+
+    return Image.new("RGB", (640, 480), (30, 120, 60))
@@ -0,0 +1,39 @@
+import io
+import types
+import zipfile
+
+
+def _upload(name, data):
+    return types.SimpleNamespace(name=name, getvalue=lambda: data)
+
+
+def _zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_expand_uploads_is_lazy_and_skips_oversized_members():
+    from batch import expand_uploads, count_uploads
+
+    archive = _upload("lot.zip", _zip({"b.png": b"b" * 10, "huge.png": b"\0" * 4096, "a.jpg": b"a" * 10,
+                                       "notes.txt": b"x"}))
+    uploads = [_upload("single.bmp", b"s"), archive]
+
+    items = expand_uploads(uploads, max_member_bytes=1024)
+
+    assert not isinstance(items, list)
+    assert next(items) == ("single.bmp", b"s")
+    assert list(items) == [("a.jpg", b"a" * 10), ("b.png", b"b" * 10)]
+    assert count_uploads(uploads, max_member_bytes=1024) == 3
+
+
+def test_expand_uploads_stops_at_max_files():
+    from batch import expand_uploads, count_uploads
+
+    archive = _upload("lot.zip", _zip({f"{n}.png": b"p" for n in range(5)}))
+
+    assert [name for name, _ in expand_uploads([archive], max_files=3)] == ["0.png", "1.png", "2.png"]
+    assert count_uploads([archive, _upload("extra.png", b"e")], max_files=3) == 3
@@ -0,0 +1,32 @@
+from batch_analysis import _synthetic_boards, analyze_lot, pack_boards, parse_verdicts
+from loadtest import MockDifyServer
+
+
+def test_pack_boards_respects_budgets():
+    summaries = [{"id": str(n), "counts": {}, "defects": []} for n in range(25)]
+
+    batches = pack_boards(summaries, max_boards=10)
+
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert sum(batches, []) == list(range(25))
+
+
+def test_parse_verdicts_only_returns_requested_ids():
+    text = '分析如下 ```json {"boards": [{"id": "0", "verdict": "defect"}, {"id": "9", "verdict": "pass"}]} ```'
+
+    assert parse_verdicts(text, ["0", "1"]) == {"0": {"verdict": "defect", "analysis": ""}}
+
+
+def test_analyze_lot_against_mock_workflow():
+    boards = _synthetic_boards(23)
+    server = MockDifyServer(workflow_latency=0.01, latency_sigma=0.0).start()
+    try:
+        report = analyze_lot(boards, server.url, "key", max_boards=10, max_concurrency=2)
+    finally:
+        server.stop()
+
+    assert report["requests"] == 3
+    assert report["failed"] == 0
+    assert [r["id"] for r in report["results"]] == [b["id"] for b in boards]
+    for board, result in zip(boards, report["results"]):
+        assert result["verdict"] == ("defect" if len(board["detections"]["boxes"]) else "pass")
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import weakref
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def image_files(tmp_path):
+    source = tmp_path / "images"
+    source.mkdir()
+    paths = []
+    for n in range(40):
+        path = source / f"board_{n:03d}.jpg"
+        Image.new("RGB", (800, 600), (n * 5, 120, 60)).save(path, quality=80)
+        paths.append(str(path))
+    return paths
+
+
+class AliveImages:
+    """统计同时存活的预处理图片数（图片对象被释放时计数减一）"""
+
+    def __init__(self):
+        self.alive = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def track(self, image):
+        with self._lock:
+            self.alive += 1
+            self.peak = max(self.peak, self.alive)
+        weakref.finalize(image, self._release)
+        return image
+
+    def _release(self):
+        with self._lock:
+            self.alive -= 1
+
+
+def _tracked(model, monkeypatch):
+    tracker = AliveImages()
+    original = type(model).preprocess_image
+
+    def preprocess_image(self, image_input, max_size=1920):
+        return tracker.track(original(self, image_input, max_size))
+
+    monkeypatch.setattr(type(model), "preprocess_image", preprocess_image)
+    return tracker
+
+
+@pytest.mark.parametrize("replicas", [None, 2])
+def test_write_batch_memory_is_bounded(make_inference, image_files, tmp_path, monkeypatch, replicas):
+    """在途图片数不超过一个推理批次加 max_pending，与图片总数无关"""
+    from batch_writer import write_batch
+    from pool import ModelPool
+
+    model = make_inference(imgsz=640)
+    tracker = _tracked(model, monkeypatch)
+    detector = model if replicas is None else ModelPool(lambda: make_inference(imgsz=640), replicas=replicas)
+    batch_size, max_pending = 4, 2
+
+    manifests = write_batch(detector, image_files, str(tmp_path / "out"), batch_size=batch_size,
+                            encode_workers=1, max_pending=max_pending)
+
+    assert [m["index"] for m in manifests] == list(range(len(image_files)))
+    assert all(m["error"] is None and m["num_detections"] == 2 for m in manifests)
+    assert tracker.peak <= batch_size + max_pending + 1
+    with open(tmp_path / "out" / "manifest.jsonl", encoding="utf-8") as f:
+        assert len([json.loads(line) for line in f]) == len(image_files)
+
+
+def test_write_batch_keeps_outputs_of_same_named_inputs_apart(make_inference, tmp_path):
+    from batch_writer import write_batch
+
+    paths = []
+    for folder in ("line_a", "line_b"):
+        (tmp_path / folder).mkdir()
+        path = tmp_path / folder / "board.jpg"
+        Image.new("RGB", (320, 240)).save(path)
+        paths.append(str(path))
+
+    manifests = write_batch(make_inference(imgsz=640), paths, str(tmp_path / "out"), batch_size=2)
+
+    outputs = [m["path"] for m in manifests]
+    assert len(set(outputs)) == 2
+    assert all(os.path.exists(path) for path in outputs)
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def test_lowres_screener_scores_whole_batch_in_one_model_call(make_inference, board_image):
+    from cascade import LowResScreener
+
+    inference = make_inference(imgsz=640)
+    screener = LowResScreener(inference, imgsz=320)
+    calls = len(inference.model.calls)
+
+    scores = screener.score_batch([board_image] * 3)
+
+    # 320 未预热，改用已预热的 640；三张图只调用一次模型
+    assert screener.screen_size == 640
+    assert inference.model.calls[calls:] == [{"batch": 3, "imgsz": 640}]
+    np.testing.assert_allclose(scores, [0.9] * 3)
+
+
+def test_lowres_screener_without_warmed_sizes_sends_everything_to_detection(make_inference, board_image,
+                                                                            monkeypatch):
+    from cascade import Cascade, LowResScreener
+
+    inference = make_inference(imgsz=640)
+    readiness = {"warmed": [], "failed": [640], "pending": []}
+    monkeypatch.setattr(inference, "readiness", lambda: readiness)
+    calls = len(inference.model.calls)
+
+    screener = LowResScreener(inference, imgsz=320)
+    scores, suspicious = Cascade(screener, threshold=0.05).screen([board_image] * 2)
+
+    assert screener.screen_size is None
+    assert suspicious.tolist() == [True, True]
+    assert len(inference.model.calls) == calls
+
+    # 之后有尺寸预热成功时恢复初筛
+    readiness["warmed"] = [640]
+    screener.score_batch([board_image])
+    assert screener.screen_size == 640
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+
+def _raw(num_classes=2):
+    """两个候选：类别 0 分数 0.9、类别 1 分数 0.3，坐标在 640 网络输入空间"""
+    raw = np.zeros((4 + num_classes, 2), dtype=np.float32)
+    raw[:4, 0] = [100, 100, 20, 20]
+    raw[:4, 1] = [300, 300, 10, 10]
+    raw[4, 0] = 0.9
+    raw[5, 1] = 0.3
+    return raw
+
+
+class StubFastPostprocessor:
+    """只替换网络前向，解码使用真实的 FastPostprocessor.decode"""
+
+    def __init__(self):
+        from detpost import FastPostprocessor
+
+        self._decoder = FastPostprocessor(None, "cpu")
+        self.batches = []
+
+    def forward(self, image, imgsz=None):
+        return _raw()
+
+    def forward_batch(self, images, imgsz=None):
+        self.batches.append(len(images))
+        return [_raw() for _ in images]
+
+    def decode(self, *args, **kwargs):
+        return self._decoder.decode(*args, **kwargs)
+
+
+def test_detect_batch_uses_fast_postprocessor_with_per_class_thresholds(make_inference, board_image):
+    inference = make_inference(postprocess="fast", imgsz=640)
+    inference.fast_postprocessor = StubFastPostprocessor()
+
+    single = inference.detect(board_image, conf_threshold={1: 0.2, 0: 0.5})[1]
+    batch = [d for _, _, d in inference.detect_batch([board_image] * 3, batch_size=3,
+                                                      conf_threshold={1: 0.2, 0: 0.5})]
+
+    assert inference.fast_postprocessor.batches == [3]
+    assert len(single["boxes"]) == 2
+    for detections in batch:
+        np.testing.assert_allclose(detections["boxes"], single["boxes"])
+        np.testing.assert_array_equal(detections["classes"], single["classes"])
+
+
+def test_detect_batch_applies_class_top_k(make_inference, board_image):
+    inference = make_inference(postprocess="fast", imgsz=640, class_top_k={1: 0})
+    inference.fast_postprocessor = StubFastPostprocessor()
+
+    detections = next(inference.detect_batch([board_image], conf_threshold=0.2))[2]
+
+    assert detections["classes"].tolist() == [0]
+
+
+def test_ultralytics_path_rejects_per_class_thresholds(make_inference, board_image):
+    inference = make_inference(imgsz=640)
+
+    with pytest.raises(ValueError):
+        list(inference.detect_batch([board_image], conf_threshold={0: 0.5}))
+    with pytest.raises(ValueError):
+        inference.detect(board_image, conf_threshold={0: 0.5})
+
+
+
+def _nms_case():
+    """
+    固定的原始输出（640 网络输入）：
+    0/1 同类高度重叠，1 被抑制；2 与 0 同框但类别不同，保留；
+    3 与其他框不相交；4 低于置信度阈值；5 与 0 IoU 0.25，保留
+    """
+    raw = np.zeros((6, 6), dtype=np.float32)
+    raw[:4] = np.array([[200, 200, 100, 100],
+                        [210, 200, 100, 100],
+                        [200, 200, 100, 100],
+                        [400, 300, 50, 50],
+                        [500, 500, 40, 40],
+                        [260, 200, 100, 100]], dtype=np.float32).T
+    raw[4] = [0.9, 0.8, 0.1, 0.6, 0.0, 0.85]
+    raw[5] = [0.0, 0.0, 0.7, 0.0, 0.2, 0.0]
+    return raw
+
+
+def test_decode_matches_recorded_ultralytics_output():
+    from PIL import Image
+    from detpost import FastPostprocessor
+
+    # ultralytics non_max_suppression + scale_boxes 在该输入上的结果（1280x960 原图，letterbox 上下各留 80）
+    expected_boxes = [[300, 140, 500, 340], [420, 140, 620, 340], [300, 140, 500, 340], [750, 390, 850, 490]]
+    expected_scores = [0.9, 0.85, 0.7, 0.6]
+    expected_classes = [0, 0, 1, 0]
+
+    boxes, scores, classes = FastPostprocessor(None, "cpu").decode(_nms_case(), Image.new("RGB", (1280, 960)),
+                                                                   0.25, 0.45, imgsz=640)
+
+    np.testing.assert_allclose(boxes, expected_boxes, atol=1e-3)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+    assert classes.tolist() == expected_classes
+
+
+def test_postprocess_matches_ultralytics_non_max_suppression():
+    torch = pytest.importorskip("torch")
+    ops = pytest.importorskip("ultralytics.utils.ops")
+    from detpost import postprocess
+
+    raw = _nms_case()
+    reference = ops.non_max_suppression(torch.from_numpy(raw[None]), 0.25, 0.45)[0].numpy()
+    boxes, scores, classes = postprocess(raw, 0.25, 0.45)
+
+    order = np.argsort(-reference[:, 4], kind="stable")
+    np.testing.assert_allclose(boxes, reference[order, :4], atol=1e-3)
+    np.testing.assert_allclose(scores, reference[order, 4], atol=1e-6)
+    assert classes.tolist() == reference[order, 5].astype(int).tolist()
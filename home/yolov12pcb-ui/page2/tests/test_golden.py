@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from golden import ReferenceLibrary
+
+
+def _reference():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 255, (128, 128, 3), dtype=np.uint8))
+
+
+def test_board_type_cannot_escape_library(tmp_path):
+    root = tmp_path / "references"
+    library = ReferenceLibrary(str(root))
+
+    library.add("../escape", _reference())
+    library.add("A/B 板", _reference())
+
+    assert not (tmp_path / "escape.png").exists()
+    assert all(os.path.dirname(os.path.abspath(root / name)) == str(root) for name in os.listdir(root))
+    assert ReferenceLibrary(str(root)).board_types() == ["../escape", "A/B 板"]
+    assert ReferenceLibrary(str(root)).get("A/B 板").board_type == "A/B 板"
+
+
+def _large_board(changed):
+    """2400x600 的平滑参考板；changed 时在参考板坐标 x 200..2300、y 250..330 处有一条宽于 1920 的变化区域"""
+    gradient = np.tile(np.linspace(60, 160, 2400, dtype=np.float32), (600, 1))
+    board = np.repeat(gradient[:, :, None], 3, axis=2).astype(np.uint8)
+    if changed:
+        board[250:330, 200:2300] = 255
+    return Image.fromarray(board)
+
+
+def test_golden_boxes_on_crops_of_large_reference(tmp_path, make_inference, monkeypatch):
+    import golden
+    from golden import GoldenInspector
+
+    inference = make_inference(imgsz=640)
+    library = ReferenceLibrary(str(tmp_path / "references"))
+    # 旧版本直接保存的大尺寸参考图
+    library.add("large", _large_board(changed=False))
+    # 待检图预处理到 1920x480，配准矩阵固定为放大 1.25 倍到参考板坐标
+    monkeypatch.setattr(golden, "register", lambda image, reference: np.diag([1.25, 1.25, 1.0]))
+
+    _, detections = GoldenInspector(inference, library).detect(_large_board(changed=True), "large")
+
+    assert detections["mode"] == "golden"
+    (x0, y0, x1, y1), = detections["regions"]
+    crop_width = (x1 - x0) * 1.25
+    assert crop_width > 1920
+    # 替身模型在（缩小后的）裁剪图上返回 [10, 10, 40, 40]，映射回待检图后按裁剪图的缩放比例放大
+    crop_scale = crop_width / 1920
+    expected = np.array([10, 10, 40, 40]) * crop_scale / 1.25 + [x0, y0, x0, y0]
+    np.testing.assert_allclose(detections["boxes"][0], expected, atol=0.5)
+
+
+def test_reference_is_saved_through_preprocess(tmp_path, make_inference):
+    inference = make_inference(imgsz=640)
+    library = ReferenceLibrary(str(tmp_path / "references"))
+
+    board = library.add("large", _large_board(changed=False), preprocess=inference.preprocess_image)
+
+    assert board.size == (1920, 480)
+    assert ReferenceLibrary(str(tmp_path / "references")).get("large").size == (1920, 480)
@@ -0,0 +1,56 @@
+import threading
+
+from conftest import StubYOLO
+
+
+class NonReentrantYOLO(StubYOLO):
+    """同一实例被并发调用时报错，模拟不可重入的 TensorRT 后端"""
+
+    latency = 0.002
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._active = 0
+        self._guard = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._guard:
+            self._active += 1
+            reentered = self._active > 1
+        try:
+            if reentered:
+                raise RuntimeError("后端被并发调用")
+            return super().__call__(*args, **kwargs)
+        finally:
+            with self._guard:
+                self._active -= 1
+
+
+def test_stress_test_with_non_reentrant_backend(make_inference, board_image, monkeypatch):
+    import inference
+    from pool import ModelPool, stress_test
+
+    monkeypatch.setattr(inference, "YOLO", NonReentrantYOLO)
+    pool = ModelPool(lambda: make_inference(imgsz=640), replicas=2)
+
+    report = stress_test(pool, [board_image] * 3, sessions=3, requests_per_session=10, heavy_threads=3)
+
+    # 会话 0 有 3 个线程，其余会话各 1 个线程
+    assert report["requests"] == (3 + 1 + 1) * 10
+    assert report["errors"] == 0
+    assert report["mismatches"] == 0
+    assert report["correct"]
+    assert set(report["sessions"]) == {"session-0", "session-1", "session-2"}
+
+
+def test_pool_detect_batch_keeps_input_order_and_reports_failures(make_inference, board_image):
+    from pool import ModelPool
+
+    pool = ModelPool(lambda: make_inference(imgsz=640), replicas=2)
+    inputs = [board_image] * 5 + ["/nonexistent.jpg"] + [board_image] * 2
+
+    results = list(pool.detect_batch(inputs, batch_size=3))
+
+    assert [i for i, _, _ in results] == list(range(len(inputs)))
+    assert [image is None for _, image, _ in results] == [False] * 5 + [True] + [False] * 2
+    assert all(len(d["boxes"]) == 2 for _, image, d in results if image is not None)
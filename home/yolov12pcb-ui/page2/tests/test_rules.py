@@ -0,0 +1,37 @@
+import numpy as np
+
+from pipeline import classify_verdict
+from rules import RuleAnalyzer
+
+NAMES = {0: "missing_hole", 1: "spur"}
+
+
+def _detections(boxes, scores, classes):
+    return {"boxes": np.asarray(boxes, dtype=np.float32).reshape(-1, 4), "scores": np.asarray(scores),
+            "classes": np.asarray(classes), "names": NAMES}
+
+
+def test_verdicts_follow_severity_and_confidence():
+    analyzer = RuleAnalyzer()
+    cases = [
+        (_detections([], [], []), "pass"),
+        (_detections([[10, 100, 20, 110]], [0.9], [0]), "defect"),
+        (_detections([[10, 100, 20, 110]], [0.4], [0]), "unknown"),
+        (_detections([[10, 100, 20, 110]] * 2, [0.9, 0.8], [1, 1]), "pass"),
+    ]
+    for detections, expected in cases:
+        result = analyzer.analyze(detections, (640, 640))
+        assert result["verdict"] == expected
+        assert classify_verdict(result["analysis_text"]) == expected
+
+
+def test_regions_without_name():
+    analyzer = RuleAnalyzer({"regions": [{"box": [0, 0, 1, 0.05], "action": "ignore"},
+                                         {"box": [0.4, 0.4, 0.6, 0.6], "action": "critical"}]})
+
+    ignored = analyzer.analyze(_detections([[10, 5, 20, 15]], [0.9], [0]), (640, 640))
+    critical = analyzer.analyze(_detections([[300, 300, 310, 310]], [0.9], [1]), (640, 640))
+
+    assert ignored["verdict"] == "pass" and ignored["ignored"] == 1
+    assert critical["verdict"] == "defect"
+    assert "0.4, 0.4, 0.6, 0.6" in critical["analysis_text"]
@@ -0,0 +1,59 @@
+import threading
+
+from scheduler import Scheduler
+
+
+def gated_task(order, name, started=None, gate=None):
+    """记录执行顺序的任务；给出 gate 时在其放行前一直占用执行槽"""
+    def run():
+        order.append(name)
+        if started is not None:
+            started.set()
+        if gate is not None:
+            assert gate.wait(5)
+        return name
+    return run
+
+
+def test_interactive_task_waits_at_most_one_batch():
+    scheduler = Scheduler().register("detection", 1)
+    order = []
+    started, gate = threading.Event(), threading.Event()
+
+    first = scheduler.submit("detection", "batch", gated_task(order, "batch-0", started, gate), cost=8)
+    assert started.wait(5)
+    # 唯一的执行槽被第一个批次占用时，再排队三个批次，随后到达一个交互请求
+    queued = [scheduler.submit("detection", "batch", gated_task(order, f"batch-{n}"), cost=8) for n in (1, 2, 3)]
+    interactive = scheduler.submit("detection", "interactive", gated_task(order, "interactive"))
+    gate.set()
+
+    for future in [first, interactive] + queued:
+        future.result(timeout=5)
+    scheduler.shutdown()
+
+    assert order == ["batch-0", "interactive", "batch-1", "batch-2", "batch-3"]
+
+
+def test_segmentation_is_not_blocked_by_busy_detection():
+    scheduler = Scheduler().register("detection", 1).register("segmentation", 1)
+    order = []
+    started, gate = threading.Event(), threading.Event()
+
+    detection = scheduler.submit("detection", "batch", gated_task(order, "detection", started, gate))
+    assert started.wait(5)
+    # 检测执行槽仍被占用，分割任务在自己的执行槽上完成
+    assert scheduler.call("segmentation", "interactive", gated_task(order, "segmentation")) == "segmentation"
+    gate.set()
+    detection.result(timeout=5)
+    scheduler.shutdown()
+
+    assert order == ["detection", "segmentation"]
+
+
+def test_run_batches_yields_in_input_order():
+    scheduler = Scheduler().register("detection", 2)
+    items = list(range(23))
+    results = list(scheduler.run_batches("detection", "batch", items, 5, lambda start, chunk: chunk, inflight=3))
+    scheduler.shutdown()
+
+    assert results == items
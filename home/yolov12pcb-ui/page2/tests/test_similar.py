@@ -0,0 +1,38 @@
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def test_concurrent_add_of_same_image_inserts_once(tmp_path, board_image):
+    from similar import DefectIndex, HandcraftedEmbedder
+
+    # 两个线程都通过锁外的检查、计算完特征后才开始写入
+    barrier = threading.Barrier(2)
+    embedder = HandcraftedEmbedder()
+
+    def embed(crops):
+        vectors = embedder(crops)
+        barrier.wait(5)
+        return vectors
+
+    db_path = str(tmp_path / "defects.db")
+    index = DefectIndex(db_path, embedder=embed)
+    detections = {"boxes": np.array([[10, 10, 60, 60], [100, 100, 150, 150]], dtype=np.float32),
+                  "scores": np.array([0.9, 0.8], dtype=np.float32), "classes": np.array([0, 1]),
+                  "names": {0: "missing_hole", 1: "spur"}}
+    results = [None, None]
+
+    def add(n):
+        results[n] = index.add(board_image, detections, "same-image")
+
+    threads = [threading.Thread(target=add, args=(n,)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT COUNT(*) FROM defects").fetchone()[0]
+    assert rows == 2
+    assert results[0] == results[1] == index.ids_for("same-image")
@@ -0,0 +1,39 @@
+def test_replay_follows_captured_refine_path(tmp_path, make_inference, board_image):
+    from slowlog import SlowRequestCapture, list_bundles, load_bundle, replay
+
+    capture = SlowRequestCapture(str(tmp_path / "slow"), threshold_ms=0)
+    inference = make_inference(imgsz="auto", imgsz_options=(320, 640, 960), refine=True, slow_capture=capture)
+
+    # 替身模型的 0.3 分检测落在复查区间内，640 上粗推理后在 960 上复查
+    _, detections = inference.detect(board_image)
+    assert (detections["refined_from"], detections["imgsz"]) == (640, 960)
+
+    bundle, = list_bundles(str(tmp_path / "slow"))
+    meta, _ = load_bundle(bundle)
+    assert meta["screen"] is True
+    assert (meta["refined_from"], meta["imgsz"]) == (640, 960)
+
+    report = replay(bundle, device="cpu", repeats=2, profile=False)
+
+    assert report["paths"] == [{"skipped": False, "coarse_imgsz": 640, "imgsz": 960}] * 2
+    assert report["path_consistent"]
+    assert report["consistent"]
+
+
+def test_replay_rebuilds_cascade_for_screened_request(tmp_path, make_inference, board_image):
+    from cascade import Cascade, LowResScreener
+    from slowlog import SlowRequestCapture, list_bundles, replay
+
+    capture = SlowRequestCapture(str(tmp_path / "slow"), threshold_ms=0)
+    inference = make_inference(imgsz="auto", imgsz_options=(320, 640), slow_capture=capture)
+    # 初筛分数 0.9 低于阈值，判为无缺陷跳过完整检测
+    inference.cascade = Cascade(LowResScreener(inference, imgsz=320), threshold=0.95)
+
+    _, detections = inference.detect(board_image)
+    assert detections["cascade"]["skipped"]
+
+    bundle, = list_bundles(str(tmp_path / "slow"))
+    report = replay(bundle, device="cpu", repeats=1, profile=False)
+
+    assert report["paths"] == [{"skipped": True, "coarse_imgsz": None, "imgsz": None}]
+    assert report["path_consistent"]
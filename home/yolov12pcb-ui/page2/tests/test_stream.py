@@ -0,0 +1,46 @@
+import numpy as np
+
+from stream import MotionGate
+
+
+def _conveyor(boards=3, moving=30, still=30, width=320, height=240, seed=0):
+    """每块板从右侧移入（moving 帧）后停住（still 帧），板面为随机纹理"""
+    rng = np.random.default_rng(seed)
+    background = np.full((height, width, 3), 40, dtype=np.uint8)
+    for _ in range(boards):
+        board = rng.integers(0, 255, (height // 2, width // 2, 3), dtype=np.uint8)
+        board = np.kron(board[::8, ::8], np.ones((8, 8, 1), dtype=np.uint8))[:height // 2, :width // 2]
+        for step in range(moving + still):
+            frame = background.copy()
+            x = max(width // 4, width - (step + 1) * (3 * width // 4) // moving)
+            visible = min(width // 2, width - x)
+            frame[height // 4:height // 4 + height // 2, x:x + visible] = board[:, :visible]
+            yield step < moving, frame
+
+
+def test_still_board_is_inferred_once():
+    gate = MotionGate(min_skip=10)
+    inferred_still = 0
+    inferred_moving = 0
+    frames = list(_conveyor())
+    for moving, frame in frames:
+        infer, _ = gate.check(frame)
+        if infer:
+            if moving:
+                inferred_moving += 1
+            else:
+                inferred_still += 1
+
+    # 每块板停稳后推理一次；运动中按 min_skip 限频
+    assert inferred_still == 3
+    assert inferred_moving <= 3 * (30 // 11 + 1) + 1
+    assert inferred_moving + inferred_still < len(frames) / 5
+
+
+def test_max_skip_forces_periodic_inference():
+    gate = MotionGate(max_skip=9)
+    frame = np.full((240, 320, 3), 90, dtype=np.uint8)
+
+    decisions = [gate.check(frame)[0] for _ in range(31)]
+
+    assert sum(decisions) == 4
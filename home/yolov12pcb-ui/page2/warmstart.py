@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import threading
+import time
+from datetime import datetime
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# /proc/cpuinfo 中影响图优化结果的指令集
+CPU_FLAGS = ("avx", "avx2", "avx512f", "avx512_vnni", "avx512_bf16", "amx_tile", "fma", "f16c", "sse4_2",
+             "asimd", "sve")
+
+
+def default_snapshot_dir():
+    return os.environ.get("PCB_SNAPSHOT_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "pcb-inference")
+
+
+def host_fingerprint():
+    """主机特征：CPU 架构、相关指令集与推理库版本，优化产物只能在相同特征的主机上复用"""
+    flags = set()
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags.update(line.split(":", 1)[1].split())
+                    break
+    except OSError:
+        pass
+    parts = [platform.machine(), ",".join(sorted(flags.intersection(CPU_FLAGS)))]
+    try:
+        import onnxruntime
+        parts.append(f"ort{onnxruntime.__version__}")
+    except ImportError:
+        pass
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=6).hexdigest()
+
+
+class SnapshotCache:
+    """
+    模型优化产物缓存
+
+    ONNX 模型首次加载时做一次完整的图优化并把结果落盘，之后按
+    (模型内容摘要, 主机特征) 直接复用；TensorRT 引擎本身就是编译产物，原样使用。
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_snapshot_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.host = host_fingerprint()
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {"digests": {}, "snapshots": {}}
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def digest(self, model_path):
+        """模型文件内容摘要，按 (大小, 修改时间) 缓存，重启时不必重新读取整个文件"""
+        path = os.path.abspath(model_path)
+        stat = os.stat(path)
+        with self._lock:
+            index = self._load_index()
+            cached = index["digests"].get(path)
+            if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+                return cached["digest"]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        value = digest.hexdigest()
+        with self._lock:
+            index = self._load_index()
+            index["digests"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": value}
+            self._save_index(index)
+        return value
+
+    def key(self, model_path):
+        return f"{self.digest(model_path)}-{self.host}"
+
+    def resolve(self, model_path):
+        """
+        返回实际加载的模型路径：已有快照直接返回，ONNX 没有快照时先生成
+
+        Returns:
+            str: 模型路径（快照或原始文件）
+        """
+        if not model_path.endswith(".onnx"):
+            return model_path
+        key = self.key(model_path)
+        snapshot_path = os.path.join(self.cache_dir, f"{key}.onnx")
+        if os.path.exists(snapshot_path):
+            logger.info(f"使用模型快照: {snapshot_path}")
+            return snapshot_path
+        try:
+            self._build_onnx(model_path, snapshot_path, key)
+            return snapshot_path
+        except Exception as e:
+            logger.warning(f"生成模型快照失败，使用原始模型: {str(e)}")
+            return model_path
+
+    def _build_onnx(self, model_path, snapshot_path, key):
+        import onnx
+        import onnxruntime as ort
+
+        start = time.time()
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath = tmp_path
+        ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+        # 优化后的模型不一定保留 ultralytics 的元数据（类别名、步长、输入尺寸），从原模型复制
+        optimized = onnx.load(tmp_path)
+        del optimized.metadata_props[:]
+        optimized.metadata_props.extend(onnx.load(model_path, load_external_data=False).metadata_props)
+        onnx.save(optimized, tmp_path)
+        os.replace(tmp_path, snapshot_path)
+
+        build_time = time.time() - start
+        with self._lock:
+            index = self._load_index()
+            index["snapshots"][key] = {
+                "source": os.path.abspath(model_path),
+                "path": snapshot_path,
+                "host": self.host,
+                "build_time_s": build_time,
+                "created": datetime.now().isoformat(timespec="seconds"),
+            }
+            self._save_index(index)
+        logger.info(f"已生成模型快照: {snapshot_path}, 耗时: {build_time:.2f}s")
+
+    def prune(self, keep=4):
+        """只保留最近生成的 keep 个快照"""
+        with self._lock:
+            index = self._load_index()
+            ordered = sorted(index["snapshots"].items(), key=lambda item: item[1]["created"], reverse=True)
+            for key, entry in ordered[keep:]:
+                if os.path.exists(entry["path"]):
+                    os.remove(entry["path"])
+                del index["snapshots"][key]
+            self._save_index(index)
+
+
+def measure_startup(model_path, device="cpu", imgsz="auto", snapshot_dir=None, background_warmup=True):
+    """
+    测量从构造推理器到完成第一次推理的时间
+
+    Returns:
+        dict: 加载耗时、首次推理耗时、就绪状态
+    """
+    import numpy as np
+    from inference import PCBInference
+
+    start = time.time()
+    inference = PCBInference(model_path, device=device, imgsz=imgsz, warm_start=True, snapshot_dir=snapshot_dir,
+                             background_warmup=background_warmup)
+    loaded = time.time()
+    inference.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+    first = time.time()
+    ready = inference.wait_ready(timeout=300)
+    return {
+        "load_s": loaded - start,
+        "time_to_first_inference_s": first - start,
+        "time_to_ready_s": time.time() - start,
+        "ready": ready,
+        "readiness": inference.readiness(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型快照生成与启动耗时测量")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--snapshot-dir", default=None)
+    parser.add_argument("--build-only", action="store_true", help="只生成快照，不测量启动耗时")
+    args = parser.parse_args()
+
+    if args.build_only:
+        print(SnapshotCache(args.snapshot_dir).resolve(args.model))
+        return
+    print(json.dumps(measure_startup(args.model, args.device, snapshot_dir=args.snapshot_dir),
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 import paddleseg.transforms as T
 from paddleseg.core import predict
 import paddle
@@ -7,6 +9,8 @@ from paddleseg import utils
 from paddleseg.cvlibs import manager
 from paddleseg.models import layers
 
+from segpost import load_volume, analyze_volume, read_spacing
+
 
 @manager.MODELS.add_component
 class Unet(nn.Layer):
@@ -125,21 +129,62 @@ class UpSampling(nn.Layer):
         x = self.double_conv(x)
         return x
 
-model = Unet(num_classes=3)
-# #生成图片列表
-image_list = ['image/1125.png']
-# with open('work/newdata/test_list.txt' ,'r') as f:
-#     for line in f.readlines():
-#         image_list.append(line.split()[0])
+# 模型权重与预测结果目录（相对本文件）
+base_dir = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(base_dir, 'model/Unet.pdparams')
+SAVE_DIR = os.path.join(base_dir, 'output/Unet/results')
+
 transforms = T.Compose([
     T.Resize(target_size=(512, 512)),
     T.Normalize()
 ])
-predict(
-        model,
-        #这是我的训练的模型保存结果路径
-        model_path = 'model/Unet.pdparams',
-        transforms=transforms,
-        image_list=image_list,
-        save_dir='output/Unet/results',
-    )
\ No newline at end of file
+
+
+def segment(image_list, spacing=(1.0, 1.0, 1.0), model_path=MODEL_PATH, save_dir=SAVE_DIR):
+    """
+    分割一组切片并做掩膜后处理（肝脏最大连通域过滤 + 肿瘤测量）
+
+    paddleseg 的 predict 每次调用都会重新加载权重，不是线程安全的，
+    页面中经调度器的 "segmentation" 资源（单个执行槽）串行调用。
+
+    Args:
+        image_list (list): 按层序排列的切片图片路径
+        spacing (tuple): 体素间距 (z, y, x)，单位mm，一般由 segpost.read_spacing 从原始体数据读取
+        model_path (str): 模型权重路径
+        save_dir (str): 预测结果目录
+
+    Returns:
+        dict: segpost.analyze_volume 的结果
+    """
+    predict(
+            Unet(num_classes=3),
+            model_path=model_path,
+            transforms=transforms,
+            image_list=image_list,
+            save_dir=save_dir,
+        )
+    mask_paths = [os.path.join(save_dir, 'pseudo_color_prediction',
+                               os.path.splitext(os.path.basename(p))[0] + '.png') for p in image_list]
+    return analyze_volume(load_volume(mask_paths), spacing=spacing)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="肝脏肿瘤分割与测量")
+    parser.add_argument("images", nargs="*", default=['image/1125.png'], help="按层序排列的切片图片")
+    # 切片所属的原始体数据，体素间距从其文件头读取；未给出时按各向 1mm 计算
+    parser.add_argument("--volume", default=None, help="原始体数据 (.nii/.nii.gz)，用于读取体素间距")
+    args = parser.parse_args()
+    # #生成图片列表
+    # with open('work/newdata/test_list.txt' ,'r') as f:
+    #     for line in f.readlines():
+    #         image_list.append(line.split()[0])
+    # 先读取体素间距，路径错误时不必等推理结束
+    spacing = read_spacing(args.volume) if args.volume else (1.0, 1.0, 1.0)
+    summary = segment(args.images, spacing=spacing)
+    print(f"肝脏体积: {summary['liver_volume_ml']:.2f} ml, 肿瘤数量: {summary['tumor_count']}, "
+          f"肿瘤负荷: {summary['tumor_burden']:.2%}")
+    for tumor in summary['tumors']:
+        print(f"  肿瘤 {tumor['id']}: {tumor['volume_mm3']:.1f} mm³, "
+              f"最大轴向径 {tumor['max_axial_diameter_mm']:.1f} mm")
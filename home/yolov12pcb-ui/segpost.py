@@ -0,0 +1,343 @@
+import os
+import logging
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# UNet三分类输出的类别编号
+BACKGROUND = 0
+LIVER = 1
+TUMOR = 2
+
+# 计算最大轴向径时使用的投影方向数量
+FERET_ANGLES = 32
+
+
+def load_mask(mask_input):
+    """
+    读取分割结果掩膜
+
+    paddleseg 的 pseudo_color_prediction 是调色板(P模式)PNG，
+    直接取索引值即为类别编号，无需按颜色反查。
+
+    Args:
+        mask_input: 掩膜文件路径、PIL.Image 或 numpy 数组
+
+    Returns:
+        np.ndarray: uint8 类别掩膜 (H, W)
+    """
+    if isinstance(mask_input, np.ndarray):
+        return mask_input.astype(np.uint8, copy=False)
+    if isinstance(mask_input, str):
+        if not os.path.exists(mask_input):
+            raise FileNotFoundError(f"掩膜文件不存在: {mask_input}")
+        mask_input = Image.open(mask_input)
+    if not isinstance(mask_input, Image.Image):
+        raise ValueError("不支持的掩膜输入格式")
+    if mask_input.mode not in ('P', 'L'):
+        raise ValueError(f"掩膜必须是调色板或灰度图, 当前模式: {mask_input.mode}")
+    return np.asarray(mask_input, dtype=np.uint8)
+
+
+def read_spacing(path):
+    """
+    从 NIfTI 头读取体素间距，只解析文件头、不读取体数据
+
+    Args:
+        path (str): 原始体数据 (.nii / .nii.gz) 路径
+
+    Returns:
+        tuple: 体素间距 (z, y, x)，单位mm
+    """
+    try:
+        import nibabel as nib
+    except ImportError:
+        raise ImportError("读取 .nii 需要安装 nibabel: pip install nibabel")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"体数据文件不存在: {path}")
+    # nibabel 轴序为 (X, Y, Z)
+    zooms = nib.load(path).header.get_zooms()[:3]
+    return float(zooms[2]), float(zooms[1]), float(zooms[0])
+
+
+def load_volume(mask_paths):
+    """
+    将按层排序的切片掩膜堆叠为三维体数据
+
+    Args:
+        mask_paths (list): 切片掩膜路径，顺序即为层序
+
+    Returns:
+        np.ndarray: uint8 体掩膜 (Z, H, W)
+    """
+    if not mask_paths:
+        raise ValueError("掩膜列表为空")
+    first = load_mask(mask_paths[0])
+    volume = np.empty((len(mask_paths),) + first.shape, dtype=np.uint8)
+    volume[0] = first
+    for z, path in enumerate(mask_paths[1:], start=1):
+        volume[z] = load_mask(path)
+    return volume
+
+
+def _as_volume(mask):
+    """二维切片统一提升为单层体数据"""
+    mask = np.asarray(mask)
+    if mask.ndim == 2:
+        return mask[np.newaxis]
+    if mask.ndim != 3:
+        raise ValueError(f"掩膜维度必须是2或3, 当前: {mask.ndim}")
+    return mask
+
+
+def _structure(ndim, connectivity):
+    """连通性结构元素，connectivity=1 为面相邻，=ndim 为全相邻"""
+    connectivity = max(1, min(connectivity, ndim))
+    return ndimage.generate_binary_structure(ndim, connectivity)
+
+
+def label_components(binary, connectivity=1):
+    """
+    整体连通域标记（一次处理整个体数据，不逐层循环）
+
+    Args:
+        binary (np.ndarray): 布尔掩膜 (Z, H, W) 或 (H, W)
+        connectivity (int): 连通性，1 为6邻域(2D为4邻域)
+
+    Returns:
+        tuple: (labels, num) 标记数组(int32)和连通域数量
+    """
+    binary = np.asarray(binary, dtype=bool)
+    labels, num = ndimage.label(binary, structure=_structure(binary.ndim, connectivity))
+    return labels.astype(np.int32, copy=False), int(num)
+
+
+def component_sizes(labels, num):
+    """各连通域的体素数，下标0为背景"""
+    return np.bincount(labels.ravel(), minlength=num + 1)
+
+
+def keep_largest_component(binary, connectivity=1):
+    """
+    只保留最大连通域
+
+    Args:
+        binary (np.ndarray): 布尔掩膜
+        connectivity (int): 连通性
+
+    Returns:
+        np.ndarray: 只含最大连通域的布尔掩膜
+    """
+    labels, num = label_components(binary, connectivity)
+    if num <= 1:
+        return labels > 0
+    sizes = component_sizes(labels, num)
+    sizes[0] = 0
+    return labels == int(np.argmax(sizes))
+
+
+def filter_liver(volume, connectivity=1):
+    """
+    肝脏最大连通域过滤
+
+    肿瘤位于肝脏内部，因此以"肝脏+肿瘤"整体求最大连通域，
+    去掉其外的所有误检（包括游离的肿瘤像素）。
+
+    Args:
+        volume (np.ndarray): 类别体掩膜 (Z, H, W) 或 (H, W)
+        connectivity (int): 连通性
+
+    Returns:
+        np.ndarray: 过滤后的类别掩膜，形状与输入一致
+    """
+    volume = np.asarray(volume)
+    organ = keep_largest_component(volume != BACKGROUND, connectivity)
+    filtered = volume.copy()
+    filtered[~organ] = BACKGROUND
+    return filtered
+
+
+def _max_axial_diameters(labels, num, spacing, angles=FERET_ANGLES):
+    """
+    计算每个肿瘤的最大轴向径(mm)
+
+    在每一层上对多个方向求投影宽度(Feret径)，对边界体素、
+    所有方向一次性分组求极值，再取各肿瘤所有层与方向上的最大值。
+    投影的极值总在层内边界上取得（内部像素总有一个相邻像素投影不小于它），
+    只投影边界体素（掩膜减去层内腐蚀）即可，大肿瘤的计算量与内存随之降到周长量级。
+    """
+    diameters = np.zeros(num + 1, dtype=np.float64)
+    foreground = labels > 0
+    # 只在层内腐蚀（不跨层），图像边缘的体素也算作边界
+    interior = ndimage.binary_erosion(foreground, structure=ndimage.generate_binary_structure(2, 1)[None])
+    z, y, x = np.nonzero(foreground & ~interior)
+    if z.size == 0:
+        return diameters[1:]
+    lab = labels[z, y, x]
+    dz, dy, dx = spacing
+
+    # (肿瘤, 层) 分组
+    group_keys = lab.astype(np.int64) * labels.shape[0] + z
+    uniq, group = np.unique(group_keys, return_inverse=True)
+
+    theta = np.linspace(0.0, np.pi, angles, endpoint=False)
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    # (N, angles) 物理坐标投影
+    proj = np.outer(x * dx, cos_t) + np.outer(y * dy, sin_t)
+
+    hi = np.full((uniq.size, angles), -np.inf)
+    lo = np.full((uniq.size, angles), np.inf)
+    np.maximum.at(hi, group, proj)
+    np.minimum.at(lo, group, proj)
+
+    # 加上单个像素在该方向上的投影宽度，保证单像素肿瘤直径不为0
+    pixel_extent = np.abs(cos_t) * dx + np.abs(sin_t) * dy
+    width = (hi - lo + pixel_extent).max(axis=1)
+
+    group_label = uniq // labels.shape[0]
+    np.maximum.at(diameters, group_label, width)
+    return diameters[1:]
+
+
+def measure_tumors(volume, spacing=(1.0, 1.0, 1.0), connectivity=1, min_voxels=1):
+    """
+    肿瘤体积与径线测量
+
+    Args:
+        volume (np.ndarray): 类别体掩膜 (Z, H, W) 或 (H, W)
+        spacing (tuple): 体素间距 (z, y, x)，单位mm
+        connectivity (int): 连通性
+        min_voxels (int): 小于该体素数的连通域视为噪声忽略
+
+    Returns:
+        list: 每个肿瘤一个字典，按体积从大到小排列
+    """
+    volume = _as_volume(volume)
+    spacing = tuple(float(s) for s in spacing)
+    if len(spacing) == 2:
+        spacing = (1.0,) + spacing
+    voxel_mm3 = float(np.prod(spacing))
+
+    labels, num = label_components(volume == TUMOR, connectivity)
+    if num == 0:
+        return []
+
+    index = np.arange(1, num + 1)
+    counts = component_sizes(labels, num)[1:]
+    centroids = np.asarray(ndimage.center_of_mass(labels > 0, labels, index)).reshape(num, 3)
+    slices = ndimage.find_objects(labels)
+    axial = _max_axial_diameters(labels, num, spacing)
+
+    volumes_mm3 = counts * voxel_mm3
+    equivalent = np.cbrt(6.0 * volumes_mm3 / np.pi)
+
+    tumors = []
+    for i in np.argsort(-counts, kind='stable'):
+        if counts[i] < min_voxels:
+            continue
+        sl = slices[i]
+        bbox = tuple((s.start, s.stop) for s in sl)
+        extent = tuple((stop - start) * sp for (start, stop), sp in zip(bbox, spacing))
+        tumors.append({
+            "id": int(index[i]),
+            "voxels": int(counts[i]),
+            "volume_mm3": float(volumes_mm3[i]),
+            "volume_ml": float(volumes_mm3[i] / 1000.0),
+            "equivalent_diameter_mm": float(equivalent[i]),
+            "max_axial_diameter_mm": float(axial[i]),
+            "extent_mm": extent,
+            "centroid": tuple(float(c) for c in centroids[i]),
+            "centroid_mm": tuple(float(c * sp) for c, sp in zip(centroids[i], spacing)),
+            "bbox": bbox,
+        })
+    return tumors
+
+
+def bounding_boxes(volume, label_value):
+    """
+    指定类别各连通域的包围盒
+
+    Args:
+        volume (np.ndarray): 类别体掩膜
+        label_value (int): 类别编号
+
+    Returns:
+        list: [(z0, z1), (y0, y1), (x0, x1)] 形式的包围盒列表
+    """
+    volume = _as_volume(volume)
+    labels, _ = label_components(volume == label_value)
+    return [tuple((s.start, s.stop) for s in sl) for sl in ndimage.find_objects(labels) if sl is not None]
+
+
+def extract_contours(volume, label_value, approx=True):
+    """
+    提取指定类别的轮廓
+
+    只在含有该类别的层上调用 cv2.findContours，空层通过整体
+    布尔归约一次性跳过。
+
+    Args:
+        volume (np.ndarray): 类别体掩膜 (Z, H, W) 或 (H, W)
+        label_value (int): 类别编号
+        approx (bool): 是否压缩轮廓点
+
+    Returns:
+        dict: 层号 -> 轮廓列表(每个为 (N, 2) 的 x, y 坐标数组)
+    """
+    volume = _as_volume(volume)
+    binary = (volume == label_value)
+    method = cv2.CHAIN_APPROX_SIMPLE if approx else cv2.CHAIN_APPROX_NONE
+    contours = {}
+    for z in np.flatnonzero(binary.any(axis=(1, 2))):
+        found, _ = cv2.findContours(binary[z].view(np.uint8), cv2.RETR_EXTERNAL, method)
+        contours[int(z)] = [c.reshape(-1, 2) for c in found]
+    return contours
+
+
+def analyze_volume(volume, spacing=(1.0, 1.0, 1.0), filter_organ=True, connectivity=1, min_voxels=1):
+    """
+    对UNet输出做完整后处理
+
+    Args:
+        volume (np.ndarray): 类别体掩膜 (Z, H, W) 或 (H, W)
+        spacing (tuple): 体素间距 (z, y, x)，单位mm
+        filter_organ (bool): 是否做肝脏最大连通域过滤
+        connectivity (int): 连通性
+        min_voxels (int): 肿瘤最小体素数
+
+    Returns:
+        dict: 肝脏/肿瘤统计、每个肿瘤的测量结果以及过滤后的掩膜
+    """
+    start = time.time()
+    volume = _as_volume(volume)
+    if len(spacing) == 2:
+        spacing = (1.0,) + tuple(spacing)
+    if filter_organ:
+        volume = filter_liver(volume, connectivity)
+
+    voxel_mm3 = float(np.prod(spacing))
+    counts = np.bincount(volume.ravel(), minlength=3)
+    tumors = measure_tumors(volume, spacing, connectivity, min_voxels)
+
+    liver_ml = float((counts[LIVER] + counts[TUMOR]) * voxel_mm3 / 1000.0)
+    # 只统计计入 tumor_count 的肿瘤，小于 min_voxels 的噪声连通域不计入体积
+    tumor_ml = float(sum(tumor["volume_ml"] for tumor in tumors))
+    elapsed = time.time() - start
+    logger.info(f"后处理完成: 肿瘤 {len(tumors)} 个, 耗时: {elapsed:.3f}s")
+
+    return {
+        "liver_volume_ml": liver_ml,
+        "tumor_volume_ml": tumor_ml,
+        "tumor_burden": tumor_ml / liver_ml if liver_ml > 0 else 0.0,
+        "tumor_count": len(tumors),
+        "tumors": tumors,
+        "mask": volume,
+        "time": elapsed,
+    }